@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from sqlalchemy import event
+import wager_fakes
+
+# benchmark the bot's command and reaction hot paths against wager_fakes' stand-in for discord and a seeded SQLite DB
+# drives the real handlers (create_wager, on_raw_reaction_add -> accept_wager / check_for_winner / resolve_winner,
+# list_wagers, on_member_remove) and reports events/sec, p50/p99 handler latency, DB queries and REST calls per event
+# the contention scenarios race concurrent settlements of one wager and check it only ever pays out once
+# usage: python wager_bench.py [--members 200 --history 2000 --events 500 ...] --output bench_results.json
+
+# settings the bot reads from the environment at import (anything already set, e.g. from .env, wins)
+BOT_ENV = {
+    "DISCORD_TOKEN": "benchmark",
+    "APP_ENV": "dev",
+    "STARTING_MONEY": "1000",
+    "WEEKLY_MONEY": "2",
+    "WELCOME_TEXT": "Welcome!",
+    "WAGER_HELP_TEXT": "",
+    "WAGER_FORMAT_TEXT": "",
+    "WAGER_BRIEF_TEXT": "",
+}
+
+# the bot's emojis, which every fake guild starts with
+REQUIRED_EMOJIS = ["wagerin", "wagerwin", "wagerlose"]
+
+# import the bot with its DB (SQLite in db.sql) and log file in a scratch directory
+def load_bot(workdir):
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    for name, value in BOT_ENV.items():
+        os.environ.setdefault(name, value)
+    os.environ["DATABASE_URL"] = "sqlite:///db.sql" # never the real database, whatever .env says
+    os.environ["AUTO_MIGRATE"] = "1"
+    with contextlib.redirect_stdout(io.StringIO()): # the engine echoes the schema it creates on import
+        import wager_commands
+    wager_commands.wager_models.engine.echo = False
+    return wager_commands
+
+# get the p-th percentile (0-100) of a list of numbers
+def percentile(values, p):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+# the current commit, so results can be compared between commits
+def current_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Bench:
+    def __init__(self, bot, fake, args):
+        self.bot = bot
+        self.fake = fake
+        self.args = args
+        self.random = random.Random(args.seed)
+        self.queries = 0
+        self.guilds = []
+        event.listen(bot.wager_models.engine, "before_cursor_execute", self.count_query)
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    # -- setup --
+
+    # build the fake guilds and members, and seed the DB with their accounts and a history of completed wagers
+    async def seed(self):
+        models = self.bot.wager_models
+        users = []
+        wagers = []
+        for guild_number in range(self.args.guilds):
+            guild = self.fake.add_guild(f"guild{guild_number}", REQUIRED_EMOJIS)
+            channel = self.fake.add_channel(guild)
+            members = [self.fake.add_member(guild) for _ in range(self.args.members)]
+            self.guilds.append((guild, channel, members))
+            users += [{"guild_id": guild.id, "id": member.id, "money": int(BOT_ENV["STARTING_MONEY"]), "escrow": 0} for member in members]
+            for _ in range(self.args.history):
+                winner, loser = self.random.sample(members, 2)
+                wagers.append({
+                    "guild_id": guild.id, "channel_id": channel.id, "message_id": self.fake.next_id(),
+                    "creator_id": winner.id, "taker_id": loser.id, "amount": self.random.randint(1, 20),
+                    "description": "seeded wager", "created_at": datetime.datetime.now(),
+                    "accepted": True, "completed": True, "winner_id": winner.id, "loser_id": loser.id,
+                })
+        with models.engine.begin() as connection:
+            if users:
+                connection.execute(models.User.__table__.insert(), users)
+            if wagers:
+                connection.execute(models.Wager.__table__.insert(), wagers)
+
+        # warm the caches the way on_ready does
+        guild_ids = {guild.id for guild, channel, members in self.guilds}
+        for guild_id in guild_ids:
+            await self.bot.validate_emojis(REQUIRED_EMOJIS, guild_id)
+        self.bot.wager_index.load(await self.bot.wager_db.run(self.bot.wager_db.find_active_wager_states, guild_ids))
+        self.bot.leaderboards.load(await self.bot.wager_db.run(self.bot.wager_db.find_standings, guild_ids))
+        self.bot.dispatcher.start()
+
+    # -- measuring --
+
+    # run a batch of events (coroutine functions) like the gateway would, up to `concurrency` at a time, and measure them
+    # the clock stops once every REST call they queued has been delivered
+    async def measure(self, name, events):
+        latencies = []
+        queries = self.queries
+        rest_calls = self.fake.total_rest_calls()
+        rate_limited = self.fake.rate_limited
+        limit = asyncio.Semaphore(self.args.concurrency)
+
+        async def handle(run_event):
+            async with limit:
+                start = time.perf_counter()
+                await run_event()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[handle(run_event) for run_event in events])
+        await self.bot.dispatcher.flush()
+        elapsed = time.perf_counter() - start
+        count = max(len(events), 1)
+        result = {
+            "events": len(events),
+            "seconds": round(elapsed, 4),
+            "events_per_sec": round(len(events) / elapsed, 2) if elapsed else None,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+            "queries_per_event": round((self.queries - queries) / count, 2),
+            "rest_calls_per_event": round((self.fake.total_rest_calls() - rest_calls) / count, 2),
+            "rate_limited": self.fake.rate_limited - rate_limited,
+        }
+        print(f"{name:>16}: {result['events']:>6} events {result['events_per_sec']:>9} ev/s  p50 {result['p50_ms']:>8}ms  "
+              f"p99 {result['p99_ms']:>8}ms  {result['queries_per_event']:>6} queries/ev  {result['rest_calls_per_event']:>5} REST/ev")
+        return result
+
+    # the bot's emoji object for one of our emojis in a guild
+    def emoji(self, guild, name):
+        return self.fake.emojis[self.bot.emoji_cache.get(guild.id, name)]
+
+    # the wagers in the DB that are open / accepted (as (wager, guild, channel) with their fake discord objects)
+    def find_wagers(self, accepted):
+        session = self.bot.wager_models.Session()
+        try:
+            Wager = self.bot.wager_models.Wager
+            wagers = session.query(Wager).filter_by(accepted=accepted, completed=False).order_by(Wager.id).all()
+        finally:
+            session.close()
+        guilds = {guild.id: (guild, channel) for guild, channel, members in self.guilds}
+        return [(wager,) + guilds[wager.guild_id] for wager in wagers if wager.guild_id in guilds]
+
+    # -- scenarios --
+
+    # members post new wagers
+    def create_events(self):
+        events = []
+        for number in range(self.args.events):
+            guild, channel, members = self.random.choice(self.guilds)
+            ctx = self.fake_context(self.random.choice(members), channel, f"!wager 5 bench wager {number}")
+            events.append(lambda ctx=ctx, number=number: self.bot.create_wager.callback(ctx, 5, wager_text=f"bench wager {number}"))
+        return events
+
+    # other members react with :wagerin: to take half of the open wagers
+    def accept_events(self):
+        events = []
+        open_wagers = self.find_wagers(False)
+        for wager, guild, channel in open_wagers[:len(open_wagers) // 2]:
+            taker = self.random.choice([member for member in guild.members.values() if member.id != wager.creator_id])
+            payload = self.fake.reaction_payload(channel.messages[wager.message_id], taker.id, self.emoji(guild, "wagerin"))
+            events.append(lambda payload=payload: self.bot.on_raw_reaction_add(payload))
+        return events
+
+    # both sides of each accepted wager vote: the creator reacts :wagerwin:, the taker :wagerlose:
+    def settle_events(self):
+        events = []
+        for wager, guild, channel in self.find_wagers(True):
+            message = channel.messages[wager.message_id]
+            for user_id, emoji_name in [(wager.creator_id, "wagerwin"), (wager.taker_id, "wagerlose")]:
+                payload = self.fake.reaction_payload(message, user_id, self.emoji(guild, emoji_name))
+                events.append(lambda payload=payload: self.bot.on_raw_reaction_add(payload))
+        return events
+
+    # members list their wagers
+    def list_events(self):
+        events = []
+        for _ in range(self.args.events):
+            guild, channel, members = self.random.choice(self.guilds)
+            ctx = self.fake_context(self.random.choice(members), channel, "!wagers")
+            events.append(lambda ctx=ctx: self.bot.list_wagers.callback(ctx))
+        return events
+
+    # the creators of the remaining open wagers leave their guilds
+    def member_remove_events(self):
+        events = []
+        leaving = {(guild.id, wager.creator_id): guild for wager, guild, channel in self.find_wagers(False)}
+        for (guild_id, user_id), guild in leaving.items():
+            member = guild.members.pop(user_id)
+            events.append(lambda member=member: self.bot.on_member_remove(member))
+        return events
+
+    def fake_context(self, author, channel, content):
+        return wager_fakes.FakeContext(self.fake, author, channel, content)
+
+    # many handlers try to settle the same wager at once; exactly one may pay out
+    async def contention(self):
+        wager_db = self.bot.wager_db
+        guild, channel, members = self.guilds[0]
+        creator, taker = members[0], members[1]
+        ctx = self.fake_context(creator, channel, "!wager 7 contended")
+        await self.bot.create_wager.callback(ctx, 7, wager_text="contended")
+        wager = [wager for wager, wager_guild, wager_channel in self.find_wagers(False) if wager.creator_id == creator.id][-1]
+        await self.bot.accept_wager(wager, taker.id)
+        before, _ = await wager_db.run(wager_db.get_money_summary, guild.id, creator.id)
+        copies = [await wager_db.run(wager_db.find_wager_by_message, wager.message_id, True) for _ in range(self.args.contenders)]
+        result = await self.measure("contention", [lambda copy=copy: self.bot.resolve_winner(copy, creator.id) for copy in copies])
+        after, _ = await wager_db.run(wager_db.get_money_summary, guild.id, creator.id)
+        result["payouts"] = (after - before) // wager.amount
+        if result["payouts"] != 1:
+            print(f"contention: expected exactly one payout, got {result['payouts']}")
+        return result
+
+    # the same race through the gateway handlers: many members react :wagerin: to one open wager at once, then its creator's
+    # :wagerwin: and every one of those members' :wagerlose: (plus redelivered copies) arrive together; the per-wager lock must
+    # let exactly one member take it, and settle it exactly once
+    async def reaction_race(self):
+        wager_db = self.bot.wager_db
+        models = self.bot.wager_models
+        guild, channel, members = self.guilds[-1]
+        creator, *racers = list(guild.members.values())[:self.args.contenders + 1]
+        ctx = self.fake_context(creator, channel, "!wager 7 raced")
+        await self.bot.create_wager.callback(ctx, 7, wager_text="raced")
+        wager = [wager for wager, wager_guild, wager_channel in self.find_wagers(False) if wager.creator_id == creator.id][-1]
+        message = channel.messages[wager.message_id]
+        before = dict((user_id, money) for guild_id, user_id, money, *rest in await wager_db.run(wager_db.find_standings, {guild.id}))
+        payloads = [self.fake.reaction_payload(message, racer.id, self.emoji(guild, "wagerin")) for racer in racers]
+        votes = [self.fake.reaction_payload(message, creator.id, self.emoji(guild, "wagerwin")) for _ in racers] + \
+            [self.fake.reaction_payload(message, racer.id, self.emoji(guild, "wagerlose")) for racer in racers]
+        self.random.shuffle(votes)
+        result = await self.measure("reaction_race", [lambda payload=payload: self.bot.on_raw_reaction_add(payload)
+            for payload in payloads + votes])
+        def settlement(session):
+            settled = session.query(models.Wager).filter_by(id=wager.id).one()
+            payouts = session.query(models.LedgerEntry).filter_by(wager_id=wager.id, kind="win").count()
+            return settled.taker_id, settled.completed, payouts
+        taker_id, completed, result["payouts"] = await wager_db.run(settlement)
+        after = dict((user_id, money) for guild_id, user_id, money, *rest in await wager_db.run(wager_db.find_standings, {guild.id}))
+        moved = {user_id: after[user_id] - money for user_id, money in before.items() if after[user_id] != money}
+        expected = {creator.id: wager.amount, taker_id: -wager.amount}
+        if not completed or result["payouts"] != 1 or moved != expected or await wager_db.run(wager_db.find_escrow_drift):
+            print(f"reaction_race: expected one taker and one payout, got {result['payouts']} payout(s) and balance changes {moved}")
+        return result
+
+    async def run(self):
+        await self.seed()
+        results = {}
+        results["create_wager"] = await self.measure("create_wager", self.create_events())
+        results["accept_wager"] = await self.measure("accept_wager", self.accept_events())
+        results["settle"] = await self.measure("settle", self.settle_events())
+        results["list_wagers"] = await self.measure("list_wagers", self.list_events())
+        results["member_remove"] = await self.measure("member_remove", self.member_remove_events())
+        results["contention"] = await self.contention()
+        results["reaction_race"] = await self.reaction_race()
+        return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the wager bot's handlers against a fake discord")
+    parser.add_argument("--guilds", type=int, default=5, help="fake guilds to seed")
+    parser.add_argument("--members", type=int, default=200, help="members (with accounts) per guild")
+    parser.add_argument("--history", type=int, default=2000, help="completed wagers to seed per guild")
+    parser.add_argument("--events", type=int, default=500, help="commands to run in the create and list scenarios")
+    parser.add_argument("--concurrency", type=int, default=20, help="how many events can be handled at once")
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated seconds per REST call")
+    parser.add_argument("--rate-limit", type=float, default=0.01, help="chance a REST call is rate limited")
+    parser.add_argument("--contenders", type=int, default=300, help="concurrent settlements of one wager in the contention scenario (and members racing to take and settle one in the reaction_race scenario)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed")
+    parser.add_argument("--output", default="bench_results.json", help="where to write the JSON results")
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+
+    with tempfile.TemporaryDirectory(prefix="wager-bench-") as workdir:
+        bot = load_bot(workdir)
+        fake = wager_fakes.FakeDiscord(latency=args.latency, rate_limit_chance=args.rate_limit, seed=args.seed)
+        fake.install(bot.bot)
+        results = asyncio.run(Bench(bot, fake, args).run())
+        bot.wager_db.db_executor.shutdown()
+        bot.wager_models.engine.dispose()
+
+    with open(output, "w") as results_file:
+        json.dump({
+            "commit": current_commit(),
+            "run_at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "config": vars(args),
+            "scenarios": results,
+        }, results_file, indent=2)
+    print(f"Results written to {output}")
+
+if __name__ == "__main__":
+    main()
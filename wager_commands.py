@@ -1,12 +1,26 @@
 import discord
 import logging
+import logging.handlers
 import os
+import queue
 import wager_models
+import wager_db
+import wager_cache
+import wager_scheduler
+import wager_locks
+import wager_dispatch
+import wager_ledger
+import wager_record
+import wager_metrics
+import wager_expiry
+import wager_export
+import wager_names
 import asyncio
-import schedule
+import contextlib
+import datetime
 from dotenv import load_dotenv
 from discord.ext import commands
-from wager_models import Wager, User, Emoji, session
+from wager_models import Wager, Pool
 
 # load our .env file and retrieve token, text, emoji ID's
 load_dotenv()
@@ -20,12 +34,46 @@ APP_ENV = os.getenv("APP_ENV")
 STARTING_MONEY = int(os.getenv("STARTING_MONEY"))
 WEEKLY_MONEY = int(os.getenv("WEEKLY_MONEY"))
 
+# sharding: SHARD_COUNT is the total number of shards across every bot process (leave unset to use discord's recommendation),
+# SHARD_IDS is the comma-separated list of shards this process runs (leave unset to run them all) - see wager_launcher.py
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+# discord delivers DMs (and reactions in them) to shard 0, so only the process running it hears back from the DMs we send;
+# commands that change a guild's wagers are guild-only, so they always run in the process that owns the guild
+HANDLES_DMS = SHARD_IDS is None or 0 in SHARD_IDS
+
+# set EVENT_LOG to a file path to record the gateway events we handle, for replaying with wager_replay.py (single process only)
+EVENT_LOG = os.getenv("EVENT_LOG")
+# how long a wager can sit open without a taker, or accepted without being settled, before it expires (hours; 0 = never)
+WAGER_OPEN_TTL_HOURS = float(os.getenv("WAGER_OPEN_TTL_HOURS", "168"))
+WAGER_ACCEPTED_TTL_HOURS = float(os.getenv("WAGER_ACCEPTED_TTL_HOURS", "720"))
+# how long a pool can go unsettled before it expires and every stake is refunded (hours; 0 = never)
+POOL_TTL_HOURS = float(os.getenv("POOL_TTL_HOURS", "720"))
+# move completed wagers into the archive table once they've been settled this many days (0 = keep them in the wager table)
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "90"))
+# how many wagers to archive per transaction
+ARCHIVE_BATCH_SIZE = 500
+
+# set METRICS_PORT to serve Prometheus metrics on METRICS_HOST:METRICS_PORT (wager_launcher.py gives each worker its own port)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT")) if os.getenv("METRICS_PORT") else None
+# MEMBER_CACHE=slim stops discord.py caching every member of every guild (names are looked up on demand instead; see wager_names.py)
+SLIM_MEMBER_CACHE = os.getenv("MEMBER_CACHE", "full").lower() == "slim"
+
 # set up logging to output to a file with formatted lines
+# handlers only put records on a queue; a listener thread formats them and writes the file, so logging never blocks the event loop
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.getenv("LOG_LEVEL", "DEBUG").upper())
 handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
 handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+log_queue = queue.SimpleQueue()
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+log_listener = logging.handlers.QueueListener(log_queue, handler)
+log_listener.start()
+
+# handler latency, DB queries, REST calls and cache hit rates (see wager_metrics.py)
+metrics = wager_metrics.Metrics()
+metrics.instrument_engine(wager_models.engine)
 
 # bot config
 bot_intents = discord.Intents(
@@ -38,97 +86,184 @@ bot_intents = discord.Intents(
     reactions=True, 
     dm_reactions=True)
 
-bot = commands.Bot(intents=bot_intents, command_prefix='!')
+# time every command invocation (argument conversion and checks included) and count the DB queries it makes
+class WagerBot(commands.AutoShardedBot):
+    async def invoke(self, ctx):
+        with metrics.track("command", ctx.command.qualified_name if ctx.command else "unknown") as usage:
+            await super().invoke(ctx)
+            usage.failed = ctx.command_failed
+
+if SLIM_MEMBER_CACHE:
+    bot = WagerBot(intents=bot_intents, command_prefix='!', shard_count=SHARD_COUNT, shard_ids=SHARD_IDS,
+        member_cache_flags=discord.MemberCacheFlags.none(), chunk_guilds_at_startup=False)
+else:
+    bot = WagerBot(intents=bot_intents, command_prefix='!', shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+metrics.instrument_http(bot.http)
+
+# the custom emojis every guild needs, and our cache of their IDs
+REQUIRED_EMOJIS = ["wagerin", "wagerwin", "wagerlose"]
+emoji_cache = wager_cache.EmojiCache()
+emoji_images = {} # emoji name -> PNG bytes
+emoji_locks = wager_locks.KeyedLock() # one emoji check per guild at a time
+# how many emoji uploads can be in flight at once when checking every guild at startup
+EMOJI_UPLOAD_CONCURRENCY = 8
+
+# index of messages that hold an open or accepted wager (or an open pool), so reactions on anything else are dropped straight away
+wager_index = wager_cache.WagerIndex()
+
+# per-wager locks keyed by message ID, so events for one wager never interleave (e.g. two win reactions settling it twice)
+wager_event_locks = wager_locks.KeyedLock()
+
+# outbound discord calls (edits, reactions, DMs) are queued here and delivered after our DB changes are committed
+dispatcher = wager_dispatch.Dispatcher(bot)
+
+# !wagers pages: how many wagers to fetch per page, discord's message length limit, our navigation reactions,
+# and the pages we've sent (so reacting to one can move it along)
+WAGER_PAGE_SIZE = 10
+MESSAGE_LIMIT = 2000
+PREV_PAGE = '\u2B05\uFE0F'
+NEXT_PAGE = '\u27A1\uFE0F'
+WAGER_STATUS_FILTERS = ["open", "accepted", "completed"]
+wager_pages = wager_cache.PageIndex()
+
+# pool wagers: the reactions that back each of a pool's outcomes (so this is the most outcomes a pool can have), and what
+# separates a pool's description and outcomes in !pool
+POOL_OUTCOME_EMOJIS = [f"{number}\uFE0F\u20E3" for number in range(1, 10)]
+POOL_SEPARATOR = "|"
+POOL_FORMAT_TEXT = "Sorry, I didn't understand your pool! Correct format for pools is:\n> !pool **amount** *description* | *outcome* | *outcome* ...\nExample:\n> !pool **10** *who wins tonight?* | *Red* | *Blue* | *Draw*\n- **amount** is what each entry stakes, as a whole number written in numerical digits\n- a pool needs between 2 and 9 outcomes, separated by `|`"
+
+# catching up on reactions after downtime: how many wager messages to fetch at once, how many of a guild's wagers to do between
+# checkpoints, and how long an unfinished pass can be resumed from its checkpoint rather than started over
+RECONCILE_CONCURRENCY = 5
+RECONCILE_CHECKPOINT_EVERY = 20
+RECONCILE_RESUME_WITHIN = datetime.timedelta(minutes=30)
+catch_up_lock = asyncio.Lock()
+
+# display names, resolved in batches and kept in a bounded LRU (see wager_names.py)
+name_cache = wager_cache.NameCache()
+name_resolver = wager_names.NameResolver(bot, name_cache)
+
+# in-memory standings for !leaderboard, and how many users to show per page
+leaderboards = wager_cache.Leaderboards()
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_NAMES = {wager_cache.BALANCE: "Richest", wager_cache.NET: "Biggest winners", wager_cache.WIN_RATE: "Best win rate"}
+
+metrics.add_cache("emoji", emoji_cache)
+metrics.add_cache("wager_index", wager_index)
+metrics.add_cache("wager_pages", wager_pages)
+metrics.add_cache("names", name_cache)
+metrics.add_gauge("wager_active_wagers", "Open and accepted wagers (and open pools) in the wager index", lambda: len(wager_index.states))
+metrics.add_counter("wager_db_batches_total", "Batches of DB work run by the group committer (one commit each)", lambda: wager_db.committer.batches)
+metrics.add_counter("wager_db_units_total", "Units of DB work run by the group committer", lambda: wager_db.committer.units)
+metrics.add_gauge("wager_expiry_deadlines", "Wager expiry deadlines being tracked by the sweeper", lambda: len(sweeper.deadlines))
+metrics.add_gauge("wager_pool_expiry_deadlines", "Pool expiry deadlines being tracked by the sweeper", lambda: len(pool_sweeper.deadlines))
+metrics.add_gauge("wager_dispatch_queue_depth", "Outbound discord calls waiting to be delivered",
+    lambda: dispatcher.queue.qsize() if dispatcher.queue is not None else 0)
 
 # TODO: randomize phrase for money each time it's mentioned
 
-# add the weekly money allotment to each user's balance
-def distribute_money_recurring():
-    for user in session.query(User).all():
-        user.add_money(WEEKLY_MONEY)
-        session.add(user)
-    session.commit()
-
-schedule.every().friday.at("18:00").do(distribute_money_recurring)
-
-# check to make sure the reactions are present in the DB *and* those ID's are present in the guild; add if necessary
-async def validate_emojis(required_emojis, guild_id):
-    for required_emoji in required_emojis:
-        # find this emoji in the DB
-        emoji = session.query(Emoji).filter(Emoji.name == required_emoji).one_or_none()
-        if not emoji: # if it's not in our database, look for it in list of emojis and add to DB, or create a new one
-            emoji_id = check_existing_emoji(required_emoji, guild_id) # see if it exists on the server already and get its ID
-            if not emoji_id:
-                emoji_id = await add_emoji(required_emoji, guild_id) # if it's not already in the server, create it
-            emoji = Emoji(emoji_id, guild_id, required_emoji)
-            session.add(emoji, guild_id)
-        else: # if it is in our database, check to make sure it actually exists in the guild
-            emoji_id = check_existing_emoji(required_emoji, guild_id)
-            if not emoji_id: # if the emoji doesn't exist on the server, create a new one
-                session.delete(emoji) # remove the incorrect entry in the DB
-                emoji_id = await add_emoji(required_emoji, guild_id) # create a new one
-                emoji = Emoji(emoji_id, guild_id, required_emoji)
-                session.add(emoji, guild_id)
-            elif not emoji_id == emoji.id: # if the emoji in the DB doesn't have the same ID as the emoji on the server, update the DB with server info
-                session.delete(emoji) # remove the incorrect entry in the DB
-                emoji = Emoji(emoji_id, guild_id, required_emoji) # add the existing emoji to the DB
-                session.add(emoji, guild_id)
-    session.commit()
-            
-
-# check the indicated guild for a required emoji; if found, return its ID
-def check_existing_emoji(required_emoji, guild_id):
-    guild = bot.get_guild(guild_id)
-    emojis = guild.emojis
-    for emoji in emojis:
-        if emoji.name == required_emoji:
-            return emoji.id
-    return None
-
-# add our custom emojis to the guild (use dev emoji if dev environment)
-async def add_emoji(emoji, guild_id):
-    if APP_ENV == "dev":
-        path = "dev_emoji/"
-    else:
-        path = ""
+# add the weekly money allotment to each user's balance (runs on the DB thread as a scheduled job)
+def distribute_money_recurring(session):
+    wager_db.add_money_to_all(session, WEEKLY_MONEY)
+
+scheduler = wager_scheduler.Scheduler()
+scheduler.every_week("weekly_money", 4, datetime.time(18, 0), distribute_money_recurring, # fridays at 18:00
+    on_run=lambda: leaderboards.add_to_all(WEEKLY_MONEY))
+scheduler.every_day("balance_snapshot", datetime.time(0, 0), wager_ledger.take_snapshots) # so balance lookups only scan a day of ledger
+
+# archive a batch of old completed wagers; returns True if there may be more (so the scheduler runs another batch)
+def archive_completed_wagers(session):
+    completed_before = datetime.datetime.now() - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)
+    return wager_db.archive_wagers(session, completed_before, ARCHIVE_BATCH_SIZE) == ARCHIVE_BATCH_SIZE
+
+if ARCHIVE_AFTER_DAYS > 0:
+    scheduler.every_day("archive_wagers", datetime.time(3, 0), archive_completed_wagers) # keep the wager table to recent wagers
+
+# expire wagers nobody took or settled in time (see wager_expiry.py), announcing them like canceled ones
+sweeper = wager_expiry.ExpirySweeper(
+    datetime.timedelta(hours=WAGER_OPEN_TTL_HOURS) if WAGER_OPEN_TTL_HOURS > 0 else None,
+    datetime.timedelta(hours=WAGER_ACCEPTED_TTL_HOURS) if WAGER_ACCEPTED_TTL_HOURS > 0 else None,
+    lambda wagers: announce_canceled_wagers(wagers, "Expired"),
+    wager_event_locks,
+)
+# and pools nobody settled in time, refunding their stakes like canceled ones
+pool_sweeper = wager_expiry.PoolExpirySweeper(
+    datetime.timedelta(hours=POOL_TTL_HOURS) if POOL_TTL_HOURS > 0 else None,
+    lambda pools: announce_canceled_pools(pools, "Expired"),
+)
+
+# make sure a guild has each of our emojis, and that the DB and emoji cache know their current IDs
+# the emoji cache (loaded from the DB in one query at startup) is diffed against the guild's emojis by name; missing emojis
+# are uploaded concurrently (at most upload_limit at a time, shared across every guild being checked) and any changed IDs
+# are stored with one DB call
+async def validate_emojis(required_emojis, guild_id, upload_limit=None):
     guild = bot.get_guild(guild_id)
-    with open(f"{path}{emoji}.png", "rb") as image:
-        emoji = await guild.create_custom_emoji(name=emoji, image=image.read())
-        return emoji.id
+    if guild is None: # we've left the guild
+        return
+    async with emoji_locks.hold(guild_id): # so two checks of one guild can't both upload the same emoji
+        on_server = {}
+        for emoji in guild.emojis:
+            on_server.setdefault(emoji.name, emoji.id)
+        changed = []
+        async def check(name):
+            emoji_id = on_server.get(name)
+            if emoji_id is None: # it's not on the server, so create it
+                emoji_id = await add_emoji(name, guild, upload_limit)
+                if emoji_id is None:
+                    return
+            if emoji_id != emoji_cache.get(guild_id, name): # new, or the DB has a stale ID for it
+                changed.append((guild_id, name, emoji_id))
+        await asyncio.gather(*[check(name) for name in required_emojis])
+        if changed:
+            await wager_db.run(wager_db.replace_emojis, changed)
+            for guild_id, name, emoji_id in changed:
+                emoji_cache.set(guild_id, name, emoji_id) # keep our cache in line with what's in the guild
 
-# get an emoji ID by name; creates a new emoji or updates database if not present
-async def find_or_create_emoji(emoji_name, guild_id):
-    emoji = session.query(Emoji).filter(Emoji.name == emoji_name, Emoji.guild_id == guild_id).one_or_none()
-    if not emoji:
-        validate_emojis(emoji_name, guild_id)
-        emoji = session.query(Emoji).filter(Emoji.name == emoji_name, Emoji.guild_id == guild_id).one_or_none()
-    return emoji.id
+# the PNG for one of our emojis (dev emoji in the dev environment), read from disk the first time it's needed
+def emoji_image(name):
+    if name not in emoji_images:
+        path = "dev_emoji/" if APP_ENV == "dev" else ""
+        with open(f"{path}{name}.png", "rb") as image:
+            emoji_images[name] = image.read()
+    return emoji_images[name]
 
-# find a user in our wager DB using their ID; creates a new user if not found
-async def find_or_create_user(user_id):
-    # TODO: how to handle a user in multiple servers?
-    discord_user = bot.get_user(user_id)
-    wager_user = session.query(User).filter_by(id=user_id).one_or_none()
-    if wager_user is None: # the user doesn't exist yet
+# add one of our custom emojis to a guild; returns its ID, or None if discord wouldn't let us (e.g. no permission, or no free slots)
+async def add_emoji(name, guild, upload_limit=None):
+    async with upload_limit or contextlib.nullcontext():
         try:
-            wager_user = User(user_id, STARTING_MONEY) # create the new user
-            session.add(wager_user)
-            session.commit()
-            await discord_user.send(WELCOME_TEXT)
-        except: #error creating user
-            await discord_user.send(f"Error creating user {discord_user.mention}!")
-            return
+            emoji = await guild.create_custom_emoji(name=name, image=emoji_image(name))
+        except discord.HTTPException:
+            logger.exception(f"Couldn't create the {name} emoji in guild {guild.id}")
+            return None
+    return emoji.id
+
+# get an emoji ID by name from the cache; creates a new emoji or updates database if not present
+async def find_or_create_emoji(emoji_name, guild_id):
+    emoji_id = emoji_cache.get(guild_id, emoji_name)
+    if not emoji_id:
+        await validate_emojis([emoji_name], guild_id)
+        emoji_id = emoji_cache.get(guild_id, emoji_name)
+    return emoji_id
+
+# find a user's account for a guild in our wager DB using their ID; creates a new account if not found
+async def find_or_create_user(guild_id, user_id):
+    try:
+        wager_user, created = await wager_db.run(wager_db.find_or_create_user, guild_id, user_id, STARTING_MONEY) # create the new user if they don't exist yet
+    except: #error creating user
+        dispatcher.send_dm(user_id, f"Error creating user <@{user_id}>!")
+        return
+    if created:
+        leaderboards.add_user(guild_id, user_id, wager_user.money)
+        dispatcher.send_dm(user_id, WELCOME_TEXT)
     return wager_user
 
 # accept a wager and send/edit related messages
 async def accept_wager(wager, user_id):
-    # get the discord objects for the channel, user, and message; generate a link to the message
+    # get the discord objects for the channel and user; generate a link to the message
     wager_channel = bot.get_channel(wager.channel_id)
-    accepting_user = bot.get_user(user_id)
-    if accepting_user.bot: # we're a bot; ignore
+    accepting_user = bot.get_user(user_id) # may not be cached (e.g. with MEMBER_CACHE=slim)
+    if accepting_user is not None and accepting_user.bot: # we're a bot; ignore
         return
-    wager_creator_user = bot.get_user(wager.creator_id)
-    reacted_message = await wager_channel.fetch_message(wager.message_id)
     message_url = get_wager_link(wager)
 
     # get the emojis we'll use
@@ -138,164 +273,426 @@ async def accept_wager(wager, user_id):
 
     try:
         # get/create the user accepting the wager from the DB
-        acceptor = await find_or_create_user(user_id)
+        acceptor = await find_or_create_user(wager.guild_id, user_id)
     except: # error finding user
-        await wager_channel.send(f"{accepting_user.mention}: Sorry, an unknown error occurred when retrieving your user information!")
+        await wager_channel.send(f"<@{user_id}>: Sorry, an unknown error occurred when retrieving your user information!")
         return
     
     # can't accept your own wager
     if wager.creator_id == user_id:
-        await reacted_message.remove_reaction(in_emoji, accepting_user) # remove the offending reaction
-        await accepting_user.send(f"You can't accept your own wager - your :wagerin: reaction has been removed")
+        dispatcher.remove_reaction(wager.channel_id, wager.message_id, in_emoji, user_id) # remove the offending reaction
+        dispatcher.send_dm(user_id, f"You can't accept your own wager - your :wagerin: reaction has been removed")
         return
 
     # make sure nerds dont try anything fishy
     if wager.amount < 1:
-        await accepting_user.send(f"{wager.amount}?! Thats not a real bet!")
+        dispatcher.send_dm(user_id, f"{wager.amount}?! Thats not a real bet!")
         return
 
-    # make sure we can afford the wager
-    if not acceptor.can_afford(wager.amount):
-        await reacted_message.remove_reaction(in_emoji, accepting_user) # remove the reaction, since we can't afford
+    # update the DB with the info on taker, as long as the wager is still open and we can afford it
+    accepted = await wager_db.run(wager_db.accept_wager, wager.id, acceptor.id)
+    if accepted is None: # someone else got there first, or it was canceled
+        return
+    if not accepted:
+        dispatcher.remove_reaction(wager.channel_id, wager.message_id, in_emoji, user_id) # remove the reaction, since we can't afford
         # get our money totals to send to the user in DM
-        total_money = acceptor.money
-        outstanding_money = acceptor.outstanding_money()
+        total_money, outstanding_money = await wager_db.run(wager_db.get_money_summary, wager.guild_id, acceptor.id)
         available_money = total_money - outstanding_money
-        await accepting_user.send(f"You don't have enough moolah to take that wager! \U0001F4B8\n**Description:** {wager.description}\n**Amount:** {wager.amount}\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {available_money} doubloons available!")
+        dispatcher.send_dm(user_id, f"You don't have enough moolah to take that wager! \U0001F4B8\n**Description:** {wager.description}\n**Amount:** {wager.amount}\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {available_money} doubloons available!")
         return
-
-    # update the DB with the info on taker
     wager.accept(acceptor.id)
+    wager_index.set(wager.message_id, wager_cache.ACCEPTED)
+    sweeper.add(wager) # it has a new deadline to be settled by
+    await resolve_wager_names([wager])
 
     # edit the wager creation message with new text on how to win/lose the wager
-    await reacted_message.edit(content=f"{wager_creator_user.display_name} wagered {wager.amount} - condition: **{wager.description}**.\n{accepting_user.display_name} accepted - winner react to **this** message with `:wagerwin:` ({str(win_emoji)}) and loser react with `:wagerlose:` ({str(lose_emoji)})")
+    dispatcher.edit_message(wager.channel_id, wager.message_id, wager_message_content(wager))
 
     # pre-populate the emoji's that users can respond with
-    await reacted_message.add_reaction(win_emoji)
-    await reacted_message.add_reaction(lose_emoji)
+    dispatcher.add_reaction(wager.channel_id, wager.message_id, win_emoji)
+    dispatcher.add_reaction(wager.channel_id, wager.message_id, lose_emoji)
 
     # send DM's to creator and acceptor
-    await accepting_user.send(f"You've accepted a wager from {wager_creator_user.display_name} for {wager.amount}.\nCondition: {wager.description}\n{message_url}")
-    await wager_creator_user.send(f"{accepting_user.display_name} accepted your wager!\n{message_url}")
+    dispatcher.send_dm(user_id, f"You've accepted a wager from {display_name(wager.creator_id, wager.guild_id)} for {wager.amount}.\nCondition: {wager.description}\n{message_url}")
+    dispatcher.send_dm(wager.creator_id, f"{display_name(user_id, wager.guild_id)} accepted your wager!\n{message_url}")
 
-async def cancel_wager(wager_id, user_id):
-    wager = session.query(Wager).filter(Wager.id == wager_id, Wager.completed == False, Wager.creator_id == user_id).one_or_none()
-    user = bot.get_user(user_id)
-    if wager is None and user:
-        await user.send(f"No outstanding wager with an ID of {wager_id} found")
-    else:
-        # get a discord object for the channel/message/guild of the wager
-        wager_guild = bot.get_guild(wager.guild_id)
-        wager_channel = bot.get_channel(wager.channel_id)
-        wager_message = await wager_channel.fetch_message(wager.message_id)
-        # cross that message out
-        new_content = f"~~{wager_message.content}~~"
-        await wager_message.edit(content=new_content)
-        # delete from DB
-        session.delete(wager)
-        if user and wager_guild.get_member(user_id): # check to make sure they're still a member before messaging
-            await user.send(f"Canceled bet with ID {wager_id}")
-        session.commit()
-
-# check the wager's message for completion - i.e. there is exactly one win emoji from the wager's creator/taker, and exactly one lose emoji from the other. returns winner_id if valid
-async def check_for_winner(wager):
-    # initialize our winner/lose id's
-    winner_id = None
-    loser_id = None
+# cancel a set of a user's outstanding wagers in one go (in one guild, or from a DM in whichever guilds they're in), letting
+# them know about any IDs we couldn't cancel
+# wager IDs are global, so a DM'd cancel finds each wager's guild from the wager itself; wagers in guilds another process runs
+# are left for that process (we couldn't edit their messages or update its caches), and the user is pointed to their server
+# the wagers' locks are held while they're canceled and announced, so an accept or settlement that's under way finishes first
+# (rather than, say, editing an accepted message over the strike-through once the wager is gone)
+async def cancel_wagers(wager_ids, user_id, guild_id=None):
+    wagers = await wager_db.run(wager_db.find_incomplete_wagers_by_id, wager_ids, user_id, guild_id)
+    elsewhere = [wager for wager in wagers if bot.get_guild(wager.guild_id) is None]
+    wagers = [wager for wager in wagers if wager not in elsewhere]
+    async with wager_event_locks.hold_all([wager.message_id for wager in wagers]):
+        canceled_wagers = await wager_db.run(wager_db.cancel_wagers, [wager.id for wager in wagers], user_id, guild_id)
+        await announce_canceled_wagers(canceled_wagers)
+    for wager in elsewhere:
+        dispatcher.send_dm(user_id, f"Bet with ID {wager.id} can only be canceled from its server - use `!cancel {wager.id}` there.\n{get_wager_link(wager)}")
+    found_ids = [wager.id for wager in canceled_wagers + elsewhere]
+    missing_ids = [str(wager_id) for wager_id in wager_ids if wager_id not in found_ids]
+    if missing_ids:
+        dispatcher.send_dm(user_id, f"No outstanding wager with an ID of {', '.join(missing_ids)} found")
 
+# strike out the messages of wagers we've just canceled or expired (the edits go out concurrently) and let their creators know
+# (call this with the wagers' locks held, as they were canceled)
+async def announce_canceled_wagers(wagers, verb="Canceled"):
+    await resolve_wager_names(wagers)
+    canceled_ids = {} # creator_id -> [(guild_id, wager_id)]
+    for wager in wagers:
+        wager_index.remove(wager.message_id)
+        dispatcher.edit_message(wager.channel_id, wager.message_id, f"~~{wager_message_content(wager)}~~")
+        canceled_ids.setdefault(wager.creator_id, []).append((wager.guild_id, wager.id))
+    for creator_id, creator_wagers in canceled_ids.items():
+        # check to make sure they're still a member before messaging
+        wager_ids = [str(wager_id) for guild_id, wager_id in creator_wagers if name_resolver.cached(guild_id, creator_id)]
+        if wager_ids:
+            dispatcher.send_dm(creator_id, f"{verb} bet with ID {', '.join(wager_ids)}")
+
+# check the wager's recorded votes for completion - i.e. there is exactly one win vote from the wager's creator/taker, and exactly one lose vote from the other. returns winner_id if valid
+# votes are (user_id, emoji_name) pairs tracked from reaction events, so this only talks to discord when reactions need cleaning up
+async def check_for_winner(wager, votes):
     # get the emojis we'll use
     win_emoji = bot.get_emoji(await find_or_create_emoji("wagerwin", wager.guild_id))
     lose_emoji = bot.get_emoji(await find_or_create_emoji("wagerlose", wager.guild_id))
 
-    # get a discord object for the channel/message of the wager
-    wager_channel = bot.get_channel(wager.channel_id)
-    wager_message = await wager_channel.fetch_message(wager.message_id)
-
-    # make a list of the users involved in the wager
-    wager_user_ids = [wager.creator_id, wager.taker_id]
-
-    # get a list of all the reactions on the wager
-    reactions = wager_message.reactions
-
-    # get a list of users who have used the :wagerwin: reaction
-    win_users_iter = [reaction.users() for reaction in reactions if reaction.custom_emoji and reaction.emoji.id == await find_or_create_emoji("wagerwin", wager.guild_id)]
-    if win_users_iter:
-        win_users_list = await win_users_iter[0].flatten()
-
-        # filter that list down to only the ID's of the users we care about (creator/taker)
-        proposed_winner_ids = [user.id for user in win_users_list if user.id in wager_user_ids]
+    # get the ID's of our bettors who have voted each way
+    proposed_winner_ids = [user_id for user_id, emoji_name in votes if emoji_name == "wagerwin"]
+    proposed_loser_ids = [user_id for user_id, emoji_name in votes if emoji_name == "wagerlose"]
 
-        # if more than one of our bettors has reacted with :wagerwin:, clear both and ignore; if exactly one has reacted, mark them winner
-        if len(proposed_winner_ids) > 1:
-            await wager_message.clear_reaction(win_emoji)
-            return
-        elif len(proposed_winner_ids) == 1:
-            winner_id = proposed_winner_ids[0]
-
-    # get a list of users who have used the :wagerlose: reaction
-    lose_users_iter = [reaction.users() for reaction in reactions if reaction.custom_emoji and reaction.emoji.id == await find_or_create_emoji("wagerlose", wager.guild_id)]
-    if lose_users_iter:
-        lose_users_list = await lose_users_iter[0].flatten()
-
-        # filter that list down to only the ID's of the users we care about (creator / taker)
-        proposed_loser_ids = [user.id for user in lose_users_list if user.id in wager_user_ids]
-
-        # if more than one of our bettors has reacted with :wagerlose:, clear both and ignore; if exactly one has reacted, mark them loser
-        if len(proposed_loser_ids) > 1:
-            await wager_message.clear_reaction(lose_emoji)
-            return
-        elif len(proposed_loser_ids) == 1:
-            loser_id = proposed_loser_ids[0]
+    # if more than one of our bettors has reacted with :wagerwin: or :wagerlose:, clear that reaction and ignore
+    if len(proposed_winner_ids) > 1:
+        await wager_db.run(wager_db.clear_votes, wager.id, "wagerwin")
+        dispatcher.clear_reaction(wager.channel_id, wager.message_id, win_emoji)
+        return
+    if len(proposed_loser_ids) > 1:
+        await wager_db.run(wager_db.clear_votes, wager.id, "wagerlose")
+        dispatcher.clear_reaction(wager.channel_id, wager.message_id, lose_emoji)
+        return
 
-    if winner_id and loser_id:
+    if proposed_winner_ids and proposed_loser_ids:
+        winner_id = proposed_winner_ids[0]
+        loser_id = proposed_loser_ids[0]
         if winner_id == loser_id: # you can't win and lose the same bet
-            await wager_message.remove_reaction(win_emoji, bot.get_user(winner_id))
-            await wager_message.remove_reaction(lose_emoji, bot.get_user(loser_id))
+            dispatcher.remove_reaction(wager.channel_id, wager.message_id, win_emoji, winner_id)
+            dispatcher.remove_reaction(wager.channel_id, wager.message_id, lose_emoji, loser_id)
             return
         # bet is complete!
         return winner_id
 
 # handle winning a bet (messaging, money transfer, DB update)
 async def resolve_winner(wager, winner_id):
-    # edit the original message
-    # get a discord object for the channel/message/users of the wager
-    wager_channel = bot.get_channel(wager.channel_id)
-    wager_message = await wager_channel.fetch_message(wager.message_id)
-    wager_creator_user = bot.get_user(wager.creator_id)
-    wager_taker_user = bot.get_user(wager.taker_id)
-    wager_winner_user = bot.get_user(winner_id)
-    message_url = f"https://discord.com/channels/{wager_message.guild.id}/{wager_message.channel.id}/{wager_message.id}"
+    message_url = get_wager_link(wager)
 
     # set the winner and loser based off the winner ID we got passed
     if wager.creator_id == winner_id:
-        wager_loser_user =  wager_taker_user
         loser_id = wager.taker_id
     else:
-        wager_loser_user = wager_creator_user
         loser_id = wager.creator_id
 
+    # update in database (record winner, transfer money); bail if someone else already completed it
+    if not await wager_db.run(wager_db.complete_wager, wager.id, winner_id, loser_id):
+        return
+    wager_index.remove(wager.message_id)
+    leaderboards.record_result(wager.guild_id, winner_id, loser_id, wager.amount)
+    wager.winner_id = winner_id
+    wager.loser_id = loser_id
+    wager.completed = True
+
     # edit the original message to reflect winner
-    await wager_message.edit(content=f"{wager_creator_user.display_name} wagered {wager.amount} - condition: **{wager.description}**.\n{wager_winner_user.display_name} won the wager against {wager_loser_user.display_name}!")
+    await resolve_wager_names([wager])
+    dispatcher.edit_message(wager.channel_id, wager.message_id, wager_message_content(wager))
 
     # send a DM to the participants
-    await wager_winner_user.send(f"You won your wager against {wager_loser_user.display_name}! You have received {wager.amount}.\n{message_url}")
-    await wager_loser_user.send(f"You lost your wager against {wager_winner_user.display_name}! You have lost {wager.amount}.\n{message_url}")
+    dispatcher.send_dm(winner_id, f"You won your wager against {display_name(loser_id, wager.guild_id)}! You have received {wager.amount}.\n{message_url}")
+    dispatcher.send_dm(loser_id, f"You lost your wager against {display_name(winner_id, wager.guild_id)}! You have lost {wager.amount}.\n{message_url}")
 
-    # update in database (record winner, transfer money)
-    wager.winner_id = winner_id
-    wager.loser_id = loser_id
-    wager.winner.add_money(wager.amount)
-    wager.loser.remove_money(wager.amount)
-    wager.completed = True
-    session.add(wager)
-    session.commit()
+# back one of a pool's outcomes when someone reacts with its number (or stop backing it when they take the reaction back)
+async def handle_pool_entry(payload, added):
+    emoji = str(payload.emoji)
+    if emoji not in POOL_OUTCOME_EMOJIS:
+        return
+    outcome = POOL_OUTCOME_EMOJIS.index(emoji)
+    async with wager_event_locks.hold(payload.message_id): # handle this pool's events one at a time
+        if wager_index.get(payload.message_id) != wager_cache.POOL: # it may have been settled or canceled while we waited
+            return
+        if not added:
+            result = await wager_db.run(wager_db.leave_pool, payload.message_id, payload.user_id, outcome)
+            if result is None: # they weren't backing that outcome (e.g. it's a reaction we removed)
+                return
+            pool, totals = result
+            await refresh_pool_message(pool, totals)
+            return
+        if await find_or_create_user(payload.guild_id, payload.user_id) is None:
+            return
+        result = await wager_db.run(wager_db.join_pool, payload.message_id, payload.user_id, outcome)
+        if result is None:
+            return
+        pool, backing, totals = result
+        if backing is None: # they can't afford the stake
+            dispatcher.remove_reaction(pool.channel_id, pool.message_id, emoji, payload.user_id)
+            await tell_short_of_stake(pool, payload.user_id)
+            return
+        if backing != outcome: # one outcome per user per pool
+            dispatcher.remove_reaction(pool.channel_id, pool.message_id, emoji, payload.user_id)
+            dispatcher.send_dm(payload.user_id, f"You're already backing {POOL_OUTCOME_EMOJIS[backing]} **{pool.outcome_names()[backing]}** in that pool - take that reaction back first if you want to switch.\n{get_wager_link(pool)}")
+            return
+        await refresh_pool_message(pool, totals)
+
+# let a user know they can't afford to join a pool
+async def tell_short_of_stake(pool, user_id):
+    total_money, outstanding_money = await wager_db.run(wager_db.get_money_summary, pool.guild_id, user_id)
+    dispatcher.send_dm(user_id, f"You don't have enough moolah to join that pool! \U0001F4B8\n**Description:** {pool.description}\n**Stake:** {pool.amount}\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {total_money - outstanding_money} doubloons available!")
+
+# show a pool's latest totals in its message
+async def refresh_pool_message(pool, totals):
+    await name_resolver.resolve(pool.guild_id, [pool.creator_id])
+    dispatcher.edit_message(pool.channel_id, pool.message_id, pool_message_content(pool, totals))
+
+# settle a pool a user created in a guild as won by one of its outcomes (numbered from 1), paying out the pot and letting every
+# entrant know how they did; their DMs go out as one bounded fan-out, however many there are
+async def settle_user_pool(pool_id, outcome, user_id, guild_id):
+    result = await wager_db.run(wager_db.settle_pool, pool_id, user_id, guild_id, outcome - 1)
+    if result is None:
+        dispatcher.send_dm(user_id, f"No open pool of yours in this server with an ID of {pool_id} and an outcome {outcome} found")
+        return
+    pool, results = result
+    async with wager_event_locks.hold(pool.message_id): # so an entry that was being handled can't overwrite the result
+        wager_index.remove(pool.message_id)
+        await refresh_pool_message(pool, tally_pool([(outcome, stake) for outcome, stake, net in results.values()]))
+    refunded = not any(net for outcome, stake, net in results.values()) # nobody backed the winner, or nobody backed anything else
+    if not refunded:
+        leaderboards.record_results(pool.guild_id,
+            [(user_id, net, outcome == pool.winning_outcome) for user_id, (outcome, stake, net) in results.items()])
+    message_url = get_wager_link(pool)
+    winning_name = pool.outcome_names()[pool.winning_outcome]
+    messages = []
+    for entrant_id, (outcome, stake, net) in results.items():
+        if refunded:
+            content = f"Pool #{pool.id} was settled as **{winning_name}**, but nobody backed against it, so your stake of {stake} has been returned."
+        elif outcome == pool.winning_outcome:
+            content = f"You won pool #{pool.id}! **{winning_name}** came in, paying you {stake + net} for your stake of {stake} (+{net})."
+        else:
+            content = f"You lost pool #{pool.id} - **{winning_name}** came in, so you've lost your stake of {stake}."
+        messages.append((entrant_id, f"{content}\n{message_url}"))
+    dispatcher.send_dms(messages)
+
+# strike out the messages of pools we've just canceled and let everyone who was in them know their stake is back
+async def announce_canceled_pools(canceled_pools, verb="Canceled"):
+    messages = []
+    for pool, entries in canceled_pools:
+        async with wager_event_locks.hold(pool.message_id):
+            wager_index.remove(pool.message_id)
+            await name_resolver.resolve(pool.guild_id, [pool.creator_id])
+            content = pool_message_content(pool, tally_pool([(entry.outcome, entry.amount) for entry in entries]))
+            dispatcher.edit_message(pool.channel_id, pool.message_id, f"~~{content}~~")
+        messages += [(entry.user_id, f"{verb} pool #{pool.id} ({pool.description}) - your stake of {entry.amount} has been returned")
+            for entry in entries]
+    dispatcher.send_dms(messages)
+
+# catch up on reactions we missed while offline, for every open and accepted wager and open pool in the given guilds (each
+# loaded in one query unless they're passed in)
+# each guild's wagers are reconciled in ID order, a chunk at a time, with at most RECONCILE_CONCURRENCY messages being fetched
+# at once across every guild (discord.py waits out any rate limits it hits); the last wager done is checkpointed in the DB
+# after each chunk, so if we restart partway through, the next pass carries on from there rather than starting over
+# pools share the fetch limit but aren't checkpointed: every pass checks them all (reconciling a pool twice changes nothing)
+async def catch_up(guild_ids, wagers=None, pools=None):
+    async with catch_up_lock: # one pass at a time, so passes don't trample each other's checkpoints
+        if wagers is None:
+            wagers = await wager_db.run(wager_db.find_incomplete_wagers, guild_ids)
+        if pools is None:
+            pools = await wager_db.run(wager_db.find_open_pools, guild_ids)
+        by_guild = {}
+        for wager in sorted(wagers, key=lambda wager: wager.id):
+            by_guild.setdefault(wager.guild_id, []).append(wager)
+        resume_after = {}
+        if by_guild:
+            resume_after = await wager_db.run(wager_db.start_reconcile_passes, list(by_guild), datetime.datetime.now(),
+                RECONCILE_RESUME_WITHIN)
+        limit = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+        await asyncio.gather(*[
+            catch_up_guild(guild_id, [wager for wager in guild_wagers if wager.id > resume_after[guild_id]], limit)
+            for guild_id, guild_wagers in by_guild.items()
+        ], *[catch_up_pool(pool, limit) for pool in pools])
+
+# reconcile one pool, counting against the fetch limit
+async def catch_up_pool(pool, limit):
+    async with limit:
+        try:
+            await reconcile_pool(pool)
+        except discord.HTTPException:
+            logger.exception(f"Couldn't catch up on pool {pool.id}")
+
+# reconcile one guild's wagers a chunk at a time, checkpointing after each chunk
+async def catch_up_guild(guild_id, wagers, limit):
+    async def reconcile(wager):
+        async with limit:
+            try:
+                await reconcile_wager(wager.message_id)
+            except discord.HTTPException:
+                logger.exception(f"Couldn't catch up on wager {wager.id}")
+    for start in range(0, len(wagers), RECONCILE_CHECKPOINT_EVERY):
+        chunk = wagers[start:start + RECONCILE_CHECKPOINT_EVERY]
+        await asyncio.gather(*[reconcile(wager) for wager in chunk])
+        finished = start + RECONCILE_CHECKPOINT_EVERY >= len(wagers)
+        await wager_db.run(wager_db.save_reconcile_checkpoint, guild_id, chunk[-1].id, finished, datetime.datetime.now())
+    if not wagers: # everything was done before we restarted
+        await wager_db.run(wager_db.save_reconcile_checkpoint, guild_id, None, True, datetime.datetime.now())
+
+# check a wager's message for reactions we missed: accept an open wager for the first member who reacted with :wagerin: and can
+# take it, or bring an accepted wager's win/lose votes in line with its reactions (settling it if they now agree)
+async def reconcile_wager(message_id):
+    async with wager_event_locks.hold(message_id):
+        wager_state = wager_index.get(message_id)
+        if wager_state is None: # settled, canceled or expired since the pass started
+            return
+        wager = await wager_db.run(wager_db.find_wager_by_message, message_id, wager_state == wager_cache.ACCEPTED)
+        if wager is None:
+            return
+        try:
+            wager_message = await bot.get_channel(wager.channel_id).fetch_message(wager.message_id)
+        except (AttributeError, discord.NotFound, discord.Forbidden): # channel or message is gone
+            return
+        if wager_state == wager_cache.OPEN:
+            await reconcile_acceptance(wager, wager_message)
+        else:
+            await reconcile_votes(wager, wager_message)
+
+# bring a pool's entries in line with the number reactions on its message: anyone whose reaction we missed joins (on the lowest
+# outcome they reacted with, if they reacted with more than one), and anyone whose reaction was taken back leaves; reactions
+# that don't back anything (extra outcomes, or from someone who can't afford the stake) are taken off, as they would have been
+async def reconcile_pool(pool):
+    async with wager_event_locks.hold(pool.message_id):
+        if wager_index.get(pool.message_id) != wager_cache.POOL: # settled, canceled or expired since the pass started
+            return
+        try:
+            pool_message = await bot.get_channel(pool.channel_id).fetch_message(pool.message_id)
+        except (AttributeError, discord.NotFound, discord.Forbidden): # channel or message is gone
+            return
+        reactions = {} # user_id -> outcomes they reacted with
+        for reaction in pool_message.reactions:
+            if str(reaction.emoji) not in POOL_OUTCOME_EMOJIS:
+                continue
+            outcome = POOL_OUTCOME_EMOJIS.index(str(reaction.emoji))
+            async for user in reaction.users():
+                if user.id != bot.user.id and not getattr(user, "bot", False):
+                    reactions.setdefault(user.id, []).append(outcome)
+        for outcomes in reactions.values():
+            outcomes.sort()
+        result = await wager_db.run(wager_db.reconcile_pool_entries, pool.id, reactions, STARTING_MONEY)
+        if result is None:
+            return
+        pool, totals, stray, short, created = result
+        for user_id in created:
+            leaderboards.add_user(pool.guild_id, user_id, STARTING_MONEY)
+            dispatcher.send_dm(user_id, WELCOME_TEXT)
+        for user_id, outcome in stray:
+            dispatcher.remove_reaction(pool.channel_id, pool.message_id, POOL_OUTCOME_EMOJIS[outcome], user_id)
+        for user_id in short:
+            await tell_short_of_stake(pool, user_id)
+        await refresh_pool_message(pool, totals)
+
+# accept an open wager for the first member whose :wagerin: reaction we missed and who can afford it
+async def reconcile_acceptance(wager, wager_message):
+    in_emoji_id = await find_or_create_emoji("wagerin", wager.guild_id)
+    for reaction in wager_message.reactions:
+        if reaction.custom_emoji and reaction.emoji.id == in_emoji_id:
+            async for user in reaction.users():
+                if user.id in [bot.user.id, wager.creator_id] or getattr(user, "bot", False): # us, the creator, or another bot
+                    continue
+                await accept_wager(wager, user.id)
+                if wager.accepted:
+                    return
+
+# replace an accepted wager's recorded votes with the win/lose reactions on its message, and settle it if they agree
+async def reconcile_votes(wager, wager_message):
+    win_emoji_id = await find_or_create_emoji("wagerwin", wager.guild_id)
+    lose_emoji_id = await find_or_create_emoji("wagerlose", wager.guild_id)
+    votes = []
+    for reaction in wager_message.reactions:
+        if reaction.custom_emoji and reaction.emoji.id in [win_emoji_id, lose_emoji_id]:
+            emoji_name = emoji_cache.name_of(reaction.emoji.id)
+            async for user in reaction.users():
+                if user.id in [wager.creator_id, wager.taker_id]:
+                    votes.append((user.id, emoji_name))
+    votes = await wager_db.run(wager_db.replace_votes, wager.id, votes)
+    winner_id = await check_for_winner(wager, votes)
+    if winner_id:
+        await resolve_winner(wager, winner_id)
 
 # generate a direct link to a wager message
 def get_wager_link(wager):
     return f"https://discord.com/channels/{wager.guild_id}/{wager.channel_id}/{wager.message_id}"
 
+# get the name to show for a user, falling back if they're not around any more
+# names come from the name cache (warm it with resolve_wager_names / name_resolver.resolve first), or failing that the user cache
+def display_name(user_id, guild_id=None, fallback="Deleted User"):
+    name = name_resolver.cached(guild_id, user_id) if guild_id is not None else None
+    if name:
+        return name
+    user = bot.get_user(user_id)
+    if user:
+        return user.display_name
+    return fallback
+
+# look up the names of everyone involved in some wagers, one batch per guild, so display_name can find them
+async def resolve_wager_names(wagers):
+    user_ids = {} # guild_id -> user IDs
+    for wager in wagers:
+        user_ids.setdefault(wager.guild_id, set()).update([wager.creator_id, wager.taker_id, wager.winner_id, wager.loser_id])
+    await asyncio.gather(*[name_resolver.resolve(guild_id, guild_user_ids) for guild_id, guild_user_ids in user_ids.items()])
+
+# build the text of a wager's message for its current state (open, accepted, or won), so we can edit it without fetching it
+def wager_message_content(wager):
+    content = f"{display_name(wager.creator_id, wager.guild_id)} wagered {wager.amount} - condition: **{wager.description}**."
+    if wager.completed:
+        content += f"\n{display_name(wager.winner_id, wager.guild_id)} won the wager against {display_name(wager.loser_id, wager.guild_id)}!"
+    elif wager.accepted:
+        win_emoji = bot.get_emoji(emoji_cache.get(wager.guild_id, "wagerwin"))
+        lose_emoji = bot.get_emoji(emoji_cache.get(wager.guild_id, "wagerlose"))
+        content += f"\n{display_name(wager.taker_id, wager.guild_id)} accepted - winner react to **this** message with `:wagerwin:` ({str(win_emoji)}) and loser react with `:wagerlose:` ({str(lose_emoji)})"
+    else:
+        in_emoji = bot.get_emoji(emoji_cache.get(wager.guild_id, "wagerin"))
+        content += f"\nReact to **this** message with `:wagerin:` ({str(in_emoji)}) to accept the wager!"
+    return content
+
+# add up a pool's entries, [(outcome, stake)], into {outcome: (backers, amount staked)}
+def tally_pool(stakes):
+    totals = {}
+    for outcome, stake in stakes:
+        backers, staked = totals.get(outcome, (0, 0))
+        totals[outcome] = (backers + 1, staked + stake)
+    return totals
+
+# build the text of a pool's message from its totals ({outcome: (backers, amount staked)}): each outcome with its backers and
+# what backing it pays per coin staked while it's open, or which outcome won once it's settled
+def pool_message_content(pool, totals):
+    outcomes = pool.outcome_names()
+    pot = sum(staked for backers, staked in totals.values())
+    creator_name = display_name(pool.creator_id, pool.guild_id)
+    content = f"**Pool #{pool.id}:** {creator_name} started a pool for {pool.amount} a head - **{pool.description}**"
+    for index, outcome in enumerate(outcomes):
+        backers, staked = totals.get(index, (0, 0))
+        if pool.completed:
+            odds = " \u2705" if index == pool.winning_outcome else ""
+        else:
+            odds = f" - pays {pot / staked:.2f}x" if staked else ""
+        content += f"\n{POOL_OUTCOME_EMOJIS[index]} {outcome}: {backers} backing, {staked} staked{odds}"
+    if pool.completed:
+        winning_staked = totals.get(pool.winning_outcome, (0, 0))[1]
+        if 0 < winning_staked < pot:
+            content += f"\n**{outcomes[pool.winning_outcome]}** won! Its backers shared the pot of {pot}."
+        else:
+            content += f"\n**{outcomes[pool.winning_outcome]}** won, with nobody on the other side - every stake was returned."
+    else:
+        content += f"\nReact to **this** message with an outcome's number to back it (the pot of {pot} is shared among the winning outcome's backers). {creator_name} settles it with `!settle_pool {pool.id} <number>`."
+    return content[:MESSAGE_LIMIT]
+
 # Display some debug stuff when logged in, and set status
 @bot.event
+@metrics.tracked_event
 async def on_ready():
     print('Logged in as')
     print(bot.user.name)
@@ -305,48 +702,159 @@ async def on_ready():
     # change bot's presence info
     await bot.change_presence(activity=discord.Game(name='with !wagers'))
 
-    # check for emojis
-    guilds = bot.guilds
-    for guild in guilds:
-        await validate_emojis(["wagerin", "wagerwin", "wagerlose"], guild.id)
+    # warm the emoji cache, wager index and expiry deadlines from the DB (just for the guilds on our shards), then check for emojis
+    guild_ids = {guild.id for guild in bot.guilds}
+    emoji_cache.load(await wager_db.run(wager_db.find_all_emojis))
+    active_wagers = await wager_db.run(wager_db.find_incomplete_wagers, guild_ids)
+    open_pools = await wager_db.run(wager_db.find_open_pools, guild_ids)
+    wager_index.load([(wager.message_id, wager.accepted) for wager in active_wagers], [pool.message_id for pool in open_pools])
+    sweeper.load(active_wagers)
+    pool_sweeper.load(open_pools)
+    leaderboards.load(await wager_db.run(wager_db.find_standings, guild_ids))
+    upload_limit = asyncio.Semaphore(EMOJI_UPLOAD_CONCURRENCY)
+    await asyncio.gather(*[validate_emojis(REQUIRED_EMOJIS, guild.id, upload_limit) for guild in bot.guilds])
+
+    # start running scheduled jobs, expiring stale wagers and delivering queued discord calls (only starts once, even though on_ready fires again on reconnect)
+    # every bot process runs the scheduler, but each job run is claimed in the shared DB, so only one process does the work
+    scheduler.start()
+    dispatcher.start()
+    sweeper.start()
+    pool_sweeper.start()
+    if METRICS_PORT:
+        try:
+            await metrics.serve(METRICS_HOST, METRICS_PORT)
+        except OSError:
+            logger.exception(f"Couldn't serve metrics on {METRICS_HOST}:{METRICS_PORT}")
+
+    # catch up on reactions that were added or removed while we were offline
+    await catch_up(guild_ids, active_wagers, open_pools)
 
-    # run schedule and check for jobs every second
-    while True:
-        # run_pending
-        schedule.run_pending()
-        await asyncio.sleep(1)
+# Catch up on reactions we missed while a shard was disconnected
+@bot.event
+@metrics.tracked_event
+async def on_shard_resumed(shard_id):
+    await catch_up({guild.id for guild in bot.guilds if guild.shard_id == shard_id})
 
 # Watch for reactions that match our custom emoji
 @bot.event
+@metrics.tracked_event
 async def on_raw_reaction_add(payload):
-    emoji = payload.emoji
-    if not emoji.is_custom_emoji: # if this isn't a custom emoji...
+    if payload.user_id == bot.user.id: # ignore our own reactions
         return
-    if emoji.id == await find_or_create_emoji("wagerin", payload.guild_id):
-        # find a wager whose create_message has the same ID as the emoji message, AND is not yet accepted
-        wager = session.query(Wager).filter(Wager.message_id == payload.message_id, Wager.accepted == False).one_or_none()
-        if wager is not None:
-            await accept_wager(wager, payload.user_id)
-    if emoji.id == await find_or_create_emoji("wagerwin", payload.guild_id) or emoji.id == await find_or_create_emoji("wagerlose", payload.guild_id):
-        # find a wager whose create_message has the same ID as the emoji message, AND is accepted but not yet completed
-        wager = session.query(Wager).filter(Wager.message_id == payload.message_id, Wager.accepted == True, Wager.completed == False).one_or_none()
+    if wager_pages.get(payload.message_id) is not None: # someone's paging through their !wagers list
+        await turn_wager_page(payload)
+        return
+    if payload.member is not None: # guild reactions carry the member, so remember their name while we have it
+        if payload.member.bot:
+            return
+        name_cache.set(payload.guild_id, payload.user_id, payload.member.display_name)
+    wager_state = wager_index.get(payload.message_id)
+    if wager_state is None: # if this isn't a message with an active wager...
+        return
+    if wager_state == wager_cache.POOL: # pools are backed with number reactions rather than our custom emojis
+        await handle_pool_entry(payload, True)
+        return
+    emoji_name = emoji_cache.name_of(payload.emoji.id)
+    if emoji_name is None: # if this isn't one of our custom emojis...
+        return
+    async with wager_event_locks.hold(payload.message_id): # handle this wager's events one at a time
+        wager_state = wager_index.get(payload.message_id) # the wager may have changed while we waited
+        if emoji_name == "wagerin" and wager_state == wager_cache.OPEN:
+            # find a wager whose create_message has the same ID as the emoji message, AND is not yet accepted
+            wager = await wager_db.run(wager_db.find_wager_by_message, payload.message_id, False)
+            if wager is not None:
+                await accept_wager(wager, payload.user_id)
+        if (emoji_name == "wagerwin" or emoji_name == "wagerlose") and wager_state == wager_cache.ACCEPTED:
+            await handle_vote(payload, emoji_name, True)
+
+# Watch for our win/lose reactions (or a pool entry's number reaction) being taken back
+@bot.event
+@metrics.tracked_event
+async def on_raw_reaction_remove(payload):
+    if wager_pages.get(payload.message_id) is not None: # bots can't remove reactions in DMs, so taking one back turns the page too
+        await turn_wager_page(payload)
+        return
+    wager_state = wager_index.get(payload.message_id)
+    if wager_state is None: # if this isn't a message with an active wager...
+        return
+    if wager_state == wager_cache.POOL:
+        await handle_pool_entry(payload, False)
+        return
+    emoji_name = emoji_cache.name_of(payload.emoji.id)
+    if emoji_name == "wagerwin" or emoji_name == "wagerlose":
+        async with wager_event_locks.hold(payload.message_id):
+            if wager_index.get(payload.message_id) == wager_cache.ACCEPTED: # it may have been accepted while we waited
+                await handle_vote(payload, emoji_name, False)
+
+# Watch for one of our win/lose reactions being cleared from a wager message
+@bot.event
+@metrics.tracked_event
+async def on_raw_reaction_clear_emoji(payload):
+    if wager_index.get(payload.message_id) is None:
+        return
+    emoji_name = emoji_cache.name_of(payload.emoji.id)
+    if emoji_name == "wagerwin" or emoji_name == "wagerlose":
+        async with wager_event_locks.hold(payload.message_id):
+            if wager_index.get(payload.message_id) != wager_cache.ACCEPTED:
+                return
+            wager = await wager_db.run(wager_db.find_wager_by_message, payload.message_id, True)
+            if wager is not None:
+                await wager_db.run(wager_db.clear_votes, wager.id, emoji_name)
+
+# Watch for all reactions being cleared from a wager message
+@bot.event
+@metrics.tracked_event
+async def on_raw_reaction_clear(payload):
+    if wager_index.get(payload.message_id) is None:
+        return
+    async with wager_event_locks.hold(payload.message_id):
+        if wager_index.get(payload.message_id) != wager_cache.ACCEPTED:
+            return
+        wager = await wager_db.run(wager_db.find_wager_by_message, payload.message_id, True)
         if wager is not None:
-            winner_id = await check_for_winner(wager) # check to see if this reaction confirms a winner for the wager
-            if winner_id: # if we have a winner, complete the wager!
-                await resolve_winner(wager, winner_id)
+            await wager_db.run(wager_db.clear_votes, wager.id)
+
+# record a participant's win/lose reaction being added or removed, then check whether the wager now has a winner
+async def handle_vote(payload, emoji_name, added):
+    result = await wager_db.run(wager_db.record_vote, payload.message_id, payload.user_id, emoji_name, added)
+    if result is None: # not a vote from one of the wager's participants
+        return
+    wager, votes = result
+    winner_id = await check_for_winner(wager, votes) # check to see if this reaction confirms a winner for the wager
+    if winner_id: # if we have a winner, complete the wager!
+        await resolve_winner(wager, winner_id)
+
+# Watch for changes to a guild's emojis; re-check ours if one of them was renamed, replaced, or deleted
+@bot.event
+@metrics.tracked_event
+async def on_guild_emojis_update(guild, before, after):
+    current = {emoji.name: emoji.id for emoji in after}
+    if any(current.get(name) != emoji_cache.get(guild.id, name) for name in REQUIRED_EMOJIS):
+        await validate_emojis(REQUIRED_EMOJIS, guild.id)
+
+# Forget a guild's emojis when we're removed from it
+@bot.event
+@metrics.tracked_event
+async def on_guild_remove(guild):
+    emoji_cache.invalidate(guild.id)
+    leaderboards.invalidate(guild.id)
 
-# Watch for users leaving; delete any outstanding wagers when they do
+# Watch for users leaving; delete any outstanding wagers (and pools) when they do
 @bot.event
+@metrics.tracked_event
 async def on_member_remove(member):
-    # get all outstanding wagers
-    outstanding_wagers = session.query(Wager).filter(Wager.completed == False).all()
-    for wager in outstanding_wagers:
-        # cancel the wager if the leaving user created it
-        if wager.creator_id == member.id:
-            await cancel_wager(wager.id, member.id)
-        # cancel the wager if the leaving user accepted it
-        elif wager.taker_id == member.id:
-            await cancel_wager(wager.id, wager.creator_id) # TODO: don't pass ID of user to cancel function, this should be checked before calling
+    name_cache.set(member.guild.id, member.id, "") # they're not a member any more, so there's no need to look them up
+    # cancel every outstanding wager and open pool in this guild that the leaving user created or accepted, and take back their
+    # stakes in anyone else's pools, in one transaction (holding the wagers' locks, as !cancel does)
+    wagers = await wager_db.run(wager_db.find_member_wagers, member.id, member.guild.id)
+    async with wager_event_locks.hold_all([wager.message_id for wager in wagers]):
+        canceled_wagers, canceled_pools, left_pools = await wager_db.run(wager_db.cancel_member_bets, member.id, member.guild.id,
+            [wager.id for wager in wagers])
+        await announce_canceled_wagers(canceled_wagers)
+    await announce_canceled_pools(canceled_pools)
+    for pool, totals in left_pools:
+        async with wager_event_locks.hold(pool.message_id):
+            await refresh_pool_message(pool, totals)
 
 # !start command to create a new user and give them starting money
 @bot.command(
@@ -356,7 +864,10 @@ async def on_member_remove(member):
     brief = "Get set up for !wagers commands"
 )
 async def start(ctx):
-    await find_or_create_user(ctx.author.id)
+    if ctx.guild is None: # every server has its own economy, so we need to know which one they're joining
+        await ctx.send("Run `!start` in a server to get set up there - every server has its own wagers and money!")
+        return
+    await find_or_create_user(ctx.guild.id, ctx.author.id)
 
 # !wager / !bet command to create a new wager
 @bot.command(
@@ -366,38 +877,36 @@ async def start(ctx):
     brief = WAGER_BRIEF_TEXT
 )
 async def create_wager(ctx, wager_amount: int, *, wager_text: str):
-    in_emoji = bot.get_emoji(await find_or_create_emoji("wagerin", ctx.guild.id)) # get the emoji we want to add / display in message
     # check to see if wager was created in a DM
     if ctx.channel.type is discord.ChannelType.private:
         await ctx.send("Can't create a wager in a direct message, sorry")
         return
+    in_emoji = bot.get_emoji(await find_or_create_emoji("wagerin", ctx.guild.id)) # get the emoji we want to add / display in message
     
     # get the wager's creator and create in DB if necessary
     try:
         # get/create the user who is creating the wager
-        wager_creator = await find_or_create_user(ctx.author.id)
+        wager_creator = await find_or_create_user(ctx.guild.id, ctx.author.id)
     except: # error finding user
         await ctx.send(f"{ctx.author.mention}: Sorry, an unknown error occurred when retrieving your user information!")
         return
 
     # make sure nerds dont try to do negative wagers
     if wager_amount < 1:
-        await ctx.author.send(f"You think that {wager_amount} is a real bet?!")
-        await ctx.message.add_reaction('\U0001F44E')
+        dispatcher.send_dm(ctx.author.id, f"You think that {wager_amount} is a real bet?!")
+        dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F44E')
         return
 
     # check to see if the creator can afford this wager
-    if not wager_creator.can_afford(wager_amount): # if we can't afford this wager...
-        # get our money totals to print out to the user
-        total_money = wager_creator.money
-        outstanding_money = wager_creator.outstanding_money()
-        available_money = total_money - outstanding_money
-        await ctx.author.send(f"You don't got the dough \U0001F4B8\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {available_money} doubloons available!") # send current money and amount of outstanding wagers
-        await ctx.message.add_reaction('\U0001F4B8')
+    total_money, outstanding_money = await wager_db.run(wager_db.get_money_summary, ctx.guild.id, wager_creator.id)
+    available_money = total_money - outstanding_money
+    if wager_amount > available_money: # if we can't afford this wager...
+        # print out our money totals to the user
+        dispatcher.send_dm(ctx.author.id, f"You don't got the dough \U0001F4B8\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {available_money} doubloons available!") # send current money and amount of outstanding wagers
+        dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F4B8')
         return
 
-    # like the original comment if everything's good (helpful for debug!)
-    await ctx.message.add_reaction('\U0001F44D')
+    name_cache.set(ctx.guild.id, ctx.author.id, ctx.author.display_name)
 
     # create wager
     new_wager = Wager(ctx.guild.id, ctx.channel.id, wager_creator.id, wager_amount, wager_text)
@@ -405,15 +914,24 @@ async def create_wager(ctx, wager_amount: int, *, wager_text: str):
     # send confirmation message
     create_message = await ctx.send(f"{ctx.author.display_name} wagered {new_wager.amount} - condition: **{new_wager.description}**.\nReact to **this** message with `:wagerin:` ({str(in_emoji)}) to accept the wager!") 
     
-    # pre-fill the 'in' emoji on the wager message
-    await create_message.add_reaction(in_emoji)
-
     # store the id of the message we sent so we can check for reactions on it later
     new_wager.message_id = create_message.id
 
-    # persist our wager
-    session.add(new_wager)
-    session.commit()
+    # persist our wager, holding the money for it; another wager of theirs may have used up the money we checked for in the meantime
+    if await wager_db.run(wager_db.add_wager, new_wager) is None:
+        dispatcher.edit_message(ctx.channel.id, create_message.id, f"~~{create_message.content}~~")
+        total_money, outstanding_money = await wager_db.run(wager_db.get_money_summary, ctx.guild.id, wager_creator.id)
+        dispatcher.send_dm(ctx.author.id, f"You don't got the dough \U0001F4B8\nYou've got {total_money} doubloons and {outstanding_money} are in outstanding bets, leaving {total_money - outstanding_money} doubloons available!")
+        dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F4B8')
+        return
+
+    # like the original comment if everything's good (helpful for debug!)
+    dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F44D')
+    wager_index.set(new_wager.message_id, wager_cache.OPEN)
+    sweeper.add(new_wager)
+
+    # pre-fill the 'in' emoji on the wager message
+    dispatcher.add_reaction(ctx.channel.id, create_message.id, in_emoji)
 
 # handle errors occurring during wager creation
 @create_wager.error
@@ -425,116 +943,367 @@ async def wager_handler(ctx, error):
     else:
         await ctx.send("Unknown error creating wager")
 
+# !pool command to create a pool wager, which any number of members join by backing one of its outcomes
+@bot.command(
+    name="create_pool",
+    aliases = ["pool"],
+    brief = "Create a pool wager that anyone can join",
+    help = "Create a pool with the amount each entry stakes, a description, and between 2 and 9 outcomes, separated by `|`. Members join by reacting with an outcome's number, and when you settle it with `!settle_pool`, everyone who backed the winning outcome shares the whole pot in proportion to their stakes.\n\nExample:\n!pool 10 who wins tonight? | Red | Blue | Draw"
+)
+async def create_pool(ctx, pool_amount: int, *, pool_text: str):
+    if ctx.guild is None:
+        await ctx.send("Can't create a pool in a direct message, sorry")
+        return
+    description, *outcomes = [part.strip() for part in pool_text.split(POOL_SEPARATOR)]
+    outcomes = [" ".join(outcome.split()) for outcome in outcomes if outcome] # one line each
+    if not description or not 2 <= len(outcomes) <= len(POOL_OUTCOME_EMOJIS):
+        await ctx.send(POOL_FORMAT_TEXT)
+        return
+    if pool_amount < 1:
+        dispatcher.send_dm(ctx.author.id, f"You think that {pool_amount} is a real bet?!")
+        dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F44E')
+        return
+    if await find_or_create_user(ctx.guild.id, ctx.author.id) is None:
+        return
+    name_cache.set(ctx.guild.id, ctx.author.id, ctx.author.display_name)
+    dispatcher.add_reaction(ctx.channel.id, ctx.message.id, '\U0001F44D')
+
+    # persist the pool first, so its message can show the ID it's settled by, then record the message
+    new_pool = await wager_db.run(wager_db.add_pool, Pool(ctx.guild.id, ctx.channel.id, ctx.author.id, pool_amount, description, outcomes))
+    create_message = await ctx.send(pool_message_content(new_pool, {}))
+    new_pool.message_id = create_message.id
+    await wager_db.run(wager_db.set_pool_message, new_pool.id, create_message.id)
+    wager_index.set(new_pool.message_id, wager_cache.POOL)
+    pool_sweeper.add(new_pool)
+
+    # pre-fill a reaction for each outcome
+    for emoji in POOL_OUTCOME_EMOJIS[:len(outcomes)]:
+        dispatcher.add_reaction(ctx.channel.id, create_message.id, emoji)
+
+@create_pool.error
+async def pool_handler(ctx, error):
+    if isinstance(error, (commands.BadArgument, commands.MissingRequiredArgument)):
+        await ctx.send(POOL_FORMAT_TEXT)
+    else:
+        await ctx.send("Unknown error creating pool")
+
+@bot.command(
+    name="settle_pool",
+    aliases=["settlepool"],
+    brief="Settle one of your pools",
+    help="Settle a pool you created in this server by giving its ID and the number of the outcome that won, e.g. '!settle_pool 4 2'. The pot is paid out to everyone who backed that outcome, in proportion to their stakes (if nobody backed it, or nobody backed anything else, everyone gets their stake back)."
+)
+@commands.guild_only()
+async def settle_pool(ctx, pool_id: int, outcome: int):
+    await settle_user_pool(pool_id, outcome, ctx.author.id, ctx.guild.id)
+
+@bot.command(
+    name="cancel_pool",
+    aliases=["cancelpool"],
+    brief="Cancel one of your open pools",
+    help="Cancel pools you created in this server by ID (shown at the top of each pool's message), returning everyone's stake e.g. '!cancel_pool 4'. You can cancel multiple pools by separating the IDs with spaces."
+)
+@commands.guild_only()
+async def cancel_pool(ctx, *pool_ids: int):
+    if not pool_ids:
+        await ctx.author.send("Cancel a pool with `!cancel_pool id` - its ID is at the top of its message")
+        return
+    canceled_pools = await wager_db.run(wager_db.cancel_pools, pool_ids, ctx.author.id, ctx.guild.id)
+    await announce_canceled_pools(canceled_pools)
+    canceled_ids = [pool.id for pool, entries in canceled_pools]
+    missing_ids = [str(pool_id) for pool_id in pool_ids if pool_id not in canceled_ids]
+    if missing_ids:
+        dispatcher.send_dm(ctx.author.id, f"No open pool in this server with an ID of {', '.join(missing_ids)} found")
+
 # command to list existing wagers
 @bot.command(
     name="list_wagers",
     aliases=["wagers", "list"],
     brief="List existing wagers",
-    help="Outputs a list of your created and accepted wagers, along with their status and direct links."
+    help="Outputs a page of your created and accepted wagers, newest first, along with their status and direct links. React with \u2B05\uFE0F / \u27A1\uFE0F to page through them.\n\nFilter by status with `open`, `accepted` or `completed`, and add `here` to only list wagers from this server - e.g. `!wagers open here`"
 )
-async def list_wagers(ctx):
+async def list_wagers(ctx, *filters: str):
+    status = None
+    guild_id = None
+    for wager_filter in filters:
+        if wager_filter.lower() in WAGER_STATUS_FILTERS:
+            status = wager_filter.lower()
+        elif wager_filter.lower() == "here" and ctx.guild:
+            guild_id = ctx.guild.id
+    page = await build_wager_page(ctx.author.id, status, guild_id)
+    if (page.has_prev or page.has_next) and not HANDLES_DMS:
+        # reactions to the DM would go to another process, which doesn't have this page; point them at a DM with us instead
+        await ctx.author.send(f"{page.content}\n*DM me `!wagers` to page through the rest.*"[:MESSAGE_LIMIT])
+        return
+    page_message = await ctx.author.send(page.content)
+    if page.has_prev or page.has_next: # more than one page; add our navigation reactions and remember where we are
+        wager_pages.set(page_message.id, page)
+        dispatcher.add_reaction(page_message.channel.id, page_message.id, PREV_PAGE)
+        dispatcher.add_reaction(page_message.channel.id, page_message.id, NEXT_PAGE)
+
+# move a !wagers listing to its previous/next page when its owner reacts with our navigation arrows
+async def turn_wager_page(payload):
+    page = wager_pages.get(payload.message_id)
+    if page is None or payload.user_id != page.user_id:
+        return
+    if str(payload.emoji) == NEXT_PAGE and page.has_next:
+        new_page = await build_wager_page(page.user_id, page.status, page.guild_id, before_id=page.last_id)
+    elif str(payload.emoji) == PREV_PAGE and page.has_prev:
+        new_page = await build_wager_page(page.user_id, page.status, page.guild_id, after_id=page.first_id)
+    else:
+        return
+    wager_pages.set(payload.message_id, new_page)
+    dispatcher.edit_message(payload.channel_id, payload.message_id, new_page.content)
+
+# build one page of a user's wager list, packing as many wagers as fit into a single message
+# pages are fetched by keyset (wager IDs before/after the current page), so every page costs the same however long the history is
+async def build_wager_page(user_id, status, guild_id, before_id=None, after_id=None):
     separator = '\n-----------------------------------------------------------------------------'
-    user = await find_or_create_user(ctx.author.id)
-    created_wagers = user.created_wagers
-    accepted_wagers = user.accepted_wagers
-    content = "__**Your wagers:**__" + separator
-    if not created_wagers and not accepted_wagers:
-        content += "\n__You haven't participated in any wagers yet!__ Type `!help wager` to get started."
-        await ctx.author.send(content)
-    if created_wagers:
-        content += "\n__Your created wagers:__" + separator
-        for wager in created_wagers:
-            # Get name of user who accepted, if anyone
-            if wager.taker:
-                taker_user = bot.get_user(wager.taker.id)
-                if taker_user:
-                    taker_name = taker_user.display_name
-                else:
-                    taker_name = "Deleted User"
-            else:
-                taker_name = "Nobody"
-            
-            # Get status
-            if wager.completed:
-                status = "Complete"
-                if wager.winner_id == ctx.author.id:
-                    winner_name = "You"
-                else:
-                    winner_name = taker_name
-                winner_text = f"**Winner:** {winner_name}"
-            elif wager.accepted:
-                status = "Accepted"
-                winner_text = ""
-            else:
-                status = "Created"
-                winner_text = ""
-
-            # build the message content for this wager
-            content += f"\n**Amount:** {wager.amount} **Accepted by:** {taker_name} **Status:** {status} {winner_text}"
-            content += f"\n**Description:** {wager.description}"
-            content += f"\n**Link:** {get_wager_link(wager)}"
-            content += separator
-            await ctx.author.send(content)
-            content = ""
-    
-    if accepted_wagers:
-        content += "\n__Your accepted wagers:__" + separator
-        for wager in accepted_wagers:
-            # Get creator name
-            creator_user = bot.get_user(wager.creator_id)
-            if creator_user:
-                creator_name = creator_user.display_name
-            else:
-                creator_name = "Deleted user"
-            # Get status
-            if wager.completed:
-                status = "Complete"
-                if wager.winner_id == ctx.author.id:
-                    winner_name = "You"
-                else:
-                    winner_name = creator_name
-                winner_text = f"**Winner:** {winner_name}"
-            else:
-                status = "Accepted"
-                winner_text = ""
-
-            # build the message content for this wager
-            content += f"\n**Amount:** {wager.amount} **Created by:** {creator_name} **Status:** {status} {winner_text}"
-            content += f"\n**Description:** {wager.description}"
-            content += f"\n**Link:** {get_wager_link(wager)}"
-            content += separator
-            await ctx.author.send(content)
-            content = ""
-            
+    header = "__**Your wagers:**__" + separator
+    wagers, has_more = await wager_db.run(wager_db.find_wagers_page, user_id, status, guild_id, before_id, after_id, WAGER_PAGE_SIZE)
+    await resolve_wager_names(wagers)
+    if not wagers:
+        if before_id is None and after_id is None:
+            content = header + "\n__You haven't participated in any wagers yet!__ Type `!help wager` to get started."
+        else:
+            content = header + "\n__No more wagers to show!__"
+        return wager_cache.WagerPage(user_id, status, guild_id, content, None, None, False, False)
+
+    # pack entries until the message is full; when paging backwards, keep the wagers closest to the page we came from
+    entries = [(wager, format_wager_entry(wager, user_id) + separator) for wager in wagers]
+    if after_id is not None:
+        entries.reverse()
+    shown = []
+    length = len(header)
+    for wager, entry in entries:
+        if shown and length + len(entry) > MESSAGE_LIMIT:
+            break
+        shown.append((wager, entry[:MESSAGE_LIMIT - len(header)]))
+        length += len(entry)
+    if after_id is not None:
+        shown.reverse()
+    more_this_way = has_more or len(shown) < len(entries)
+
+    content = header + "".join(entry for wager, entry in shown)
+    has_prev = more_this_way if after_id is not None else before_id is not None
+    has_next = more_this_way if after_id is None else True
+    return wager_cache.WagerPage(user_id, status, guild_id, content, shown[0][0].id, shown[-1][0].id, has_prev, has_next)
+
+# build the text describing one wager in a user's wager list
+def format_wager_entry(wager, user_id):
+    creator_name = "You" if wager.creator_id == user_id else display_name(wager.creator_id, wager.guild_id)
+    if wager.taker_id:
+        taker_name = "You" if wager.taker_id == user_id else display_name(wager.taker_id, wager.guild_id)
+    else:
+        taker_name = "Nobody"
+
+    # Get status
+    if wager.completed:
+        status = "Complete"
+        winner_name = "You" if wager.winner_id == user_id else display_name(wager.winner_id, wager.guild_id)
+        winner_text = f"**Winner:** {winner_name}"
+    elif wager.accepted:
+        status = "Accepted"
+        winner_text = ""
+    else:
+        status = "Created"
+        winner_text = ""
+
+    # build the message content for this wager
+    content = f"\n**ID:** {wager.id} **Amount:** {wager.amount} **Created by:** {creator_name} **Accepted by:** {taker_name} **Status:** {status} {winner_text}"
+    content += f"\n**Description:** {wager.description}"
+    content += f"\n**Link:** {get_wager_link(wager)}"
+    return content
+
+@bot.command(
+    name="leaderboard",
+    aliases=["leaderboards", "top"],
+    brief="Show this server's top wagerers",
+    help="Shows this server's leaderboard, ranked by balance (default), net winnings ('net') or win rate ('winrate'), 10 users per page, e.g. '!leaderboard net 2'."
+)
+@commands.guild_only()
+async def leaderboard(ctx, *args: str):
+    board = wager_cache.BALANCE
+    page_number = 1
+    for arg in args:
+        if arg.lower() in LEADERBOARD_NAMES:
+            board = arg.lower()
+        elif arg.isdigit() and int(arg) > 0:
+            page_number = int(arg)
+        else:
+            await ctx.send(f"Unknown leaderboard `{arg}` - use one of {', '.join(LEADERBOARD_NAMES)} and optionally a page number, e.g. `!leaderboard net 2`")
+            return
+    entries, ranked_count = leaderboards.page(ctx.guild.id, board, (page_number - 1) * LEADERBOARD_PAGE_SIZE, LEADERBOARD_PAGE_SIZE)
+    await name_resolver.resolve(ctx.guild.id, [user_id for rank, user_id, record in entries])
+    page_count = max((ranked_count + LEADERBOARD_PAGE_SIZE - 1) // LEADERBOARD_PAGE_SIZE, 1)
+    content = f"__**{LEADERBOARD_NAMES[board]} in {ctx.guild.name}**__ (page {page_number} of {page_count})"
+    if not entries:
+        content += "\nNobody to show here yet!"
+    for rank, user_id, (balance, net, wins, losses) in entries:
+        if board == wager_cache.BALANCE:
+            score = f"{balance} doubloons"
+        elif board == wager_cache.NET:
+            score = f"{net:+} doubloons"
+        else:
+            score = f"{wins / (wins + losses):.0%} ({wins}W/{losses}L)"
+        content += f"\n**{rank}.** {display_name(user_id, ctx.guild.id)} - {score}"
+    own_rank = leaderboards.rank(ctx.guild.id, board, ctx.author.id)
+    if own_rank is not None:
+        content += f"\nYou're ranked #{own_rank} of {ranked_count}."
+    await ctx.send(content[:MESSAGE_LIMIT])
+
+@bot.command(
+    name="stats",
+    brief="Show your (or another member's) wager record",
+    help="Shows wins, losses, win rate, total wagered, net winnings, biggest win and current streak in this server, for you or a mentioned member e.g. '!stats @someone'."
+)
+@commands.guild_only()
+async def stats(ctx, member: discord.Member = None):
+    member = member or ctx.author
+    user_stats = await wager_db.run(wager_db.find_user_stats, ctx.guild.id, member.id)
+    if user_stats is None or user_stats.wins + user_stats.losses == 0:
+        await ctx.send(f"{member.display_name} hasn't finished any wagers in {ctx.guild.name} yet!")
+        return
+    games = user_stats.wins + user_stats.losses
+    if user_stats.streak > 0:
+        streak = f"{user_stats.streak} win(s)"
+    else:
+        streak = f"{-user_stats.streak} loss(es)"
+    content = f"__**{member.display_name}'s wagers in {ctx.guild.name}:**__"
+    content += f"\n**Wins:** {user_stats.wins} **Losses:** {user_stats.losses} **Win rate:** {user_stats.wins / games:.0%}"
+    content += f"\n**Total wagered:** {user_stats.total_wagered} **Net:** {user_stats.net:+} **Biggest win:** {user_stats.biggest_win}"
+    content += f"\n**Current streak:** {streak}"
+    await ctx.send(content)
 
 @bot.command(
     name="money",
     brief="Show information about your imaginary money",
-    help="Lists your total money, as well as what money you have currently tied up in bets."
+    help="Lists your total money, as well as what money you have currently tied up in bets. Every server has its own money - use this in a server to see that server's, or in a DM to see them all."
 )
 async def money(ctx):
-    user = await find_or_create_user(ctx.author.id)
-    await ctx.author.send(f"You have {user.money} doubloons, {user.outstanding_money()} of which are tied up in outstanding bets. This leaves you {user.money - user.outstanding_money()} available.")
+    if ctx.guild is not None:
+        user = await find_or_create_user(ctx.guild.id, ctx.author.id)
+        total_money, outstanding_money = await wager_db.run(wager_db.get_money_summary, ctx.guild.id, user.id)
+        await ctx.author.send(f"You have {total_money} doubloons in {ctx.guild.name}, {outstanding_money} of which are tied up in outstanding bets. This leaves you {total_money - outstanding_money} available.")
+        return
+    balances = await wager_db.run(wager_db.find_user_balances, ctx.author.id)
+    if not balances:
+        await ctx.author.send("You don't have any money yet! Type `!start` in a server to get set up.")
+        return
+    content = "__**Your money:**__"
+    for guild_id, total_money, outstanding_money in balances:
+        guild = bot.get_guild(guild_id)
+        guild_name = guild.name if guild else "Unknown server"
+        content += f"\n**{guild_name}:** {total_money} doubloons, {outstanding_money} tied up in outstanding bets, {total_money - outstanding_money} available."
+    await ctx.author.send(content[:MESSAGE_LIMIT])
 
 # TODO: maybe remove the bet 'taker' from DB if they remove the 'in' emoji?
 
 @bot.command(
     name="cancel",
     brief="Cancel one of your oustanding bets",
-    help="Without any arguments, this command will list your outstanding bets and a unique ID for each - to cancel a bet, use that ID in the cancel command e.g. '!cancel 13'. You can cancel multiple bets by separating the IDs with spaces."
+    help="Without any arguments (in a server), this command will list your outstanding bets in that server and a unique ID for each - to cancel a bet, use that ID in the cancel command e.g. '!cancel 13', in the server or in a DM to me. You can cancel multiple bets by separating the IDs with spaces."
 )
 async def cancel(ctx, *cancel_ids: int):
-    user = await find_or_create_user(ctx.author.id)
     if not cancel_ids:
+        if ctx.guild is None: # the list is per server, so it's only shown in one
+            raise commands.NoPrivateMessage()
         separator = '\n-----------------------------------------------------------------------------'
-        wagers = [created_wager for created_wager in user.created_wagers if created_wager.completed == False]
+        wagers = await wager_db.run(wager_db.find_outstanding_created_wagers, ctx.author.id, ctx.guild.id)
         content = "__**Your Outstanding Wagers**__  (Cancel with !cancel `id`)" + separator
         for wager in wagers:
             content += f"\n**ID:** {wager.id} **Amount:** {wager.amount}\n**Description:** {wager.description}\n**Link:** {get_wager_link(wager)}" + separator
-        await bot.get_user(user.id).send(content)
+        await ctx.author.send(content)
     else:
-        for cancel_id in cancel_ids:
-            await cancel_wager(cancel_id, user.id)
-            
+        await cancel_wagers(cancel_ids, ctx.author.id, ctx.guild.id if ctx.guild else None)
+
+# owner-only command to make sure every user's stored escrow matches their outstanding wagers
+@bot.command(
+    name="check_escrow",
+    aliases=["checkescrow"],
+    brief="Check stored escrow against outstanding wagers",
+    help="Recomputes each user's escrowed money from their outstanding wagers and reports any users whose stored escrow has drifted.",
+    hidden=True
+)
+@commands.is_owner()
+async def check_escrow(ctx):
+    drift = await wager_db.run(wager_db.find_escrow_drift)
+    if not drift:
+        await ctx.author.send("Escrow is consistent for every user.")
+        return
+    content = f"__**Escrow drift found for {len(drift)} user(s):**__"
+    for guild_id, user_id, stored_escrow, actual_escrow in drift:
+        content += f"\n**Guild:** {guild_id} **User:** {user_id} **Stored:** {stored_escrow} **Actual:** {actual_escrow}"
+    await ctx.author.send(content[:2000])
+
+# owner-only command to look up what a member's balance in this server was at some point in time, from the ledger
+@bot.command(
+    name="balance_at",
+    aliases=["balanceat"],
+    brief="Look up a member's past balance",
+    help="Shows what a member's balance in this server was at a given time (YYYY-MM-DD or YYYY-MM-DDTHH:MM), from the money ledger.",
+    hidden=True
+)
+@commands.is_owner()
+@commands.guild_only()
+async def balance_at(ctx, member: discord.Member, when):
+    try:
+        at = datetime.datetime.fromisoformat(when)
+    except ValueError:
+        await ctx.author.send(f"Couldn't read `{when}` as a time - use YYYY-MM-DD or YYYY-MM-DDTHH:MM")
+        return
+    if at.time() == datetime.time(0, 0) and "T" not in when:
+        at += datetime.timedelta(days=1) # a bare date means the end of that day
+    balance = await wager_db.run(wager_ledger.balance_at, ctx.guild.id, member.id, at)
+    if balance is None:
+        await ctx.author.send(f"{member.display_name} had no account in {ctx.guild.name} at {at}.")
+        return
+    money, escrow = balance
+    await ctx.author.send(f"At {at}, {member.display_name} had {money} doubloons in {ctx.guild.name} ({escrow} of it in outstanding bets).")
+
+# owner-only command to export wager history (archived and live) as a gzipped CSV or JSON lines attachment
+@bot.command(
+    name="export_wagers",
+    aliases=["exportwagers"],
+    brief="Export wager history",
+    help="DMs you every wager in this server (or in every server, when used in a DM), archived ones included, as a gzipped CSV or JSON lines file, e.g. '!export_wagers jsonl'.",
+    hidden=True
+)
+@commands.is_owner()
+async def export_wagers(ctx, export_format="csv"):
+    export_format = export_format.lower()
+    if export_format not in wager_export.FORMATS:
+        await ctx.author.send(f"Unknown format `{export_format}` - use one of {', '.join(wager_export.FORMATS)}")
+        return
+    guild_id = ctx.guild.id if ctx.guild else None
+    export_file, count = await asyncio.to_thread(wager_export.export_to_file, wager_models.engine, export_format, guild_id)
+    with export_file:
+        size = export_file.seek(0, os.SEEK_END)
+        export_file.seek(0)
+        if size > wager_export.ATTACHMENT_LIMIT:
+            await ctx.author.send(f"The export of {count} wagers is too big to attach ({size // 1024 // 1024}MB) - run `python wager_export.py` on the bot's host instead.")
+            return
+        await ctx.author.send(f"Exported {count} wagers.", file=discord.File(export_file, filename=f"wagers.{export_format}.gz"))
+
+# owner-only command to summarize the bot's runtime metrics: the busiest handlers, REST routes and cache hit rates
+@bot.command(
+    name="botstats",
+    brief="Show runtime metrics",
+    help="Shows handler latency and DB queries per call, REST calls by route, and cache hit rates since the bot started.",
+    hidden=True
+)
+@commands.is_owner()
+async def botstats(ctx):
+    await ctx.author.send(f"```\n{metrics.summary()[:MESSAGE_LIMIT - 8]}\n```")
 
-bot.run(DISCORD_TOKEN)
+# only connect when run as a script, so the handlers can be imported (e.g. by wager_bench.py)
+if __name__ == "__main__":
+    recorder = None
+    if EVENT_LOG:
+        recorder = wager_record.EventRecorder(EVENT_LOG)
+        recorder.save_start_db(wager_models.engine)
+        recorder.attach(bot, scheduler, sweeper, pool_sweeper)
+    bot.run(DISCORD_TOKEN)
+    if recorder is not None:
+        recorder.close()
+    log_listener.stop()
@@ -0,0 +1,760 @@
+import asyncio
+import contextvars
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+from sqlalchemy import func, or_, and_, case, insert, select, union_all, literal, bindparam, Integer, DateTime
+from wager_models import Wager, ArchivedWager, Pool, PoolEntry, User, UserStats, Emoji, WagerVote, ScheduledJob, ReconcileCheckpoint, Session
+import wager_ledger
+
+logger = logging.getLogger('discord')
+
+# all database work runs on this one thread so SQLite queries and commits never block the discord event loop
+db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="wager-db")
+
+# group commit: units of work queued while the DB thread is busy are run together and committed in one transaction
+# DB_BATCH_SIZE caps how many go in one transaction; DB_BATCH_WINDOW_MS (default 0) waits that long for more to arrive
+# before starting a batch, trading a little latency for bigger batches
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "100"))
+DB_BATCH_WINDOW = int(os.getenv("DB_BATCH_WINDOW_MS", "0")) / 1000
+
+# run func(session, *args) on the DB thread; returns its result once its changes are committed, or raises what it raised
+# the caller's context variables go with it, so its queries are charged to the handler that made them (see wager_metrics)
+async def run(func, *args):
+    return await committer.submit(func, *args)
+
+# gathers units of work from concurrent handlers and runs them on the DB thread in batches, one commit per batch,
+# so commits per second don't limit events per second; each caller's future resolves once its batch is committed
+class GroupCommitter:
+    def __init__(self, max_batch=DB_BATCH_SIZE, window=DB_BATCH_WINDOW):
+        self.max_batch = max_batch
+        self.window = window
+        self.pending = [] # (context, func, args, future) waiting for a batch
+        self.flushing = False
+        self.batches = 0
+        self.units = 0
+
+    async def submit(self, func, *args):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((contextvars.copy_context(), func, args, future))
+        if not self.flushing:
+            self.flushing = True
+            loop.create_task(self.flush(loop))
+        return await future
+
+    # keep running batches until nothing is waiting; whatever queues up while a batch runs goes in the next one
+    async def flush(self, loop):
+        try:
+            if self.window:
+                await asyncio.sleep(self.window)
+            while self.pending:
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                try:
+                    outcomes = await loop.run_in_executor(db_executor, _run_batch, [unit[:3] for unit in batch])
+                except Exception as error: # e.g. the commit itself failed; every unit in the batch failed with it
+                    logger.exception(f"Batch of {len(batch)} DB units failed")
+                    outcomes = [(False, error)] * len(batch)
+                self.batches += 1
+                self.units += len(batch)
+                for (context, func, args, future), (succeeded, value) in zip(batch, outcomes):
+                    if future.cancelled():
+                        continue
+                    if succeeded:
+                        future.set_result(value)
+                    else:
+                        future.set_exception(value)
+        finally:
+            self.flushing = False
+
+committer = GroupCommitter()
+
+# run a batch of units of work in one transaction, in the order they were queued; returns [(succeeded, result or error)]
+# each unit runs in its own SAVEPOINT, so a failing unit is rolled back (and raises for its caller) on its own while the rest
+# of the batch commits; each unit is flushed and the session cleared after it, so every caller gets its own objects as if it
+# had its own session (a batch of one doesn't need a savepoint: its transaction is rolled back instead)
+# raises if the batch's commit fails, in which case every unit in it failed
+def _run_batch(batch):
+    if len(batch) == 1:
+        context, func, args = batch[0]
+        try:
+            return [(True, context.run(_run_in_session, func, *args))]
+        except Exception as error:
+            return [(False, error)]
+    session = Session()
+    try:
+        outcomes = []
+        for context, func, args in batch:
+            try:
+                outcomes.append((True, context.run(_run_in_savepoint, session, func, *args)))
+            except Exception as error:
+                outcomes.append((False, error))
+            session.expunge_all()
+        session.commit()
+        return outcomes
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# run one unit of a batch in its own SAVEPOINT, flushing it before the savepoint is released; called in the unit's context, so
+# every statement it causes (the flush and the savepoint's included) is counted against its handler, as a batch of one's are
+def _run_in_savepoint(session, func, *args):
+    savepoint = session.begin_nested()
+    try:
+        result = func(session, *args)
+        session.flush()
+        savepoint.commit()
+        return result
+    except:
+        savepoint.rollback()
+        raise
+
+# open a session for a single unit of work and always close it, so the identity map never outlives the event
+def _run_in_session(func, *args):
+    session = Session()
+    try:
+        result = func(session, *args)
+        session.commit()
+        return result
+    except:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+# the most IDs to put in one IN (...) list, so a process with thousands of guilds stays well under SQLite's limit on bound parameters
+IN_CHUNK_SIZE = 500
+
+# split a collection of IDs into lists of at most IN_CHUNK_SIZE, to be queried an IN (...) list at a time
+def in_chunks(ids):
+    ids = list(ids)
+    return [ids[start:start + IN_CHUNK_SIZE] for start in range(0, len(ids), IN_CHUNK_SIZE)]
+
+# -- users --
+
+# find a user's account in a guild, creating it with starting money if needed; returns (user, created)
+def find_or_create_user(session, guild_id, user_id, starting_money):
+    user = session.query(User).filter_by(guild_id=guild_id, id=user_id).one_or_none()
+    if user is not None:
+        return user, False
+    user = User(guild_id, user_id, starting_money)
+    session.add(user)
+    session.flush()
+    wager_ledger.post(session, wager_ledger.starting_money(guild_id, user_id, starting_money))
+    return user, True
+
+# get a user's total money and the amount tied up in outstanding bets in a guild; returns (money, outstanding) or None
+def get_money_summary(session, guild_id, user_id):
+    user = session.query(User).filter_by(guild_id=guild_id, id=user_id).one_or_none()
+    if user is None:
+        return None
+    return user.money, user.outstanding_money()
+
+# get (guild_id, money, outstanding) for each guild a user has an account in
+def find_user_balances(session, user_id):
+    return session.query(User.guild_id, User.money, User.escrow).filter(User.id == user_id).all()
+
+# get (guild_id, user_id, money, net winnings, wins, losses) for every user in the given guilds (used to build the leaderboards)
+def find_standings(session, guild_ids):
+    standings = []
+    for chunk in in_chunks(guild_ids):
+        standings += session.query(
+                User.guild_id, User.id, User.money,
+                func.coalesce(UserStats.net, 0), func.coalesce(UserStats.wins, 0), func.coalesce(UserStats.losses, 0)) \
+            .outerjoin(UserStats, and_(UserStats.guild_id == User.guild_id, UserStats.user_id == User.id)) \
+            .filter(User.guild_id.in_(chunk)) \
+            .all()
+    return standings
+
+# add the weekly money allotment to each user's balance in a single UPDATE, and record it in the ledger
+def add_money_to_all(session, amount):
+    session.query(User).update({User.money: User.money + amount}, synchronize_session=False)
+    wager_ledger.post_stipend(session, amount)
+
+# -- emojis --
+
+# get every emoji row we have stored (used to warm the emoji cache)
+def find_all_emojis(session):
+    return session.query(Emoji).all()
+
+# store the current IDs of our emojis in guilds, [(guild_id, name, emoji_id)], replacing any rows we had for them
+def replace_emojis(session, emojis):
+    for guild_id, name, emoji_id in emojis:
+        session.query(Emoji) \
+            .filter(or_(and_(Emoji.guild_id == guild_id, Emoji.name == name), Emoji.id == emoji_id)) \
+            .delete(synchronize_session=False)
+    session.add_all([Emoji(emoji_id, guild_id, name) for guild_id, name, emoji_id in emojis])
+
+# -- wagers --
+
+# persist a newly created wager (message already sent) and hold the creator's money for it, if they can still afford it
+# (another of their wagers may have been created since they were checked); returns the wager, or None if they can't afford it
+def add_wager(session, wager):
+    creator = session.query(User).filter_by(guild_id=wager.guild_id, id=wager.creator_id).one()
+    if not creator.can_afford(wager.amount):
+        return None
+    session.add(wager)
+    creator.hold(wager.amount)
+    session.flush()
+    wager_ledger.post(session, wager_ledger.hold(wager.guild_id, wager.creator_id, wager.amount, wager.id))
+    return wager
+
+# find a wager by the ID of its message, in a given accepted/completed state
+def find_wager_by_message(session, message_id, accepted, completed=False):
+    return session.query(Wager).filter(Wager.message_id == message_id, Wager.accepted == accepted, Wager.completed == completed).one_or_none()
+
+# record a taker on a wager if it's still open and they can afford it
+# returns True if the wager was accepted, False if the taker can't afford it, or None if it's no longer open
+def accept_wager(session, wager_id, taker_id):
+    wager = session.query(Wager).filter(Wager.id == wager_id, Wager.accepted == False, Wager.completed == False).one_or_none()
+    taker = session.query(User).filter_by(guild_id=wager.guild_id, id=taker_id).one_or_none() if wager else None
+    if wager is None or taker is None:
+        return None
+    if not taker.can_afford(wager.amount):
+        return False
+    wager.accept(taker_id)
+    taker.hold(wager.amount)
+    wager_ledger.post(session, wager_ledger.hold(wager.guild_id, taker_id, wager.amount, wager.id))
+    return True
+
+# get the given wagers that haven't been completed yet (only the ones a user created, if creator_id is given, and only in one
+# guild, if guild_id is), so their locks can be taken before they're canceled or expired
+def find_incomplete_wagers_by_id(session, wager_ids, creator_id=None, guild_id=None):
+    if not wager_ids:
+        return []
+    query = session.query(Wager).filter(Wager.id.in_(wager_ids), Wager.completed == False)
+    if creator_id is not None:
+        query = query.filter(Wager.creator_id == creator_id)
+    if guild_id is not None:
+        query = query.filter(Wager.guild_id == guild_id)
+    return query.all()
+
+# get every outstanding wager in a guild that a member created or accepted
+def find_member_wagers(session, member_id, guild_id):
+    return session.query(Wager) \
+        .filter(or_(Wager.creator_id == member_id, Wager.taker_id == member_id)) \
+        .filter(Wager.guild_id == guild_id, Wager.completed == False) \
+        .all()
+
+# cancel the given outstanding wagers created by a user (in one guild, unless guild_id is None); returns the wagers that were canceled
+def cancel_wagers(session, wager_ids, creator_id, guild_id=None):
+    return delete_wagers(session, find_incomplete_wagers_by_id(session, wager_ids, creator_id, guild_id))
+
+# remove incomplete wagers from the DB and release the money their creators (and takers) had held for them
+# escrow is released with a single UPDATE for every affected user, the releases are posted to the ledger as one transaction,
+# and the wagers and their votes are deleted in bulk
+def delete_wagers(session, wagers):
+    if not wagers:
+        return []
+    releases = {} # guild_id -> {user_id: amount to release}
+    entries = []
+    for wager in wagers:
+        guild_releases = releases.setdefault(wager.guild_id, {})
+        for user_id in [wager.creator_id, wager.taker_id]:
+            if user_id is not None:
+                guild_releases[user_id] = guild_releases.get(user_id, 0) + wager.amount
+                entries += wager_ledger.release(wager.guild_id, user_id, wager.amount, wager.id)
+    for guild_id, guild_releases in releases.items():
+        session.query(User).filter(User.guild_id == guild_id, User.id.in_(guild_releases.keys())) \
+            .update({User.escrow: User.escrow - case(guild_releases, value=User.id)}, synchronize_session=False)
+    wager_ledger.post(session, entries)
+    wager_ids = [wager.id for wager in wagers]
+    session.query(WagerVote).filter(WagerVote.wager_id.in_(wager_ids)).delete(synchronize_session=False)
+    session.query(Wager).filter(Wager.id.in_(wager_ids)).delete(synchronize_session=False)
+    return wagers
+
+# expire the outstanding wagers posted as the given messages, whatever their deadlines (a replay re-running the sweeper's
+# recorded expiries); returns the expired wagers
+def expire_wagers_by_message(session, message_ids):
+    if not message_ids:
+        return []
+    return delete_wagers(session, session.query(Wager).filter(Wager.message_id.in_(message_ids), Wager.completed == False).all())
+
+# expire the given wagers if they're past their deadline: open ones created at or before open_before, and accepted ones accepted
+# at or before accepted_before (None for either means wagers in that state don't expire)
+# expired wagers are deleted and their money released in bulk, like canceled ones; returns (expired wagers, wagers still
+# incomplete and not yet due, for the sweeper to track again)
+def expire_wagers(session, wager_ids, open_before, accepted_before):
+    wagers = find_incomplete_wagers_by_id(session, wager_ids)
+    expired = []
+    pending = []
+    for wager in wagers:
+        cutoff, touched_at = (accepted_before, wager.accepted_at) if wager.accepted else (open_before, wager.created_at)
+        if cutoff is None or touched_at is None:
+            continue
+        (expired if touched_at <= cutoff else pending).append(wager)
+    return delete_wagers(session, expired), pending
+
+# record the winner/loser of a wager and transfer the money; returns False if the wager was already completed
+# the wager is claimed with a conditional UPDATE ... WHERE completed = 0, so settling it twice can never pay out twice
+def complete_wager(session, wager_id, winner_id, loser_id):
+    claimed = session.query(Wager) \
+        .filter(Wager.id == wager_id, Wager.accepted == True, Wager.completed == False) \
+        .update({Wager.completed: True, Wager.winner_id: winner_id, Wager.loser_id: loser_id, Wager.completed_at: datetime.datetime.now()},
+            synchronize_session=False)
+    if not claimed:
+        return False
+    wager = session.query(Wager).filter(Wager.id == wager_id).one()
+    winner = session.query(User).filter_by(guild_id=wager.guild_id, id=winner_id).one()
+    loser = session.query(User).filter_by(guild_id=wager.guild_id, id=loser_id).one()
+    winner.release(wager.amount)
+    loser.release(wager.amount)
+    winner.add_money(wager.amount)
+    loser.remove_money(wager.amount)
+    wager_ledger.post(session, wager_ledger.settle(wager.guild_id, winner_id, loser_id, wager.amount, wager_id))
+    find_or_create_stats(session, wager.guild_id, winner_id).record(wager.amount, True)
+    find_or_create_stats(session, wager.guild_id, loser_id).record(wager.amount, False)
+    session.query(WagerVote).filter(WagerVote.wager_id == wager_id).delete()
+    return True
+
+# -- pools --
+
+# persist a newly created pool and return it (with its ID, so its message can show it)
+def add_pool(session, pool):
+    session.add(pool)
+    session.flush()
+    return pool
+
+# record the message a pool was posted in
+def set_pool_message(session, pool_id, message_id):
+    session.query(Pool).filter(Pool.id == pool_id).update({Pool.message_id: message_id}, synchronize_session=False)
+
+# get {pool_id: {outcome: (backers, amount staked)}} for the given pools, with one GROUP BY
+def find_pool_totals(session, pool_ids):
+    totals = {pool_id: {} for pool_id in pool_ids}
+    rows = session.query(PoolEntry.pool_id, PoolEntry.outcome, func.count(), func.sum(PoolEntry.amount)) \
+        .filter(PoolEntry.pool_id.in_(pool_ids)) \
+        .group_by(PoolEntry.pool_id, PoolEntry.outcome)
+    for pool_id, outcome, backers, staked in rows:
+        totals[pool_id][outcome] = (backers, staked)
+    return totals
+
+# back one of an open pool's outcomes (by the pool's message), staking the pool's amount if the user can afford it
+# a user only gets one entry per pool; returns (pool, the outcome they're backing now or None if they can't afford to, the
+# pool's totals), or None if the message doesn't hold an open pool
+def join_pool(session, message_id, user_id, outcome):
+    pool = session.query(Pool).filter(Pool.message_id == message_id, Pool.completed == False).one_or_none()
+    user = session.query(User).filter_by(guild_id=pool.guild_id, id=user_id).one_or_none() if pool else None
+    if pool is None or user is None or outcome >= len(pool.outcome_names()):
+        return None
+    entry = session.query(PoolEntry).filter_by(pool_id=pool.id, user_id=user_id).one_or_none()
+    if entry is not None: # already in; backing this outcome or another one
+        return pool, entry.outcome, find_pool_totals(session, [pool.id])[pool.id]
+    if not user.can_afford(pool.amount):
+        return pool, None, find_pool_totals(session, [pool.id])[pool.id]
+    session.add(PoolEntry(pool.id, pool.guild_id, user_id, outcome, pool.amount))
+    user.hold(pool.amount)
+    wager_ledger.post(session, wager_ledger.hold(pool.guild_id, user_id, pool.amount, None, pool.id))
+    session.flush()
+    return pool, outcome, find_pool_totals(session, [pool.id])[pool.id]
+
+# take back a user's entry on an open pool's outcome (by the pool's message) and release their stake
+# returns (pool, the pool's totals), or None if they weren't backing that outcome of an open pool
+def leave_pool(session, message_id, user_id, outcome):
+    pool = session.query(Pool).filter(Pool.message_id == message_id, Pool.completed == False).one_or_none()
+    entry = session.query(PoolEntry).filter_by(pool_id=pool.id, user_id=user_id, outcome=outcome).one_or_none() if pool else None
+    if entry is None:
+        return None
+    release_pool_entries(session, [entry])
+    session.delete(entry)
+    session.flush()
+    return pool, find_pool_totals(session, [pool.id])[pool.id]
+
+# release the stakes held for pool entries, with a single UPDATE per guild, and post the releases to the ledger as one transaction
+def release_pool_entries(session, entries):
+    releases = {} # guild_id -> {user_id: amount to release}
+    ledger_entries = []
+    for entry in entries:
+        guild_releases = releases.setdefault(entry.guild_id, {})
+        guild_releases[entry.user_id] = guild_releases.get(entry.user_id, 0) + entry.amount
+        ledger_entries += wager_ledger.release(entry.guild_id, entry.user_id, entry.amount, None, entry.pool_id)
+    for guild_id, guild_releases in releases.items():
+        session.query(User).filter(User.guild_id == guild_id, User.id.in_(guild_releases.keys())) \
+            .update({User.escrow: User.escrow - case(guild_releases, value=User.id)}, synchronize_session=False)
+    wager_ledger.post(session, ledger_entries)
+
+# when a member leaves a guild, cancel their outstanding wagers there (the given IDs, from find_member_wagers) and take them out
+# of its pools (cancel_member_pools) in one unit of work; returns (canceled wagers, canceled pools, pools they left)
+def cancel_member_bets(session, member_id, guild_id, wager_ids):
+    canceled_wagers = delete_wagers(session, find_incomplete_wagers_by_id(session, wager_ids))
+    canceled_pools, left_pools = cancel_member_pools(session, member_id, guild_id)
+    return canceled_wagers, canceled_pools, left_pools
+
+# cancel the given open pools created by a user in a guild, returning everyone's stakes; returns [(pool, its entries)] for each
+# one canceled
+def cancel_pools(session, pool_ids, creator_id, guild_id):
+    pools = session.query(Pool) \
+        .filter(Pool.id.in_(pool_ids), Pool.creator_id == creator_id, Pool.guild_id == guild_id, Pool.completed == False) \
+        .all()
+    return delete_pools(session, pools)
+
+# when a member leaves a guild, cancel the open pools they created there and take their entries out of the others
+# returns ([(pool, its entries)] for each pool canceled, [(pool, its totals)] for each pool they left)
+# (one query finds every pool they're in either way, so a member who's in none costs nothing more)
+def cancel_member_pools(session, member_id, guild_id):
+    backed = select(PoolEntry.pool_id).where(PoolEntry.guild_id == guild_id, PoolEntry.user_id == member_id)
+    pools = session.query(Pool) \
+        .filter(Pool.guild_id == guild_id, Pool.completed == False, or_(Pool.creator_id == member_id, Pool.id.in_(backed))) \
+        .all()
+    canceled = delete_pools(session, [pool for pool in pools if pool.creator_id == member_id])
+    left = [pool for pool in pools if pool.creator_id != member_id]
+    if not left:
+        return canceled, []
+    pool_ids = [pool.id for pool in left]
+    entries = session.query(PoolEntry).filter(PoolEntry.user_id == member_id, PoolEntry.pool_id.in_(pool_ids)).all()
+    release_pool_entries(session, entries)
+    session.query(PoolEntry).filter(PoolEntry.user_id == member_id, PoolEntry.pool_id.in_(pool_ids)).delete(synchronize_session=False)
+    totals = find_pool_totals(session, pool_ids)
+    return canceled, [(pool, totals[pool.id]) for pool in left]
+
+# remove open pools from the DB, releasing every stake in them in bulk; returns [(pool, its entries)]
+def delete_pools(session, pools):
+    if not pools:
+        return []
+    pool_ids = [pool.id for pool in pools]
+    entries = session.query(PoolEntry).filter(PoolEntry.pool_id.in_(pool_ids)).all()
+    release_pool_entries(session, entries)
+    session.query(PoolEntry).filter(PoolEntry.pool_id.in_(pool_ids)).delete(synchronize_session=False)
+    session.query(Pool).filter(Pool.id.in_(pool_ids)).delete(synchronize_session=False)
+    return [(pool, [entry for entry in entries if entry.pool_id == pool.id]) for pool in pools]
+
+# expire the given open pools if nobody settled them in time (created at or before created_before), refunding every stake like
+# a canceled pool; returns [(pool, its entries)] for the pools expired
+def expire_pools(session, pool_ids, created_before):
+    if not pool_ids:
+        return []
+    pools = session.query(Pool).filter(Pool.id.in_(pool_ids), Pool.completed == False, Pool.created_at <= created_before).all()
+    return delete_pools(session, pools)
+
+# expire the open pools posted as the given messages, whatever their deadlines (a replay re-running the pool sweeper's recorded
+# expiries); returns [(pool, its entries)]
+def expire_pools_by_message(session, message_ids):
+    if not message_ids:
+        return []
+    return delete_pools(session, session.query(Pool).filter(Pool.message_id.in_(message_ids), Pool.completed == False).all())
+
+# bring an open pool's entries in line with the number reactions on its message, {user_id: [outcomes they reacted with, lowest
+# first]} (used to catch up after downtime): entries whose reaction is gone are taken back, and anyone reacting without an
+# entry joins on the first outcome they reacted with, if they can afford it (accounts are made for anyone who hasn't got one);
+# reactions for outcomes the pool doesn't have are ignored
+# returns (pool, its totals, [(user_id, outcome)] reactions that don't back anything and should come off the message, user IDs
+# short of the stake, user IDs given new accounts), or None if it isn't an open pool any more
+def reconcile_pool_entries(session, pool_id, reactions, starting_money):
+    pool = session.query(Pool).filter(Pool.id == pool_id, Pool.completed == False).one_or_none()
+    if pool is None:
+        return None
+    reactions = {user_id: [outcome for outcome in outcomes if outcome < len(pool.outcome_names())] for user_id, outcomes in reactions.items()}
+    entries = session.query(PoolEntry).filter(PoolEntry.pool_id == pool_id).all()
+    gone = [entry for entry in entries if entry.outcome not in reactions.get(entry.user_id, [])]
+    release_pool_entries(session, gone)
+    for entry in gone:
+        session.delete(entry)
+    session.flush()
+    backing = {entry.user_id: entry.outcome for entry in entries if entry not in gone}
+    created = []
+    short = []
+    holds = []
+    for user_id, outcomes in reactions.items():
+        if user_id in backing or not outcomes:
+            continue
+        user, new_account = find_or_create_user(session, pool.guild_id, user_id, starting_money)
+        if new_account:
+            created.append(user_id)
+        if not user.can_afford(pool.amount):
+            short.append(user_id)
+            continue
+        session.add(PoolEntry(pool.id, pool.guild_id, user_id, outcomes[0], pool.amount))
+        user.hold(pool.amount)
+        holds += wager_ledger.hold(pool.guild_id, user_id, pool.amount, None, pool.id)
+        backing[user_id] = outcomes[0]
+    wager_ledger.post(session, holds)
+    session.flush()
+    stray = [(user_id, outcome) for user_id, outcomes in reactions.items() for outcome in outcomes if backing.get(user_id) != outcome]
+    return pool, find_pool_totals(session, [pool.id])[pool.id], stray, short, created
+
+# split a pool's pot among the backers of the winning outcome in proportion to their stakes (parimutuel), from its entries in
+# the order they joined; returns {user_id: (outcome, stake, net)}, net being what they won or minus what they lost
+# payouts are rounded down and the coins left over go one each to the winners who lost the most to rounding (earliest
+# entries first), so the pot is paid out exactly; if nobody (or everybody) backed the winning outcome, every stake is returned
+def pool_results(entries, winning_outcome):
+    pot = sum(entry.amount for entry in entries)
+    backing = sum(entry.amount for entry in entries if entry.outcome == winning_outcome)
+    if backing == 0 or backing == pot:
+        return {entry.user_id: (entry.outcome, entry.amount, 0) for entry in entries}
+    payouts = {}
+    shortfalls = []
+    for position, entry in enumerate(entries):
+        if entry.outcome == winning_outcome:
+            payouts[entry.user_id], shortfall = divmod(entry.amount * pot, backing)
+            shortfalls.append((-shortfall, position, entry.user_id))
+    leftover = pot - sum(payouts.values())
+    for shortfall, position, user_id in sorted(shortfalls)[:leftover]:
+        payouts[user_id] += 1
+    return {entry.user_id: (entry.outcome, entry.amount, payouts.get(entry.user_id, 0) - entry.amount) for entry in entries}
+
+# settle a pool its creator says has been won by an outcome: claim it with a conditional UPDATE (so it's only ever paid out once),
+# work out every entry's payout in one pass, then apply them all with a single UPDATE of the user table (money and escrow by
+# CASE on the user ID), one ledger transaction and one stats load; returns (pool, pool_results(...)), or None if it isn't
+# an open pool of theirs in the guild (or has no such outcome)
+def settle_pool(session, pool_id, creator_id, guild_id, winning_outcome):
+    pool = session.query(Pool) \
+        .filter(Pool.id == pool_id, Pool.creator_id == creator_id, Pool.guild_id == guild_id, Pool.completed == False) \
+        .one_or_none()
+    if pool is None or not 0 <= winning_outcome < len(pool.outcome_names()):
+        return None
+    claimed = session.query(Pool) \
+        .filter(Pool.id == pool_id, Pool.completed == False) \
+        .update({Pool.completed: True, Pool.winning_outcome: winning_outcome, Pool.completed_at: datetime.datetime.now()},
+            synchronize_session=False)
+    if not claimed:
+        return None
+    session.expunge(pool) # it's been updated already; this just tells the caller
+    pool.completed = True
+    pool.winning_outcome = winning_outcome
+    entries = session.query(PoolEntry).filter(PoolEntry.pool_id == pool_id).order_by(PoolEntry.joined_at, PoolEntry.user_id).all()
+    results = pool_results(entries, winning_outcome)
+    if not results:
+        return pool, results
+    stakes = {user_id: stake for user_id, (outcome, stake, net) in results.items()}
+    nets = {user_id: net for user_id, (outcome, stake, net) in results.items()}
+    session.query(User).filter(User.guild_id == pool.guild_id, User.id.in_(results.keys())) \
+        .update({User.money: User.money + case_by_amount(User.id, nets), User.escrow: User.escrow - case_by_amount(User.id, stakes)},
+            synchronize_session=False)
+    wager_ledger.post(session, wager_ledger.settle_pool(pool.guild_id,
+        {user_id: (stake, net) for user_id, (outcome, stake, net) in results.items()}, pool_id))
+    if any(net for net in nets.values()): # a pool everyone gets their stake back from isn't a win or loss for anyone
+        stats = {row.user_id: row for row in session.query(UserStats)
+            .filter(UserStats.guild_id == pool.guild_id, UserStats.user_id.in_(results.keys()))}
+        for user_id, (outcome, stake, net) in results.items():
+            if user_id not in stats:
+                stats[user_id] = UserStats(pool.guild_id, user_id)
+                session.add(stats[user_id])
+            stats[user_id].record(stake, outcome == winning_outcome, net)
+    return pool, results
+
+# a CASE giving each key's amount, {key: amount}, with one branch per distinct amount (`WHEN id IN (...) THEN amount`) rather
+# than one per key: everyone on the same side of a pool gets about the same payout, so there are only a handful of branches
+# however many entries there are, and each IN list is looked up through an index rather than compared key by key
+def case_by_amount(column, amounts):
+    keys_by_amount = {}
+    for key, amount in amounts.items():
+        keys_by_amount.setdefault(amount, []).append(key)
+    return case(*[(column.in_(keys), amount) for amount, keys in keys_by_amount.items()], else_=0)
+
+# get every open pool in the given guilds that's been posted (used to build the wager index and expiry deadlines, and to catch up)
+def find_open_pools(session, guild_ids):
+    pools = []
+    for chunk in in_chunks(guild_ids):
+        pools += session.query(Pool).filter(Pool.guild_id.in_(chunk), Pool.completed == False, Pool.message_id != None).all()
+    return pools
+
+# -- stats --
+
+# get a user's settled-wager stats in a guild, or None if they haven't settled any wagers there
+def find_user_stats(session, guild_id, user_id):
+    return session.query(UserStats).filter_by(guild_id=guild_id, user_id=user_id).one_or_none()
+
+# get a user's stats row in a guild, creating an empty one if needed
+def find_or_create_stats(session, guild_id, user_id):
+    stats = find_user_stats(session, guild_id, user_id)
+    if stats is None:
+        stats = UserStats(guild_id, user_id)
+        session.add(stats)
+    return stats
+
+# -- win/lose votes --
+
+# get the (user_id, emoji_name) votes recorded for a wager
+def find_votes(session, wager_id):
+    return session.query(WagerVote.user_id, WagerVote.emoji_name).filter(WagerVote.wager_id == wager_id).all()
+
+# record a participant adding (or removing) a win/lose reaction on an accepted wager's message
+# returns (wager, votes) so the caller can check for a winner, or None if this isn't a participant's vote on an accepted wager
+def record_vote(session, message_id, user_id, emoji_name, added):
+    wager = find_wager_by_message(session, message_id, True)
+    if wager is None or user_id not in [wager.creator_id, wager.taker_id]:
+        return None
+    vote = session.query(WagerVote).filter_by(wager_id=wager.id, user_id=user_id, emoji_name=emoji_name).one_or_none()
+    if added and vote is None:
+        session.add(WagerVote(wager.id, user_id, emoji_name))
+    elif not added and vote is not None:
+        session.delete(vote)
+    session.flush()
+    return wager, find_votes(session, wager.id)
+
+# forget the votes on a wager for one emoji (or every emoji, if no name is given) after its reactions are cleared
+def clear_votes(session, wager_id, emoji_name=None):
+    query = session.query(WagerVote).filter(WagerVote.wager_id == wager_id)
+    if emoji_name is not None:
+        query = query.filter(WagerVote.emoji_name == emoji_name)
+    query.delete()
+
+# replace a wager's recorded votes with what's actually on its message (used to reconcile after downtime); returns the votes
+def replace_votes(session, wager_id, votes):
+    clear_votes(session, wager_id)
+    for user_id, emoji_name in votes:
+        session.add(WagerVote(wager_id, user_id, emoji_name))
+    return votes
+
+# get (message_id, accepted) for every wager in the given guilds that hasn't been completed yet (used to build the wager index)
+def find_active_wager_states(session, guild_ids):
+    states = []
+    for chunk in in_chunks(guild_ids):
+        states += session.query(Wager.message_id, Wager.accepted).filter(Wager.guild_id.in_(chunk), Wager.completed == False).all()
+    return [(message_id, accepted) for message_id, accepted in states]
+
+# get every incomplete wager in the given guilds (used to warm the wager index and expiry deadlines at startup)
+def find_incomplete_wagers(session, guild_ids):
+    wagers = []
+    for chunk in in_chunks(guild_ids):
+        wagers += session.query(Wager).filter(Wager.guild_id.in_(chunk), Wager.completed == False).all()
+    return wagers
+
+# -- catch-up passes --
+
+# start a catch-up pass for each of the given guilds; returns {guild_id: ID of the last wager already reconciled}
+# a pass that was left unfinished (we restarted partway through it) less than resume_within ago is resumed from its checkpoint;
+# anything older starts over, since reactions could have been missed on the wagers it already did
+def start_reconcile_passes(session, guild_ids, now, resume_within):
+    checkpoints = {checkpoint.guild_id: checkpoint for chunk in in_chunks(guild_ids) for checkpoint in
+        session.query(ReconcileCheckpoint).filter(ReconcileCheckpoint.guild_id.in_(chunk))}
+    resume_after = {}
+    for guild_id in guild_ids:
+        checkpoint = checkpoints.get(guild_id)
+        if checkpoint is not None and checkpoint.finished_at is None and checkpoint.started_at >= now - resume_within:
+            resume_after[guild_id] = checkpoint.last_wager_id or 0
+            continue
+        if checkpoint is None:
+            checkpoint = ReconcileCheckpoint(guild_id, now)
+            session.add(checkpoint)
+        checkpoint.started_at = now
+        checkpoint.last_wager_id = None
+        checkpoint.finished_at = None
+        resume_after[guild_id] = 0
+    return resume_after
+
+# record that a guild's catch-up pass has reconciled every wager up to last_wager_id (finishing the pass if finished is set)
+def save_reconcile_checkpoint(session, guild_id, last_wager_id, finished, now):
+    session.query(ReconcileCheckpoint).filter(ReconcileCheckpoint.guild_id == guild_id) \
+        .update({ReconcileCheckpoint.last_wager_id: last_wager_id, ReconcileCheckpoint.finished_at: now if finished else None},
+            synchronize_session=False)
+
+# get a user's outstanding created wagers in a guild
+def find_outstanding_created_wagers(session, user_id, guild_id):
+    return session.query(Wager).filter(Wager.creator_id == user_id, Wager.guild_id == guild_id, Wager.completed == False) \
+        .order_by(Wager.id).all()
+
+# get one page of the wagers a user created or accepted, newest first, optionally filtered by status (open/accepted/completed) and guild
+# pages are found by keyset: wagers older than before_id, or newer than after_id; returns (wagers, whether there are more that way)
+# completed wagers may have been archived, so unless we only want open or accepted ones, the page is read from both tables in one
+# UNION ALL query (each side limited by the keyset, so it only reads a page's worth of either); rows have the wager columns
+# plus accepted, completed and archived
+def find_wagers_page(session, user_id, status, guild_id, before_id, after_id, limit):
+    direction = "after" if after_id is not None else "before" if before_id is not None else None
+    query = wagers_page_query(status, guild_id is not None, direction)
+    keyset_id = after_id if after_id is not None else before_id
+    wagers = session.execute(query, {"user_id": user_id, "guild_id": guild_id, "keyset_id": keyset_id, "limit": limit + 1}).all()
+    if direction == "after":
+        return list(reversed(wagers[:limit])), len(wagers) > limit
+    return wagers[:limit], len(wagers) > limit
+
+# the query for a kind of wager page, with the user, guild, keyset ID and limit left as parameters
+# building a UNION of subqueries is slow enough in Python to matter here, so each kind is only built once
+wagers_page_queries = {}
+def wagers_page_query(status, by_guild, direction):
+    key = (status, by_guild, direction)
+    if key in wagers_page_queries:
+        return wagers_page_queries[key]
+    tables = [Wager] if status in ["open", "accepted"] else [Wager, ArchivedWager]
+    limit = bindparam("limit", type_=Integer)
+    pages = []
+    for table in tables:
+        query = history_select(table).where(or_(table.creator_id == bindparam("user_id"), table.taker_id == bindparam("user_id")))
+        if table is Wager and status == "open":
+            query = query.where(Wager.accepted == False, Wager.completed == False)
+        elif table is Wager and status == "accepted":
+            query = query.where(Wager.accepted == True, Wager.completed == False)
+        elif table is Wager and status == "completed":
+            query = query.where(Wager.completed == True)
+        if by_guild:
+            query = query.where(table.guild_id == bindparam("guild_id"))
+        if direction == "after":
+            query = query.where(table.id > bindparam("keyset_id")).order_by(table.id.asc())
+        elif direction == "before":
+            query = query.where(table.id < bindparam("keyset_id")).order_by(table.id.desc())
+        else:
+            query = query.order_by(table.id.desc())
+        pages.append(select(query.limit(limit).subquery()))
+    page = union_all(*pages).subquery()
+    query = select(page).order_by(page.c.id.asc() if direction == "after" else page.c.id.desc()).limit(limit)
+    wagers_page_queries[key] = query
+    return query
+
+# -- archive --
+
+# the columns copied from the wager table to the archive
+ARCHIVED_COLUMNS = ["id", "guild_id", "channel_id", "message_id", "creator_id", "taker_id", "amount", "description",
+    "created_at", "accepted_at", "completed_at", "winner_id", "loser_id"]
+
+# select the columns live and archived wagers have in common from either table, plus accepted, completed and archived
+# (so the two can be read together with a UNION ALL)
+def history_select(table):
+    if table is ArchivedWager:
+        states = [literal(True).label("accepted"), literal(True).label("completed"), literal(True).label("archived")]
+    else:
+        states = [Wager.accepted, Wager.completed, literal(False).label("archived")]
+    return select(*[getattr(table, name) for name in ARCHIVED_COLUMNS], *states)
+
+# move up to limit completed wagers settled at or before completed_before (or before we tracked when) into the archive,
+# oldest first, with one INSERT ... SELECT and one DELETE; returns how many were moved
+def archive_wagers(session, completed_before, limit):
+    wager_ids = [wager_id for wager_id, in session.query(Wager.id)
+        .filter(Wager.completed == True, or_(Wager.completed_at <= completed_before, Wager.completed_at == None))
+        .order_by(Wager.id).limit(limit)]
+    if not wager_ids:
+        return 0
+    columns = [getattr(Wager, name) for name in ARCHIVED_COLUMNS]
+    session.execute(insert(ArchivedWager).from_select(ARCHIVED_COLUMNS + ["archived_at"],
+        select(*columns, literal(datetime.datetime.now(), DateTime)).where(Wager.id.in_(wager_ids))))
+    session.query(WagerVote).filter(WagerVote.wager_id.in_(wager_ids)).delete(synchronize_session=False)
+    session.query(Wager).filter(Wager.id.in_(wager_ids)).delete(synchronize_session=False)
+    return len(wager_ids)
+
+# -- scheduled jobs --
+
+# get {job name: last run} for the named jobs, recording a first run of `now` for any job we haven't seen before
+def load_job_runs(session, names, now):
+    last_runs = {job.name: job.last_run for job in session.query(ScheduledJob).filter(ScheduledJob.name.in_(names))}
+    for name in names:
+        if name not in last_runs:
+            session.add(ScheduledJob(name, now))
+            last_runs[name] = now
+    return last_runs
+
+# move a job's last run from previous_run to due; returns False if someone else already moved it
+def claim_job_run(session, name, previous_run, due):
+    claimed = session.query(ScheduledJob) \
+        .filter(ScheduledJob.name == name, ScheduledJob.last_run == previous_run) \
+        .update({ScheduledJob.last_run: due}, synchronize_session=False)
+    return claimed == 1
+
+# -- consistency checks --
+
+# recompute every user's escrow from their incomplete wagers and open pool entries in each guild and compare it to the stored value
+# returns a list of (guild_id, user_id, stored_escrow, actual_escrow) for each account whose escrow has drifted
+def find_escrow_drift(session):
+    held = union_all(
+        select(Wager.guild_id, Wager.creator_id.label("user_id"), Wager.amount).where(Wager.completed == False),
+        select(Wager.guild_id, Wager.taker_id, Wager.amount).where(Wager.completed == False, Wager.taker_id != None),
+        select(PoolEntry.guild_id, PoolEntry.user_id, PoolEntry.amount).join(Pool, Pool.id == PoolEntry.pool_id).where(Pool.completed == False),
+    ).subquery()
+    actual_escrow = func.coalesce(func.sum(held.c.amount), 0)
+    return session.query(User.guild_id, User.id, User.escrow, actual_escrow) \
+        .outerjoin(held, and_(held.c.guild_id == User.guild_id, held.c.user_id == User.id)) \
+        .group_by(User.guild_id, User.id, User.escrow) \
+        .having(User.escrow != actual_escrow) \
+        .all()
@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import logging
+import random
+import aiohttp
+import discord
+import wager_locks
+
+logger = logging.getLogger('discord')
+
+# how many outbound actions can be in flight at once (actions on the same route still run one at a time)
+DISPATCH_CONCURRENCY = 8
+# how many DMs one fan-out (e.g. settling a pool) can have in flight at once
+FAN_OUT_CONCURRENCY = 4
+# how many times to retry an action that hit a rate limit or a transient failure, and the base backoff between tries
+MAX_RETRIES = 5
+BASE_BACKOFF = 0.5
+
+# a single outbound discord call, queued by the dispatcher
+# route groups actions that share a discord rate limit bucket (a channel's messages, or a user's DMs)
+class Action:
+    def __init__(self, route, perform, description):
+        self.route = route
+        self.perform = perform
+        self.description = description
+
+# queues outbound discord calls (message edits, reactions, DMs) so handlers can commit their DB changes and move on
+# actions on different routes run concurrently, actions on the same route run in the order they were queued,
+# repeated edits to one message collapse into the latest content, and 429s/transient failures are retried with backoff
+class Dispatcher:
+    def __init__(self, bot, concurrency=DISPATCH_CONCURRENCY):
+        self.bot = bot
+        self.concurrency = concurrency
+        self.queue = None
+        self.workers = []
+        self.route_locks = wager_locks.KeyedLock() # a route's actions run in order
+        self.blocked_until = {} # route -> loop time we were told to wait until by a 429
+        self.pending_edits = {} # (channel_id, message_id) -> latest content not yet sent
+        self.fan_outs = itertools.count() # gives each fan-out its own route
+
+    # start the worker tasks (safe to call more than once)
+    def start(self):
+        if self.queue is not None:
+            return
+        self.queue = asyncio.Queue()
+        self.workers = [asyncio.ensure_future(self.work()) for _ in range(self.concurrency)]
+
+    # wait until every queued action has been delivered (or given up on)
+    async def flush(self):
+        if self.queue is not None:
+            await self.queue.join()
+
+    def enqueue(self, action):
+        self.start()
+        self.queue.put_nowait(action)
+
+    # -- actions --
+
+    # edit a message's content; if an edit to the same message is still queued, just replace its content
+    def edit_message(self, channel_id, message_id, content):
+        key = (channel_id, message_id)
+        already_queued = key in self.pending_edits
+        self.pending_edits[key] = content
+        if already_queued:
+            return
+        latest = {}
+        async def perform():
+            if key in self.pending_edits: # pick up the newest content (it may have changed since a failed attempt, too)
+                latest["content"] = self.pending_edits.pop(key)
+            message = self.partial_message(channel_id, message_id)
+            if "content" in latest and message is not None:
+                await message.edit(content=latest["content"])
+        self.enqueue(Action(("channel", channel_id), perform, f"edit message {message_id}"))
+
+    # add one of our reactions to a message
+    def add_reaction(self, channel_id, message_id, emoji):
+        async def perform():
+            message = self.partial_message(channel_id, message_id)
+            if message is not None:
+                await message.add_reaction(emoji)
+        self.enqueue(Action(("channel", channel_id), perform, f"add reaction to message {message_id}"))
+
+    # remove a user's reaction from a message
+    def remove_reaction(self, channel_id, message_id, emoji, user_id):
+        async def perform():
+            message = self.partial_message(channel_id, message_id)
+            if message is not None:
+                await message.remove_reaction(emoji, discord.Object(id=user_id))
+        self.enqueue(Action(("channel", channel_id), perform, f"remove reaction from message {message_id}"))
+
+    # remove every user's reaction with an emoji from a message
+    def clear_reaction(self, channel_id, message_id, emoji):
+        async def perform():
+            message = self.partial_message(channel_id, message_id)
+            if message is not None:
+                await message.clear_reaction(emoji)
+        self.enqueue(Action(("channel", channel_id), perform, f"clear reaction on message {message_id}"))
+
+    # send a direct message to a user
+    def send_dm(self, user_id, content):
+        self.enqueue(self.dm_action(user_id, content))
+
+    # send direct messages to many users, [(user_id, content)], as one queued action that delivers at most
+    # FAN_OUT_CONCURRENCY of them at a time, so a big batch (a pool's payout DMs) goes out concurrently without taking
+    # over every worker; each DM still waits its turn on its user's route, and is retried or given up on by itself
+    def send_dms(self, messages):
+        if not messages:
+            return
+        limit = asyncio.Semaphore(FAN_OUT_CONCURRENCY)
+        async def send(user_id, content):
+            action = self.dm_action(user_id, content)
+            async with limit:
+                try:
+                    async with self.route_locks.hold(action.route):
+                        await self.deliver(action)
+                except Exception:
+                    logger.exception(f"Dispatcher failed to {action.description}")
+        async def perform():
+            await asyncio.gather(*[send(user_id, content) for user_id, content in messages])
+        self.enqueue(Action(("fan_out", next(self.fan_outs)), perform, f"DM {len(messages)} users"))
+
+    def dm_action(self, user_id, content):
+        async def perform():
+            user = self.bot.get_user(user_id) or await self.bot.fetch_user(user_id)
+            await user.send(content)
+        return Action(("dm", user_id), perform, f"DM user {user_id}")
+
+    # get a message we can act on without fetching it, or None if we can't see its channel any more
+    def partial_message(self, channel_id, message_id):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return None
+        return channel.get_partial_message(message_id)
+
+    # -- delivery --
+
+    async def work(self):
+        while True:
+            action = await self.queue.get()
+            try:
+                async with self.route_locks.hold(action.route):
+                    await self.deliver(action)
+            except Exception:
+                logger.exception(f"Dispatcher failed to {action.description}")
+            finally:
+                self.queue.task_done()
+
+    # perform an action, waiting out 429s on its route and backing off on transient failures
+    async def deliver(self, action):
+        loop = asyncio.get_running_loop()
+        for attempt in range(MAX_RETRIES + 1):
+            wait = self.blocked_until.pop(action.route, 0) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await action.perform()
+                return
+            except discord.HTTPException as error:
+                if error.status == 429:
+                    retry_after = getattr(error, "retry_after", None) or BASE_BACKOFF * 2 ** attempt
+                    self.blocked_until[action.route] = loop.time() + retry_after
+                    continue
+                if error.status < 500 or attempt == MAX_RETRIES:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+            await asyncio.sleep(BASE_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+        logger.warning(f"Dispatcher gave up trying to {action.description}")
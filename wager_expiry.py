@@ -0,0 +1,133 @@
+import asyncio
+import contextlib
+import datetime
+import heapq
+import logging
+import wager_db
+
+logger = logging.getLogger('discord')
+
+# never sleep longer than this between checks, so clock changes can't push expiry out indefinitely
+MAX_SLEEP = 3600
+# how long to wait before retrying a sweep that failed
+RETRY_DELAY = 60
+# the most wagers expired in one transaction
+BATCH_SIZE = 100
+
+# expires wagers that have sat too long: open ones nobody took within open_ttl of being created, and accepted ones nobody
+# settled within accepted_ttl of being accepted (either TTL can be None, so wagers in that state never expire)
+# deadlines are kept in a min-heap of (deadline, wager_id), so the sweeper only wakes when the earliest one is due; entries
+# aren't removed when a wager is accepted, settled or canceled - the DB checks each due wager's current state when it's swept,
+# expires the ones that really are past their deadline and hands back the rest to be pushed again with their new deadline
+# on_expired(wagers) is a coroutine, awaited with each batch of expired wagers (already deleted, with their money released);
+# if locks (a KeyedLock by message ID) are given, the due wagers' locks are held while they're expired and announced, so an
+# accept or settlement that's under way finishes first
+class ExpirySweeper:
+    def __init__(self, open_ttl, accepted_ttl, on_expired, locks=None, batch_size=BATCH_SIZE):
+        self.open_ttl = open_ttl
+        self.accepted_ttl = accepted_ttl
+        self.on_expired = on_expired
+        self.locks = locks
+        self.batch_size = batch_size
+        self.deadlines = []
+        self.wake = None
+        self.task = None
+
+    # get the time a wager expires in its current state, or None if it never does
+    def deadline(self, wager):
+        if wager.accepted:
+            if self.accepted_ttl is None or wager.accepted_at is None:
+                return None
+            return wager.accepted_at + self.accepted_ttl
+        if self.open_ttl is None or wager.created_at is None:
+            return None
+        return wager.created_at + self.open_ttl
+
+    # track a wager's deadline (call again when it's accepted, as that changes it)
+    def add(self, wager):
+        deadline = self.deadline(wager)
+        if deadline is None:
+            return
+        if self.wake is not None and (not self.deadlines or deadline < self.deadlines[0][0]):
+            self.wake.set() # it's due before whatever we're sleeping until
+        heapq.heappush(self.deadlines, (deadline, wager.id))
+
+    # track the deadlines of every incomplete wager (replaces anything already tracked)
+    def load(self, wagers):
+        self.deadlines = [(deadline, wager.id) for wager in wagers if (deadline := self.deadline(wager)) is not None]
+        heapq.heapify(self.deadlines)
+        if self.wake is not None:
+            self.wake.set()
+
+    # start sweeping; safe to call again (e.g. when on_ready fires after a reconnect)
+    def start(self):
+        if self.task is not None or (self.open_ttl is None and self.accepted_ttl is None):
+            return
+        self.wake = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    # pop the IDs of wagers that are due (at most batch_size of them)
+    def pop_due(self, now):
+        wager_ids = set()
+        while self.deadlines and self.deadlines[0][0] <= now and len(wager_ids) < self.batch_size:
+            wager_ids.add(heapq.heappop(self.deadlines)[1])
+        return wager_ids
+
+    # expire due wagers a batch at a time, then sleep until the next deadline (or until an earlier one is added)
+    async def run(self):
+        while True:
+            now = datetime.datetime.now()
+            wager_ids = self.pop_due(now)
+            if wager_ids:
+                try:
+                    await self.sweep(wager_ids, now)
+                except Exception:
+                    logger.exception(f"Expiring {len(wager_ids)} wagers failed")
+                    retry_at = now + datetime.timedelta(seconds=RETRY_DELAY)
+                    for wager_id in wager_ids:
+                        heapq.heappush(self.deadlines, (retry_at, wager_id))
+                    await asyncio.sleep(RETRY_DELAY)
+                continue
+            delay = MAX_SLEEP
+            if self.deadlines:
+                delay = min((self.deadlines[0][0] - now).total_seconds(), MAX_SLEEP)
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(delay, 0))
+            except asyncio.TimeoutError:
+                pass
+
+    # expire the due wagers that really are past their deadline, and track the rest again
+    async def sweep(self, wager_ids, now):
+        wagers = await wager_db.run(wager_db.find_incomplete_wagers_by_id, list(wager_ids))
+        async with self.locks.hold_all([wager.message_id for wager in wagers]) if self.locks else contextlib.nullcontext():
+            expired, pending = await wager_db.run(wager_db.expire_wagers, [wager.id for wager in wagers],
+                self.cutoff(self.open_ttl, now), self.cutoff(self.accepted_ttl, now))
+            if expired:
+                logger.info(f"Expired {len(expired)} wagers")
+                await self.on_expired(expired)
+        for wager in pending: # accepted since they were tracked, so they have a new deadline
+            self.add(wager)
+
+    # wagers last touched at or before this time have expired (None if the TTL is off)
+    def cutoff(self, ttl, now):
+        return now - ttl if ttl is not None else None
+
+# expires open pools nobody settled within ttl of being created, refunding every stake; deadlines are tracked as for wagers, but a
+# pool's never changes, so a due pool is either expired or already gone
+# on_expired(pools) is awaited with each batch of expired pools, [(pool, its entries)] (already deleted, with every stake released);
+# it takes each pool's lock itself, as announce_canceled_pools does, so no locks are held here
+class PoolExpirySweeper(ExpirySweeper):
+    def __init__(self, ttl, on_expired, batch_size=BATCH_SIZE):
+        super().__init__(ttl, None, on_expired, batch_size=batch_size)
+
+    def deadline(self, pool):
+        if self.open_ttl is None or pool.created_at is None:
+            return None
+        return pool.created_at + self.open_ttl
+
+    async def sweep(self, pool_ids, now):
+        expired = await wager_db.run(wager_db.expire_pools, list(pool_ids), self.cutoff(self.open_ttl, now))
+        if expired:
+            logger.info(f"Expired {len(expired)} pools")
+            await self.on_expired(expired)
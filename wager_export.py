@@ -0,0 +1,92 @@
+import argparse
+import csv
+import gzip
+import json
+import sys
+import tempfile
+from sqlalchemy import select, union_all, or_
+import wager_db
+import wager_models
+from wager_models import Wager, ArchivedWager
+
+# streams wager history (live and archived wagers) out as CSV or JSON lines, a row at a time, so memory use stays flat however
+# much history there is:
+#   python wager_export.py [--format csv|jsonl] [--guild ID] [--user ID] [--output FILE]
+# the owner-only !export_wagers command sends the same export as a gzipped attachment
+
+FORMATS = ["csv", "jsonl"]
+# how many rows to fetch from the database at a time
+FETCH_ROWS = 1000
+# the largest attachment we try to DM (discord's limit for bots without boosts)
+ATTACHMENT_LIMIT = 10 * 1024 * 1024
+
+# the columns exported for each wager; status is open, accepted or completed, and archived says which table it came from
+EXPORT_COLUMNS = wager_db.ARCHIVED_COLUMNS + ["status", "archived"]
+
+# a query over every wager (optionally just one guild's, or one user's), live or archived, in ID order
+def history_query(guild_id=None, user_id=None):
+    queries = []
+    for table in [Wager, ArchivedWager]:
+        query = wager_db.history_select(table)
+        if guild_id is not None:
+            query = query.where(table.guild_id == guild_id)
+        if user_id is not None:
+            query = query.where(or_(table.creator_id == user_id, table.taker_id == user_id))
+        queries.append(query)
+    history = union_all(*queries).subquery()
+    return select(history).order_by(history.c.id)
+
+# stream the history rows as dicts of EXPORT_COLUMNS
+def history_rows(connection, guild_id=None, user_id=None):
+    results = connection.execution_options(stream_results=True, yield_per=FETCH_ROWS).execute(history_query(guild_id, user_id))
+    for row in results.mappings():
+        status = "completed" if row["completed"] else "accepted" if row["accepted"] else "open"
+        yield {**{name: row[name] for name in wager_db.ARCHIVED_COLUMNS}, "status": status, "archived": bool(row["archived"])}
+
+# write the history to a text stream in the given format; returns how many wagers were written
+def write_history(connection, out, export_format, guild_id=None, user_id=None):
+    count = 0
+    if export_format == "csv":
+        writer = csv.DictWriter(out, fieldnames=EXPORT_COLUMNS)
+        writer.writeheader()
+        for row in history_rows(connection, guild_id, user_id):
+            writer.writerow(row)
+            count += 1
+    else:
+        for row in history_rows(connection, guild_id, user_id):
+            out.write(json.dumps(row, default=str) + "\n")
+            count += 1
+    return count
+
+# write the history, gzipped, to a temporary file (for sending as an attachment); returns (file, wagers written)
+# uses its own connection, so a long export runs alongside the bot's DB work rather than holding up the DB thread
+def export_to_file(engine, export_format, guild_id=None, user_id=None):
+    export_file = tempfile.TemporaryFile()
+    with engine.connect() as connection, gzip.open(export_file, "wt", encoding="utf-8", newline="") as out:
+        count = write_history(connection, out, export_format, guild_id, user_id)
+    export_file.seek(0)
+    return export_file, count
+
+def main():
+    parser = argparse.ArgumentParser(description="Export wager history (live and archived) as CSV or JSON lines")
+    parser.add_argument("--format", choices=FORMATS, default="csv")
+    parser.add_argument("--guild", type=int, help="only this guild's wagers")
+    parser.add_argument("--user", type=int, help="only wagers this user created or took")
+    parser.add_argument("--output", help="file to write (default stdout; gzipped if it ends in .gz)")
+    args = parser.parse_args()
+    if args.output is None:
+        out = sys.stdout
+    elif args.output.endswith(".gz"):
+        out = gzip.open(args.output, "wt", encoding="utf-8", newline="")
+    else:
+        out = open(args.output, "w", encoding="utf-8", newline="")
+    try:
+        with wager_models.engine.connect() as connection:
+            count = write_history(connection, out, args.format, args.guild, args.user)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(f"Exported {count} wagers", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+import asyncio
+import collections
+import itertools
+import random
+import types
+import discord
+
+# an in-process stand-in for the bits of discord the bot talks to, for benchmarks and load tests
+# FakeDiscord.install(bot) points the bot's cache lookups (get_channel, get_user, get_guild, get_emoji, user) at fake objects;
+# every REST call a fake object makes waits out a simulated latency, can be rate limited, and is counted by route
+
+# discord snowflakes are 64-bit; start fake IDs high enough that they look like real ones
+FIRST_SNOWFLAKE = 10 ** 17
+
+# stands in for the aiohttp response that discord.HTTPException expects
+class FakeResponse:
+    def __init__(self, status, reason):
+        self.status = status
+        self.reason = reason
+
+# a custom emoji, or a unicode one if it has no ID
+class FakeEmoji:
+    def __init__(self, emoji_id, name):
+        self.id = emoji_id
+        self.name = name
+
+    def __str__(self):
+        if self.id is None:
+            return self.name
+        return f"<:{self.name}:{self.id}>"
+
+class FakeUser:
+    def __init__(self, fake, user_id, name, bot=False):
+        self.fake = fake
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+        self.bot = bot
+        self.dm_channel = FakeChannel(fake, fake.next_id(), None, discord.ChannelType.private)
+
+    # DM this user
+    async def send(self, content):
+        return await self.dm_channel.send(content)
+
+class FakeMember(FakeUser):
+    def __init__(self, fake, user_id, name, guild):
+        super().__init__(fake, user_id, name)
+        self.guild = guild
+
+class FakeGuild:
+    def __init__(self, fake, guild_id, name):
+        self.fake = fake
+        self.id = guild_id
+        self.name = name
+        self.emojis = []
+        self.members = {}
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    # look members up by ID, as discord.py does over the gateway when they aren't cached
+    async def query_members(self, user_ids, limit=5, presences=False, cache=True):
+        await self.fake.rest(("guild", self.id), "query members")
+        return [self.members[user_id] for user_id in user_ids[:limit] if user_id in self.members]
+
+    async def create_custom_emoji(self, name, image):
+        await self.fake.rest(("guild", self.id), "create emoji")
+        emoji = FakeEmoji(self.fake.next_id(), name)
+        self.emojis.append(emoji)
+        self.fake.emojis[emoji.id] = emoji
+        return emoji
+
+# one emoji's reactions on a message
+class FakeReaction:
+    def __init__(self, fake, emoji):
+        self.fake = fake
+        self.emoji = emoji
+        self.custom_emoji = isinstance(emoji, FakeEmoji)
+        self.user_ids = set()
+
+    async def users(self):
+        await self.fake.rest(("channel", None), "fetch reaction users")
+        for user_id in list(self.user_ids):
+            yield self.fake.users.get(user_id) or discord.Object(id=user_id)
+
+class FakeMessage:
+    def __init__(self, fake, message_id, channel, author, content):
+        self.fake = fake
+        self.id = message_id
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.guild = channel.guild
+        self.reactions_by_emoji = {} # str(emoji) -> FakeReaction
+        self._state = None # discord.ext.commands.Context reads this, but never uses it for what we do
+        self.attachments = []
+        self.mentions = []
+
+    @property
+    def reactions(self):
+        return [reaction for reaction in self.reactions_by_emoji.values() if reaction.user_ids]
+
+    # record a user's reaction (without any REST call - this is the user's doing, not ours)
+    def react(self, emoji, user_id, added=True):
+        reaction = self.reactions_by_emoji.setdefault(str(emoji), FakeReaction(self.fake, emoji))
+        if added:
+            reaction.user_ids.add(user_id)
+        else:
+            reaction.user_ids.discard(user_id)
+
+    async def edit(self, content):
+        await self.fake.rest(self.channel.route, "edit message")
+        self.content = content
+
+    async def add_reaction(self, emoji):
+        await self.fake.rest(self.channel.route, "add reaction")
+        self.react(emoji, self.fake.bot_user.id)
+
+    async def remove_reaction(self, emoji, member):
+        await self.fake.rest(self.channel.route, "remove reaction")
+        self.react(emoji, member.id, False)
+
+    async def clear_reaction(self, emoji):
+        await self.fake.rest(self.channel.route, "clear reaction")
+        self.reactions_by_emoji.pop(str(emoji), None)
+
+class FakeChannel:
+    def __init__(self, fake, channel_id, guild, channel_type=discord.ChannelType.text):
+        self.fake = fake
+        self.id = channel_id
+        self.guild = guild
+        self.type = channel_type
+        self.route = ("dm" if channel_type is discord.ChannelType.private else "channel", channel_id)
+        self.messages = {}
+        fake.channels[channel_id] = self
+
+    async def send(self, content):
+        await self.fake.rest(self.route, "send message")
+        message = FakeMessage(self.fake, self.fake.message_id_for(self), self, self.fake.bot_user, content)
+        self.messages[message.id] = message
+        return message
+
+    # messages we haven't seen (e.g. ones sent by users) are made up on the spot, as if they'd been fetched
+    def get_partial_message(self, message_id):
+        message = self.messages.get(message_id)
+        if message is None:
+            message = self.messages[message_id] = FakeMessage(self.fake, message_id, self, None, "")
+        return message
+
+    async def fetch_message(self, message_id):
+        await self.fake.rest(self.route, "fetch message")
+        if message_id not in self.messages:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown Message")
+        return self.messages[message_id]
+
+# a command invocation context, with just what the bot's commands use
+class FakeContext:
+    def __init__(self, fake, author, channel, content=""):
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.message = FakeMessage(fake, fake.next_id(), channel, author, content)
+        channel.messages[self.message.id] = self.message
+
+    async def send(self, content):
+        return await self.channel.send(content)
+
+# the fake discord: its guilds, channels, users and emojis, plus the simulated REST API they all call through
+class FakeDiscord:
+    def __init__(self, latency=0.0, rate_limit_chance=0.0, retry_after=0.05, seed=None, first_id=FIRST_SNOWFLAKE):
+        self.latency = latency # seconds each REST call takes
+        self.rate_limit_chance = rate_limit_chance # chance a REST call is answered with a 429 first
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.ids = itertools.count(first_id) # IDs for new fake objects (start above any real IDs they sit alongside)
+        self.guilds = {}
+        self.channels = {}
+        self.users = {}
+        self.emojis = {}
+        self.rest_calls = collections.Counter() # (route kind, description) -> calls, including rate limited tries
+        self.rate_limited = 0
+        self.sent_message_ids = {} # channel_id -> deque of IDs to give the messages we send there (to match a recorded run)
+        self.bot_user = FakeUser(self, self.next_id(), "wager-bot", bot=True)
+        self.users[self.bot_user.id] = self.bot_user
+
+    def next_id(self):
+        return next(self.ids)
+
+    # the ID for a message the bot is sending to a channel
+    def message_id_for(self, channel):
+        ids = self.sent_message_ids.get(channel.id)
+        if ids:
+            return ids.popleft()
+        return self.next_id()
+
+    # -- building the fake world --
+
+    def add_guild(self, name, emoji_names=(), guild_id=None):
+        guild = FakeGuild(self, guild_id or self.next_id(), name)
+        for emoji_name in emoji_names:
+            emoji = FakeEmoji(self.next_id(), emoji_name)
+            guild.emojis.append(emoji)
+            self.emojis[emoji.id] = emoji
+        self.guilds[guild.id] = guild
+        return guild
+
+    def add_channel(self, guild, channel_id=None):
+        return FakeChannel(self, channel_id or self.next_id(), guild)
+
+    def add_member(self, guild, user_id=None, name=None):
+        user_id = user_id or self.next_id()
+        member = FakeMember(self, user_id, name or f"user{user_id}", guild)
+        guild.members[user_id] = member
+        self.users.setdefault(user_id, member)
+        return member
+
+    # point a discord.py bot's cache lookups at this fake
+    def install(self, bot):
+        bot.get_channel = lambda channel_id: self.channels.get(channel_id)
+        bot.get_user = lambda user_id: self.users.get(user_id)
+        bot.get_guild = lambda guild_id: self.guilds.get(guild_id)
+        bot.get_emoji = lambda emoji_id: self.emojis.get(emoji_id)
+        bot.fetch_user = self.fetch_user
+        bot._connection.user = self.bot_user
+
+    async def fetch_user(self, user_id):
+        await self.rest(("user", user_id), "fetch user")
+        if user_id not in self.users:
+            raise discord.NotFound(FakeResponse(404, "Not Found"), "Unknown User")
+        return self.users[user_id]
+
+    # -- gateway events --
+
+    # a user reacts to a message (or takes their reaction back); returns the raw event payload the gateway would send
+    # (reactions added in a guild carry the reacting member, as they do from discord)
+    def reaction_payload(self, message, user_id, emoji, added=True):
+        message.react(emoji, user_id, added)
+        guild = message.channel.guild
+        return types.SimpleNamespace(
+            message_id=message.id,
+            channel_id=message.channel.id,
+            guild_id=guild.id if guild else None,
+            user_id=user_id,
+            emoji=emoji,
+            member=guild.get_member(user_id) if guild and added else None,
+        )
+
+    # -- the simulated REST API --
+
+    # make one REST call on a route: wait out the latency, and any simulated 429 first (as discord.py's HTTP client does)
+    async def rest(self, route, description):
+        self.rest_calls[(route[0], description)] += 1
+        if self.rate_limit_chance and self.random.random() < self.rate_limit_chance:
+            self.rate_limited += 1
+            await asyncio.sleep(self.latency + self.retry_after)
+            self.rest_calls[(route[0], description)] += 1
+        await asyncio.sleep(self.latency)
+
+    def total_rest_calls(self):
+        return sum(self.rest_calls.values())
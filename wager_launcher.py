@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+import time
+from dotenv import load_dotenv
+
+# run the bot as several worker processes that split the shards between them, all sharing one database
+# WORKER_PROCESSES sets how many processes to run, SHARD_COUNT how many shards in total (defaults to one per process)
+# each worker runs wager_commands.py with SHARD_COUNT and its own SHARD_IDS; a worker that dies is restarted
+# if METRICS_PORT is set, worker N serves its metrics on METRICS_PORT + N
+
+# how long to wait before restarting a worker that exited
+RESTART_DELAY = 10
+
+# split shard IDs 0..shard_count-1 between workers, round robin
+def split_shards(shard_count, worker_count):
+    return [list(range(worker, shard_count, worker_count)) for worker in range(worker_count)]
+
+# start one worker process running the given shards
+def start_worker(shard_count, shard_ids, worker):
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(str(shard_id) for shard_id in shard_ids))
+    if os.getenv("METRICS_PORT"):
+        env["METRICS_PORT"] = str(int(os.getenv("METRICS_PORT")) + worker)
+    return subprocess.Popen([sys.executable, "wager_commands.py"], env=env)
+
+def main():
+    load_dotenv()
+    worker_count = int(os.getenv("WORKER_PROCESSES", "1"))
+    shard_count = int(os.getenv("SHARD_COUNT", str(worker_count)))
+    worker_count = min(worker_count, shard_count)
+
+    # create tables and apply migrations once, before any worker touches the database
+    import wager_models
+
+    workers = {}
+    for worker, shard_ids in enumerate(split_shards(shard_count, worker_count)):
+        workers[tuple(shard_ids)] = start_worker(shard_count, shard_ids, worker)
+    try:
+        while True:
+            time.sleep(RESTART_DELAY)
+            for index, (shard_ids, worker) in enumerate(workers.items()):
+                if worker.poll() is not None:
+                    print(f"Worker for shards {list(shard_ids)} exited with code {worker.returncode}; restarting")
+                    workers[shard_ids] = start_worker(shard_count, list(shard_ids), index)
+    except KeyboardInterrupt:
+        for worker in workers.values():
+            worker.terminate()
+        for worker in workers.values():
+            worker.wait()
+
+if __name__ == "__main__":
+    main()
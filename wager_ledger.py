@@ -0,0 +1,133 @@
+import datetime
+import uuid
+from sqlalchemy import func, select, literal, null, cast, exists, and_, insert, DateTime, Integer, BigInteger
+from wager_models import LedgerEntry, BalanceSnapshot, User
+
+# double-entry bookkeeping for every money movement: each transaction is a set of ledger entries that sums to zero
+# entries are written in the same DB transaction as the balance change they record, and are never updated or deleted
+
+# accounts
+AVAILABLE = "available"
+HELD = "held"
+TREASURY = "treasury"
+
+# kinds of entry
+STARTING = "starting"
+STIPEND = "stipend"
+HOLD = "hold"
+RELEASE = "release"
+WIN = "win"
+LOSS = "loss"
+OPENING = "opening" # balances users already had when the ledger was introduced
+
+ENTRY_COLUMNS = ["txn", "guild_id", "user_id", "account", "amount", "kind", "wager_id", "created_at"]
+
+# build one leg of a transaction
+def entry(guild_id, user_id, account, amount, kind, wager_id=None, pool_id=None):
+    return {"guild_id": guild_id, "user_id": user_id, "account": account, "amount": amount, "kind": kind, "wager_id": wager_id,
+        "pool_id": pool_id}
+
+# starting money for a new account, paid out of the guild's treasury
+def starting_money(guild_id, user_id, amount):
+    return [
+        entry(guild_id, None, TREASURY, -amount, STARTING),
+        entry(guild_id, user_id, AVAILABLE, amount, STARTING),
+    ]
+
+# money put on hold for a wager the user created or took (or a stake in a pool)
+def hold(guild_id, user_id, amount, wager_id, pool_id=None):
+    return [
+        entry(guild_id, user_id, AVAILABLE, -amount, HOLD, wager_id, pool_id),
+        entry(guild_id, user_id, HELD, amount, HOLD, wager_id, pool_id),
+    ]
+
+# held money given back when a wager (or pool) is canceled or settled
+def release(guild_id, user_id, amount, wager_id, pool_id=None):
+    return [
+        entry(guild_id, user_id, HELD, -amount, RELEASE, wager_id, pool_id),
+        entry(guild_id, user_id, AVAILABLE, amount, RELEASE, wager_id, pool_id),
+    ]
+
+# settle a wager: release both sides' held money, then move the stake from the loser to the winner
+def settle(guild_id, winner_id, loser_id, amount, wager_id):
+    return release(guild_id, winner_id, amount, wager_id) + release(guild_id, loser_id, amount, wager_id) + [
+        entry(guild_id, loser_id, AVAILABLE, -amount, LOSS, wager_id),
+        entry(guild_id, winner_id, AVAILABLE, amount, WIN, wager_id),
+    ]
+
+# settle a pool: release every stake, then move the losers' stakes to the winners, {user_id: (stake, net)} (net being what
+# they won, or minus what they lost)
+def settle_pool(guild_id, results, pool_id):
+    entries = []
+    for user_id, (stake, net) in results.items():
+        entries += release(guild_id, user_id, stake, None, pool_id)
+        if net:
+            entries.append(entry(guild_id, user_id, AVAILABLE, net, WIN if net > 0 else LOSS, None, pool_id))
+    return entries
+
+# append entries to the ledger as one transaction, with a single multi-row INSERT
+# raises ValueError if the entries don't balance in every guild they touch
+def post(session, entries):
+    if not entries:
+        return
+    totals = {}
+    for leg in entries:
+        totals[leg["guild_id"]] = totals.get(leg["guild_id"], 0) + leg["amount"]
+    unbalanced = [guild_id for guild_id, total in totals.items() if total != 0]
+    if unbalanced:
+        raise ValueError(f"Ledger transaction doesn't balance in guild(s) {unbalanced}")
+    txn = uuid.uuid4().hex
+    now = datetime.datetime.now()
+    session.execute(insert(LedgerEntry), [dict(leg, txn=txn, created_at=now) for leg in entries])
+
+# record a stipend paid to every user out of their guild's treasury, with two INSERT ... SELECTs however many users there are
+# (the NULLs are typed, since PostgreSQL would otherwise take a bare NULL in a SELECT list to be text)
+def post_stipend(session, amount):
+    txn = literal(uuid.uuid4().hex)
+    now = literal(datetime.datetime.now(), DateTime)
+    no_user = cast(null(), BigInteger)
+    no_wager = cast(null(), Integer)
+    credits = select(txn, User.guild_id, User.id, literal(AVAILABLE), literal(amount), literal(STIPEND), no_wager, now)
+    debits = select(txn, User.guild_id, no_user, literal(TREASURY), literal(-amount) * func.count(), literal(STIPEND), no_wager, now) \
+        .group_by(User.guild_id)
+    session.execute(insert(LedgerEntry).from_select(ENTRY_COLUMNS, credits))
+    session.execute(insert(LedgerEntry).from_select(ENTRY_COLUMNS, debits))
+
+# -- snapshots --
+
+# snapshot the balance of every user whose ledger has moved since the last snapshot (runs on the DB thread as a scheduled job)
+# balances come from the user table, which is updated in the same transactions as the ledger, so the two always agree here
+def take_snapshots(session):
+    last_entry_id = session.query(func.max(LedgerEntry.id)).scalar()
+    previous_entry_id = session.query(func.max(BalanceSnapshot.last_entry_id)).scalar() or 0
+    if last_entry_id is None or last_entry_id <= previous_entry_id:
+        return
+    moved = exists().where(and_(
+        LedgerEntry.guild_id == User.guild_id,
+        LedgerEntry.user_id == User.id,
+        LedgerEntry.id > previous_entry_id,
+        LedgerEntry.id <= last_entry_id,
+    ))
+    balances = select(User.guild_id, User.id, literal(last_entry_id), User.money, User.escrow, literal(datetime.datetime.now(), DateTime)) \
+        .where(moved)
+    session.execute(insert(BalanceSnapshot).from_select(["guild_id", "user_id", "last_entry_id", "money", "escrow", "taken_at"], balances))
+
+# get a user's (money, escrow) in a guild as of a point in time, or None if they had no account yet
+# starts from the latest snapshot taken by then and adds up the ledger entries after it
+def balance_at(session, guild_id, user_id, at):
+    snapshot = session.query(BalanceSnapshot) \
+        .filter(BalanceSnapshot.guild_id == guild_id, BalanceSnapshot.user_id == user_id, BalanceSnapshot.taken_at <= at) \
+        .order_by(BalanceSnapshot.taken_at.desc(), BalanceSnapshot.id.desc()) \
+        .first()
+    money, escrow, after_id = (snapshot.money, snapshot.escrow, snapshot.last_entry_id) if snapshot else (0, 0, 0)
+    tail = session.query(LedgerEntry.account, func.sum(LedgerEntry.amount)) \
+        .filter(LedgerEntry.guild_id == guild_id, LedgerEntry.user_id == user_id, LedgerEntry.id > after_id, LedgerEntry.created_at <= at) \
+        .group_by(LedgerEntry.account) \
+        .all()
+    if snapshot is None and not tail:
+        return None
+    for account, amount in tail:
+        money += amount
+        if account == HELD:
+            escrow += amount
+    return money, escrow
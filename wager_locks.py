@@ -0,0 +1,32 @@
+import asyncio
+import contextlib
+
+# async locks keyed by an ID (e.g. a wager's message ID), so events for the same wager run one at a time
+# while events for different wagers still run in parallel; a key's lock is evicted once nobody holds or waits on it
+class KeyedLock:
+    def __init__(self):
+        self.locks = {} # key -> [lock, number of holders + waiters]
+
+    # hold the lock for a key for the duration of an `async with` block
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    # hold the locks for several keys at once, for changes that touch many of them together (e.g. canceling a batch of wagers)
+    # they're taken in sorted order, so two holders of overlapping sets can't deadlock (a single hold() never waits on a second key)
+    @contextlib.asynccontextmanager
+    async def hold_all(self, keys):
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self.hold(key))
+            yield
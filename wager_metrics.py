@@ -0,0 +1,271 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import time
+import discord
+from sqlalchemy import event
+
+logger = logging.getLogger('discord')
+
+# in-process runtime metrics: latency histograms for every command and event handler, the DB queries (and query time)
+# each handler caused, outbound REST calls by route, and cache hit rates
+# they're served in Prometheus' text format from a local HTTP endpoint, and summarized by the owner-only !botstats
+
+# histogram bucket upper bounds, in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# the usage of the handler running in the current task; wager_db.run carries it over to the DB thread
+current_usage = contextvars.ContextVar("current_usage", default=None)
+
+# a latency histogram with fixed buckets, like a Prometheus histogram
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last count is for values over the largest bucket
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    # estimate the q-th quantile (0-1) as the upper bound of the bucket it falls in (None past the largest bucket)
+    def quantile(self, q):
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return None
+
+# what one handler invocation did: the DB queries it ran and the time they took, and whether it failed
+# (commands report errors to on_command_error rather than raising, so they set failed themselves)
+class HandlerUsage:
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.failed = False
+
+# running totals for one handler
+class HandlerStats:
+    def __init__(self):
+        self.latency = Histogram()
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.errors = 0
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.handlers = {} # (kind, name) -> HandlerStats, kind being "command" or "event"
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rest = {} # (method, route path) -> Histogram
+        self.rest_results = {} # (method, route path, status) -> count
+        self.caches = {} # name -> cache with hits and misses counters
+        self.readings = {} # name -> (metric type, help, function returning the current value)
+        self.server = None
+
+    # -- collecting --
+
+    # time a handler and count the DB queries it causes, e.g. `with metrics.track("event", "on_raw_reaction_add"):`
+    @contextlib.contextmanager
+    def track(self, kind, name):
+        usage = HandlerUsage()
+        token = current_usage.set(usage)
+        start = time.perf_counter()
+        failed = False
+        try:
+            yield usage
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            current_usage.reset(token)
+            stats = self.handlers.get((kind, name))
+            if stats is None:
+                stats = self.handlers[(kind, name)] = HandlerStats()
+            stats.latency.observe(elapsed)
+            stats.queries += usage.queries
+            stats.query_seconds += usage.query_seconds
+            if failed or usage.failed:
+                stats.errors += 1
+
+    # decorate an event handler so it's tracked under its own name
+    def tracked_event(self, func):
+        async def wrapper(*args, **kwargs):
+            with self.track("event", func.__name__):
+                return await func(*args, **kwargs)
+        wrapper.__name__ = func.__name__
+        wrapper.__qualname__ = func.__qualname__
+        return wrapper
+
+    # count every query an engine runs, and charge it to the handler that caused it (if any)
+    def instrument_engine(self, engine):
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info["query_started"].pop()
+            self.queries += 1
+            self.query_seconds += elapsed
+            usage = current_usage.get()
+            if usage is not None:
+                usage.queries += 1
+                usage.query_seconds += elapsed
+        event.listen(engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+    # time every REST call discord.py makes, by method and route (e.g. PATCH /channels/{channel_id}/messages/{message_id})
+    # the time includes any waiting out of rate limits that discord.py does for the call
+    def instrument_http(self, http):
+        request = http.request
+        async def timed_request(route, **kwargs):
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = await request(route, **kwargs)
+                status = "ok"
+                return result
+            except discord.HTTPException as error:
+                status = str(error.status)
+                raise
+            finally:
+                self.record_rest(route.method, route.path, status, time.perf_counter() - start)
+        http.request = timed_request
+
+    def record_rest(self, method, path, status, elapsed):
+        histogram = self.rest.get((method, path))
+        if histogram is None:
+            histogram = self.rest[(method, path)] = Histogram()
+        histogram.observe(elapsed)
+        key = (method, path, status)
+        self.rest_results[key] = self.rest_results.get(key, 0) + 1
+
+    # report a cache's hits and misses counters
+    def add_cache(self, name, cache):
+        self.caches[name] = cache
+
+    # report a value that's read when metrics are collected (e.g. a queue's length)
+    def add_gauge(self, name, help_text, read):
+        self.readings[name] = ("gauge", help_text, read)
+
+    # report a count kept elsewhere (e.g. by wager_db's group committer)
+    def add_counter(self, name, help_text, read):
+        self.readings[name] = ("counter", help_text, read)
+
+    # -- reporting --
+
+    # render every metric in the Prometheus text exposition format
+    def render(self):
+        lines = []
+        def header(name, metric_type, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+        def histogram(name, labels, histogram):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.sum}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+
+        header("wager_uptime_seconds", "gauge", "Seconds since the bot process started")
+        lines.append(f"wager_uptime_seconds {time.time() - self.started}")
+
+        handlers = sorted(self.handlers.items())
+        header("wager_handler_seconds", "histogram", "Time to handle a command or gateway event")
+        for (kind, name), stats in handlers:
+            histogram("wager_handler_seconds", f'kind="{kind}",name="{escape(name)}"', stats.latency)
+        header("wager_handler_errors_total", "counter", "Handler invocations that raised")
+        for (kind, name), stats in handlers:
+            lines.append(f'wager_handler_errors_total{{kind="{kind}",name="{escape(name)}"}} {stats.errors}')
+        header("wager_handler_db_queries_total", "counter", "DB queries run on behalf of a handler")
+        for (kind, name), stats in handlers:
+            lines.append(f'wager_handler_db_queries_total{{kind="{kind}",name="{escape(name)}"}} {stats.queries}')
+        header("wager_handler_db_seconds_total", "counter", "Time spent in DB queries run on behalf of a handler")
+        for (kind, name), stats in handlers:
+            lines.append(f'wager_handler_db_seconds_total{{kind="{kind}",name="{escape(name)}"}} {stats.query_seconds}')
+
+        header("wager_db_queries_total", "counter", "DB queries run")
+        lines.append(f"wager_db_queries_total {self.queries}")
+        header("wager_db_query_seconds_total", "counter", "Time spent in DB queries")
+        lines.append(f"wager_db_query_seconds_total {self.query_seconds}")
+
+        header("wager_rest_seconds", "histogram", "Time taken by outbound discord REST calls, including rate limit waits")
+        for (method, path), latency in sorted(self.rest.items()):
+            histogram("wager_rest_seconds", f'method="{method}",route="{escape(path)}"', latency)
+        header("wager_rest_requests_total", "counter", "Outbound discord REST calls by result (ok, an HTTP status, or error)")
+        for (method, path, status), count in sorted(self.rest_results.items()):
+            lines.append(f'wager_rest_requests_total{{method="{method}",route="{escape(path)}",status="{status}"}} {count}')
+
+        header("wager_cache_lookups_total", "counter", "In-process cache lookups by result")
+        for name, cache in sorted(self.caches.items()):
+            lines.append(f'wager_cache_lookups_total{{cache="{name}",result="hit"}} {cache.hits}')
+            lines.append(f'wager_cache_lookups_total{{cache="{name}",result="miss"}} {cache.misses}')
+
+        for name, (metric_type, help_text, read) in sorted(self.readings.items()):
+            header(name, metric_type, help_text)
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    # a short plain-text summary for !botstats: the busiest handlers, REST routes and cache hit rates
+    def summary(self, limit=10):
+        uptime = int(time.time() - self.started)
+        lines = [f"Uptime {uptime // 3600}h{uptime % 3600 // 60:02d}m, {self.queries} DB queries ({self.query_seconds:.1f}s)", ""]
+        lines.append(f"{'handler':<28}{'calls':>7}{'avg ms':>8}{'p99 ms':>8}{'q/call':>7}{'errs':>5}")
+        busiest = sorted(self.handlers.items(), key=lambda item: item[1].latency.sum, reverse=True)[:limit]
+        for (kind, name), stats in busiest:
+            calls = stats.latency.count
+            p99 = stats.latency.quantile(0.99)
+            p99 = f"{p99 * 1000:.0f}" if p99 is not None else ">10000"
+            lines.append(f"{name[:27]:<28}{calls:>7}{stats.latency.sum / calls * 1000:>8.1f}{p99:>8}{stats.queries / calls:>7.1f}{stats.errors:>5}")
+        lines.append("")
+        lines.append(f"{'REST route':<50}{'calls':>7}{'avg ms':>8}")
+        for (method, path), latency in sorted(self.rest.items(), key=lambda item: item[1].count, reverse=True)[:limit]:
+            lines.append(f"{(method + ' ' + path)[:49]:<50}{latency.count:>7}{latency.sum / latency.count * 1000:>8.1f}")
+        lines.append("")
+        for name, cache in sorted(self.caches.items()):
+            lookups = cache.hits + cache.misses
+            rate = f"{cache.hits / lookups:.1%}" if lookups else "-"
+            lines.append(f"{name} cache: {rate} hits of {lookups} lookups")
+        return "\n".join(lines)
+
+    # -- serving --
+
+    # serve render() over HTTP on host:port for Prometheus to scrape (safe to call more than once)
+    async def serve(self, host, port):
+        if self.server is not None:
+            return
+        self.server = await asyncio.start_server(self.handle_scrape, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+
+    # answer any GET with the current metrics; there's only one thing to serve, so the path isn't checked
+    async def handle_scrape(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in [b"\r\n", b"\n", b""]: # skip the headers
+                pass
+            if request_line.startswith(b"GET "):
+                body = self.render().encode("utf-8")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n")
+            else:
+                body = b"Method Not Allowed\n"
+                writer.write(b"HTTP/1.1 405 Method Not Allowed\r\nContent-Type: text/plain\r\n")
+            writer.write(f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+# escape a label value for the Prometheus text format
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
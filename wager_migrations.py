@@ -0,0 +1,291 @@
+import argparse
+import datetime
+import os
+import sys
+from sqlalchemy import text, inspect, bindparam, DateTime
+
+# versioned schema changes that Base.metadata.create_all can't make on an existing database (indexes, new columns)
+# add a column to an existing table, unless create_all already built the table with it
+def add_column(connection, table, column, definition):
+    if column in [existing["name"] for existing in inspect(connection).get_columns(table)]:
+        return
+    connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {definition}'))
+
+# add the user escrow column and fill it from each user's incomplete wagers
+def add_user_escrow(connection):
+    add_column(connection, "user", "escrow", "INTEGER NOT NULL DEFAULT 0")
+    connection.execute(text(ESCROW_BACKFILL))
+
+# give every guild its own economy: re-key users by (guild_id, id), with one account per guild they've wagered in
+# each of those accounts starts from the user's old (shared) balance, with escrow recomputed from that guild's wagers; this
+# deliberately creates money (a user with a balance of B who wagered in three guilds ends up with 3B across them), since
+# the old balance can't be traced back to the guilds it was won in, and splitting it would leave every account short of
+# what the user had; each guild's economy only ever sees one copy of it
+# users who never wagered have no guild to put them in and are dropped, balance and all: they get a fresh account with the
+# starting money the next time they use the bot in a guild
+# IDs are discord snowflakes, so they're BIGINT (as in the models; INTEGER is 32-bit on PostgreSQL)
+def split_users_by_guild(connection):
+    if "guild_id" in [existing["name"] for existing in inspect(connection).get_columns("user")]:
+        return
+    connection.execute(text('''
+        CREATE TABLE user_by_guild (
+            guild_id BIGINT NOT NULL,
+            id BIGINT NOT NULL,
+            money INTEGER,
+            escrow INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, id)
+        )
+    '''))
+    connection.execute(text('''
+        INSERT INTO user_by_guild (guild_id, id, money, escrow)
+        SELECT members.guild_id, "user".id, "user".money, 0
+        FROM "user" JOIN (
+            SELECT guild_id, creator_id AS user_id FROM wager WHERE guild_id IS NOT NULL
+            UNION
+            SELECT guild_id, taker_id AS user_id FROM wager WHERE guild_id IS NOT NULL AND taker_id IS NOT NULL
+        ) members ON members.user_id = "user".id
+    '''))
+    connection.execute(text('''
+        UPDATE user_by_guild SET escrow = (
+            SELECT COALESCE(SUM(wager.amount), 0) FROM wager
+            WHERE NOT wager.completed AND wager.guild_id = user_by_guild.guild_id
+            AND (wager.creator_id = user_by_guild.id OR wager.taker_id = user_by_guild.id)
+        )
+    '''))
+    connection.execute(text('DROP TABLE "user"'))
+    connection.execute(text('ALTER TABLE user_by_guild RENAME TO "user"'))
+
+# open the ledger with the balances users already have: their available and held money, paid out of each guild's treasury
+# skipped if the ledger already has entries (e.g. on a fresh database, where users only appear once the ledger exists)
+def open_ledger(connection):
+    if connection.execute(text("SELECT COUNT(*) FROM ledger")).scalar():
+        return
+    connection.execute(text('''
+        INSERT INTO ledger (txn, guild_id, user_id, account, amount, kind, created_at)
+        SELECT 'opening', guild_id, id, 'available', money - escrow, 'opening', (:now) FROM "user"
+        UNION ALL
+        SELECT 'opening', guild_id, id, 'held', escrow, 'opening', (:now) FROM "user" WHERE escrow != 0
+        UNION ALL
+        SELECT 'opening', guild_id, NULL, 'treasury', -SUM(money), 'opening', (:now) FROM "user" GROUP BY guild_id
+    ''').bindparams(bindparam("now", datetime.datetime.now(), type_=DateTime)))
+
+# build every user's settled-wager stats by replaying completed wagers in order (so streaks come out right)
+# skipped if the stats table already has rows (e.g. on a fresh database, where they're kept up to date from the start)
+def backfill_user_stats(connection):
+    if connection.execute(text("SELECT COUNT(*) FROM user_stats")).scalar():
+        return
+    stats = {} # (guild_id, user_id) -> [wins, losses, total_wagered, net, biggest_win, streak]
+    results = connection.execute(text('''
+        SELECT guild_id, winner_id, loser_id, amount FROM wager
+        WHERE completed AND guild_id IS NOT NULL AND winner_id IS NOT NULL AND loser_id IS NOT NULL
+        ORDER BY id
+    '''))
+    for guild_id, winner_id, loser_id, amount in results:
+        for user_id, won in [(winner_id, True), (loser_id, False)]:
+            wins, losses, total_wagered, net, biggest_win, streak = stats.get((guild_id, user_id), [0, 0, 0, 0, 0, 0])
+            if won:
+                stats[(guild_id, user_id)] = [wins + 1, losses, total_wagered + amount, net + amount, max(biggest_win, amount), max(streak, 0) + 1]
+            else:
+                stats[(guild_id, user_id)] = [wins, losses + 1, total_wagered + amount, net - amount, biggest_win, min(streak, 0) - 1]
+    if not stats:
+        return
+    connection.execute(text('''
+        INSERT INTO user_stats (guild_id, user_id, wins, losses, total_wagered, net, biggest_win, streak)
+        VALUES (:guild_id, :user_id, :wins, :losses, :total_wagered, :net, :biggest_win, :streak)
+    '''), [
+        {"guild_id": guild_id, "user_id": user_id, "wins": wins, "losses": losses, "total_wagered": total_wagered,
+         "net": net, "biggest_win": biggest_win, "streak": streak}
+        for (guild_id, user_id), (wins, losses, total_wagered, net, biggest_win, streak) in stats.items()
+    ])
+
+# give wagers real timestamps: created_at was a string fixed when the bot started (not a timestamp per wager), and accepted_at is new
+# incomplete wagers get the time of the upgrade for both, so the expiry sweeper gives them a full TTL instead of guessing
+def timestamp_wagers(connection):
+    add_column(connection, "wager", "accepted_at", "TIMESTAMP")
+    created_at = [column for column in inspect(connection).get_columns("wager") if column["name"] == "created_at"][0]
+    if connection.dialect.name != "sqlite" and not isinstance(created_at["type"], DateTime): # SQLite doesn't enforce column types
+        connection.execute(text("ALTER TABLE wager ALTER COLUMN created_at TYPE TIMESTAMP USING created_at::timestamp"))
+    now = bindparam("now", datetime.datetime.now(), type_=DateTime)
+    connection.execute(text("UPDATE wager SET created_at = (:now) WHERE NOT completed").bindparams(now))
+    connection.execute(text("UPDATE wager SET accepted_at = (:now) WHERE accepted AND NOT completed").bindparams(now))
+
+# record when wagers are completed; ones completed before this is left NULL, and are treated as old enough to archive
+def add_wager_completed_at(connection):
+    add_column(connection, "wager", "completed_at", "TIMESTAMP")
+
+# tag ledger entries with the pool wager they moved money for (the pool tables themselves are new, so create_all makes them)
+def add_ledger_pool_id(connection):
+    add_column(connection, "ledger", "pool_id", "INTEGER")
+
+# rebuild a SQLite table with AUTOINCREMENT, so IDs that have been used are never handed out again (without it SQLite gives new
+# rows max(id) + 1, which reuses the ID of the newest row whenever it's deleted or archived), and start its ID sequence after
+# every ID already used for it, in it or in the ledger; other databases' sequences never go backwards, so there's nothing to do
+# the table is written out as it stood at the migration's version (not from the model), following SQLite's create, copy, drop,
+# rename recipe; id_sources are (table, column) pairs of IDs already handed out
+def rebuild_with_autoincrement(connection, table, columns, constraints, indexed, id_sources):
+    if connection.dialect.name != "sqlite":
+        return
+    table_sql = connection.execute(text(f"SELECT sql FROM sqlite_master WHERE type = 'table' AND name = '{table}'")).scalar()
+    if "AUTOINCREMENT" in table_sql.upper(): # a fresh database, which create_all built with it
+        return
+    definition = ",\n".join(["id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT"] + [f"{name} {type_}" for name, type_ in columns] + constraints)
+    connection.execute(text(f"CREATE TABLE {table}_autoincrement ({definition})"))
+    names = ", ".join(["id"] + [name for name, type_ in columns])
+    connection.execute(text(f"INSERT INTO {table}_autoincrement ({names}) SELECT {names} FROM {table}"))
+    connection.execute(text(f"DROP TABLE {table}"))
+    connection.execute(text(f"ALTER TABLE {table}_autoincrement RENAME TO {table}"))
+    for column in indexed:
+        connection.execute(text(f"CREATE INDEX ix_{table}_{column} ON {table} ({column})"))
+    used = " UNION ALL ".join(f"SELECT {column} AS id FROM {source}" for source, column in [(table, "id")] + id_sources)
+    connection.execute(text(f"DELETE FROM sqlite_sequence WHERE name = '{table}'"))
+    connection.execute(text(f"INSERT INTO sqlite_sequence (name, seq) SELECT '{table}', COALESCE(MAX(id), 0) FROM ({used})"))
+
+# never reuse a wager's ID once it's been archived, canceled or expired (see rebuild_with_autoincrement)
+def autoincrement_wager_ids(connection):
+    rebuild_with_autoincrement(connection, "wager", [
+        ("guild_id", "BIGINT"), ("channel_id", "BIGINT"), ("message_id", "BIGINT"), ("creator_id", "BIGINT"),
+        ("amount", "INTEGER"), ("description", "VARCHAR"), ("created_at", "DATETIME"), ("accepted_at", "DATETIME"),
+        ("taker_id", "BIGINT"), ("accepted", "BOOLEAN NOT NULL"), ("completed", "BOOLEAN NOT NULL"), ("winner_id", "BIGINT"),
+        ("loser_id", "BIGINT"), ("completed_at", "DATETIME"),
+    ], [
+        'FOREIGN KEY(guild_id, creator_id) REFERENCES "user" (guild_id, id)',
+        'FOREIGN KEY(guild_id, taker_id) REFERENCES "user" (guild_id, id)',
+        'FOREIGN KEY(guild_id, winner_id) REFERENCES "user" (guild_id, id)',
+        'FOREIGN KEY(guild_id, loser_id) REFERENCES "user" (guild_id, id)',
+    ], ["message_id", "creator_id", "taker_id", "completed"], [("wager_archive", "id"), ("ledger", "wager_id")])
+
+# never reuse a pool's ID once it's been canceled or expired (see rebuild_with_autoincrement)
+def autoincrement_pool_ids(connection):
+    rebuild_with_autoincrement(connection, "pool", [
+        ("guild_id", "BIGINT"), ("channel_id", "BIGINT"), ("message_id", "BIGINT"), ("creator_id", "BIGINT"),
+        ("amount", "INTEGER"), ("description", "VARCHAR"), ("outcomes", "VARCHAR NOT NULL"), ("created_at", "DATETIME"),
+        ("completed", "BOOLEAN NOT NULL"), ("winning_outcome", "INTEGER"), ("completed_at", "DATETIME"),
+    ], [
+        'FOREIGN KEY(guild_id, creator_id) REFERENCES "user" (guild_id, id)',
+    ], ["message_id", "creator_id", "completed"], [("ledger", "pool_id")])
+
+ESCROW_BACKFILL = '''
+    UPDATE "user" SET escrow = (
+        SELECT COALESCE(SUM(wager.amount), 0) FROM wager
+        WHERE NOT wager.completed AND (wager.creator_id = "user".id OR wager.taker_id = "user".id)
+    )
+'''
+
+# each migration is a (version, description, steps) tuple; they're applied in order and the version is recorded in schema_version
+# a step is either a SQL statement or a function taking the connection
+# steps must be safe to run against a freshly created schema too, since create_all already builds the current models
+MIGRATIONS = [
+    (1, "index wager lookups by message, creator, taker and completion", [
+        "CREATE INDEX IF NOT EXISTS ix_wager_message_id ON wager (message_id)",
+        "CREATE INDEX IF NOT EXISTS ix_wager_creator_id ON wager (creator_id)",
+        "CREATE INDEX IF NOT EXISTS ix_wager_taker_id ON wager (taker_id)",
+        "CREATE INDEX IF NOT EXISTS ix_wager_completed ON wager (completed)",
+    ]),
+    (2, "track escrowed money on each user", [
+        add_user_escrow,
+    ]),
+    (3, "give each guild its own economy", [
+        split_users_by_guild,
+    ]),
+    (4, "open the money ledger with existing balances", [
+        open_ledger,
+    ]),
+    (5, "build per-user wager stats from completed wagers", [
+        backfill_user_stats,
+    ]),
+    (6, "timestamp wager creation and acceptance", [
+        timestamp_wagers,
+    ]),
+    (7, "timestamp wager completion, for archiving", [
+        add_wager_completed_at,
+    ]),
+    (8, "tag ledger entries with their pool wager", [
+        add_ledger_pool_id,
+    ]),
+    (9, "never reuse the IDs of archived wagers", [
+        autoincrement_wager_ids,
+    ]),
+    (10, "never reuse the IDs of canceled or expired pools", [
+        autoincrement_pool_ids,
+    ]),
+]
+
+# get the schema version recorded in the database (0 if no migrations have been applied)
+def current_version(connection):
+    connection.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+    version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+# apply any migrations newer than the database's schema version (up to target, if given), each in its own transaction
+# returns the (version, description) of each migration applied
+def migrate(engine, target=None):
+    with engine.begin() as connection:
+        version = current_version(connection)
+    applied = []
+    for migration_version, description, steps in MIGRATIONS:
+        if migration_version <= version or (target is not None and migration_version > target):
+            continue
+        with engine.begin() as connection:
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(text(step))
+            connection.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": migration_version})
+        applied.append((migration_version, description))
+    return applied
+
+# list the tables, columns and indexes the models define that the database doesn't have
+# (anything listed needs a migration: create_all only creates missing tables, never alters existing ones)
+def find_schema_drift(engine, metadata):
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    drift = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            drift.append(f"missing table {table.name}")
+            continue
+        columns = {column["name"] for column in inspector.get_columns(table.name)}
+        drift += [f"missing column {table.name}.{column.name}" for column in table.columns if column.name not in columns]
+        indexes = {index["name"] for index in inspector.get_indexes(table.name)}
+        drift += [f"missing index {index.name} on {table.name}" for index in table.indexes if index.name not in indexes]
+    return drift
+
+# manage the schema of the database in DATABASE_URL by hand:
+#   python wager_migrations.py status            show the schema version and any migrations waiting to be applied
+#   python wager_migrations.py upgrade [--to N]  create missing tables and apply migrations (up to version N)
+#   python wager_migrations.py verify            check the database has every table, column and index the models define
+def main():
+    parser = argparse.ArgumentParser(description="Manage the wager bot's database schema")
+    parser.add_argument("command", choices=["status", "upgrade", "verify"])
+    parser.add_argument("--to", type=int, help="with upgrade: the schema version to stop at")
+    args = parser.parse_args()
+    os.environ["AUTO_MIGRATE"] = "0" # don't let importing the models migrate the database before we're asked to
+    import wager_models
+    engine = wager_models.engine
+    print(f"Database: {engine.url.render_as_string(hide_password=True)}")
+
+    if args.command == "status":
+        with engine.begin() as connection:
+            version = current_version(connection)
+        print(f"Schema version {version} (latest is {MIGRATIONS[-1][0]})")
+        for migration_version, description, steps in MIGRATIONS:
+            if migration_version > version:
+                print(f"  pending {migration_version}: {description}")
+    elif args.command == "upgrade":
+        wager_models.Base.metadata.create_all(engine)
+        applied = migrate(engine, args.to)
+        for migration_version, description in applied:
+            print(f"Applied {migration_version}: {description}")
+        if not applied:
+            print("Nothing to apply")
+    elif args.command == "verify":
+        drift = find_schema_drift(engine, wager_models.Base.metadata)
+        for problem in drift:
+            print(problem)
+        if drift:
+            sys.exit(f"{len(drift)} difference(s) between the models and the database")
+        print("The database matches the models")
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,50 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, Table, create_engine, or_
-from sqlalchemy.orm import relationship, backref, sessionmaker
+from sqlalchemy import Column, Integer, BigInteger, String, ForeignKey, ForeignKeyConstraint, Boolean, DateTime, Index
+from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 import datetime
+import os
+import wager_migrations
+import wager_storage
+from dotenv import load_dotenv
 
-engine = create_engine('sqlite:///db.sql', echo=True)
+# the database comes from DATABASE_URL (SQLite in db.sql by default; see wager_storage.py for the settings)
+load_dotenv()
+engine = wager_storage.create_engine_from_env()
 
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
+# sessions are opened per unit of work (see wager_db); keep loaded attributes around after commit so results can leave the session
+Session = sessionmaker(bind=engine, expire_on_commit=False)
 
-session = Session()
+# discord IDs (guilds, channels, messages, users, emojis) are 64-bit snowflakes, so they're stored as BIGINT
 
 # a class representing a single wager
+# the users taking part are identified by (guild_id, user ID), since every guild has its own economy
 class Wager(Base):
     __tablename__ = "wager"
+    __table_args__ = (
+        ForeignKeyConstraint(["guild_id", "creator_id"], ["user.guild_id", "user.id"]),
+        ForeignKeyConstraint(["guild_id", "taker_id"], ["user.guild_id", "user.id"]),
+        ForeignKeyConstraint(["guild_id", "winner_id"], ["user.guild_id", "user.id"]),
+        ForeignKeyConstraint(["guild_id", "loser_id"], ["user.guild_id", "user.id"]),
+        {"sqlite_autoincrement": True}, # archived wagers keep their IDs, so SQLite mustn't hand them out again
+    )
     # Wager details
     id = Column(Integer, primary_key = True)
-    guild_id = Column(Integer) # guild is basically the same thing as server
-    channel_id = Column(Integer)
-    message_id = Column(Integer)
-    creator_id = Column(Integer, ForeignKey("user.id")) # id of user who instantiated the wager
-    creator = relationship("User", back_populates="created_wagers", foreign_keys=[creator_id]) # creator object
+    guild_id = Column(BigInteger) # guild is basically the same thing as server
+    channel_id = Column(BigInteger)
+    message_id = Column(BigInteger, index=True)
+    creator_id = Column(BigInteger, index=True) # id of user who instantiated the wager
     amount = Column(Integer)
     description = Column(String)
-    created_at = Column(String, default=datetime.datetime.now())
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    accepted_at = Column(DateTime) # when the taker accepted, so unsettled wagers can expire
     # Wager status
-    taker_id = Column(Integer, ForeignKey("user.id")) # id of user accepting wager
-    taker = relationship("User", back_populates="accepted_wagers", foreign_keys=[taker_id])
+    taker_id = Column(BigInteger, index=True) # id of user accepting wager
     accepted = Column(Boolean, default=False, nullable=False)
-    completed = Column(Boolean, default=False, nullable=False)
-    winner_id = Column(Integer, ForeignKey("user.id"))
-    winner = relationship("User", back_populates="won_wagers", foreign_keys=[winner_id])
-    loser_id = Column(Integer, ForeignKey("user.id"))
-    loser = relationship("User", back_populates="lost_wagers", foreign_keys=[loser_id])
+    completed = Column(Boolean, default=False, nullable=False, index=True)
+    winner_id = Column(BigInteger)
+    loser_id = Column(BigInteger)
+    completed_at = Column(DateTime) # when it was settled (None for wagers settled before this was tracked)
 
     def __init__(self, guild_id, channel_id, creator_id, amount, description):
         self.guild_id = guild_id
@@ -46,21 +59,97 @@ class Wager(Base):
     def accept(self, taker_id):
         self.taker_id = taker_id
         self.accepted = True
-        session.add(self)
-        session.commit()
+        self.accepted_at = datetime.datetime.now()
 
+# a completed wager moved out of the wager table once it's old enough (see wager_db.archive_wagers), so the live table only
+# holds recent and active wagers; it keeps the ID it had in the wager table, and the history views read both
+class ArchivedWager(Base):
+    __tablename__ = "wager_archive"
+    id = Column(Integer, primary_key = True, autoincrement = False)
+    guild_id = Column(BigInteger, index=True)
+    channel_id = Column(BigInteger)
+    message_id = Column(BigInteger)
+    creator_id = Column(BigInteger, index=True)
+    taker_id = Column(BigInteger, index=True)
+    amount = Column(Integer)
+    description = Column(String)
+    created_at = Column(DateTime)
+    accepted_at = Column(DateTime)
+    completed_at = Column(DateTime)
+    winner_id = Column(BigInteger)
+    loser_id = Column(BigInteger)
+    archived_at = Column(DateTime, nullable=False)
+
+# a pool (parimutuel) wager: any number of users back one of its outcomes by reacting to its message, each staking the pool's
+# amount, and when the creator names the winning outcome the whole pot is shared among its backers in proportion to their stakes
+# (see wager_db.settle_pool); the stakes are kept in pool_entry
+class Pool(Base):
+    __tablename__ = "pool"
+    __table_args__ = (
+        ForeignKeyConstraint(["guild_id", "creator_id"], ["user.guild_id", "user.id"]),
+        {"sqlite_autoincrement": True}, # canceled and expired pools are deleted, and the ledger still has their IDs
+    )
+    id = Column(Integer, primary_key = True)
+    guild_id = Column(BigInteger)
+    channel_id = Column(BigInteger)
+    message_id = Column(BigInteger, index=True)
+    creator_id = Column(BigInteger, index=True) # the user who made the pool and settles it
+    amount = Column(Integer) # the stake each entry puts in
+    description = Column(String)
+    outcomes = Column(String, nullable=False) # the outcomes users can back, one per line
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    completed = Column(Boolean, default=False, nullable=False, index=True)
+    winning_outcome = Column(Integer) # index into outcomes, once settled
+    completed_at = Column(DateTime)
+
+    def __init__(self, guild_id, channel_id, creator_id, amount, description, outcomes):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.creator_id = creator_id
+        self.amount = amount
+        self.description = description
+        self.outcomes = "\n".join(outcomes)
+
+    def __repr__(self):
+        return f'<Pool(id={self.id}, creator_id={self.creator_id}, amount={self.amount})'
+
+    def outcome_names(self):
+        return self.outcomes.split("\n")
+
+# one user's stake in a pool, on the outcome they backed (a user can only back one outcome per pool)
+class PoolEntry(Base):
+    __tablename__ = "pool_entry"
+    __table_args__ = (
+        ForeignKeyConstraint(["guild_id", "user_id"], ["user.guild_id", "user.id"]),
+        Index("ix_pool_entry_user", "guild_id", "user_id"),
+    )
+    pool_id = Column(Integer, ForeignKey("pool.id"), primary_key = True)
+    user_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    guild_id = Column(BigInteger, nullable=False)
+    outcome = Column(Integer, nullable=False) # index into the pool's outcomes
+    amount = Column(Integer, nullable=False)
+    joined_at = Column(DateTime, default=datetime.datetime.now)
+
+    def __init__(self, pool_id, guild_id, user_id, outcome, amount):
+        self.pool_id = pool_id
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.outcome = outcome
+        self.amount = amount
+
+# a user's account in one guild - each guild has its own economy, so the same discord user has a separate balance in each
 class User(Base):
     __tablename__ = "user"
-    id = Column(Integer, primary_key = True, autoincrement = False)
+    guild_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    id = Column(BigInteger, primary_key = True, autoincrement = False) # discord snowflake
     money = Column(Integer, default=0)
-    created_wagers = relationship("Wager", order_by=Wager.id, back_populates="creator", foreign_keys="[Wager.creator_id]")
-    accepted_wagers = relationship("Wager", order_by=Wager.id, back_populates="taker", foreign_keys="[Wager.taker_id]")
-    won_wagers = relationship("Wager", order_by=Wager.id, back_populates="winner", foreign_keys="[Wager.winner_id]")
-    lost_wagers = relationship("Wager", order_by=Wager.id, back_populates="loser", foreign_keys="[Wager.loser_id]")
+    escrow = Column(Integer, default=0, nullable=False) # money tied up in outstanding bets, kept up to date as wagers change
 
-    def __init__(self, snowflake_id, starting_money):
+    def __init__(self, guild_id, snowflake_id, starting_money):
+        self.guild_id = guild_id
         self.id = snowflake_id
         self.money = starting_money
+        self.escrow = 0
 
     def add_money(self, amount):
         self.money += amount
@@ -68,12 +157,17 @@ class User(Base):
     def remove_money(self, amount):
         self.money -= amount
 
+    # hold money for a bet this user created or took
+    def hold(self, amount):
+        self.escrow += amount
+
+    # release money held for a bet that was canceled or completed
+    def release(self, amount):
+        self.escrow -= amount
+
     # get the amount of money this user has outstanding in bets (created or taken bets that haven't yet been confirmed)
     def outstanding_money(self):
-        query = session.query(Wager.amount).filter(or_(Wager.creator_id == self.id, Wager.taker_id == self.id)).filter(Wager.completed == False)
-        query_results = query.all()
-        outstanding_amount = sum([wager.amount for wager in query_results])
-        return outstanding_amount
+        return self.escrow
 
     # check to see if this user can afford an action (has enough money)
     def can_afford(self, amount):
@@ -82,8 +176,8 @@ class User(Base):
 
 class Emoji(Base):
     __tablename__ = "emoji"
-    id = Column(Integer, primary_key = True, autoincrement = False)
-    guild_id = Column(Integer, nullable=False)
+    id = Column(BigInteger, primary_key = True, autoincrement = False)
+    guild_id = Column(BigInteger, nullable=False)
     name = Column(String, nullable=False)
 
     def __init__(self, emoji_id, guild_id, name):
@@ -91,4 +185,114 @@ class Emoji(Base):
         self.guild_id = guild_id
         self.name = name
 
-Base.metadata.create_all(engine)
\ No newline at end of file
+# a :wagerwin: / :wagerlose: reaction from one of a wager's participants, tracked from gateway events
+class WagerVote(Base):
+    __tablename__ = "wager_vote"
+    wager_id = Column(Integer, ForeignKey("wager.id"), primary_key = True)
+    user_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    emoji_name = Column(String, primary_key = True) # wagerwin or wagerlose
+
+    def __init__(self, wager_id, user_id, emoji_name):
+        self.wager_id = wager_id
+        self.user_id = user_id
+        self.emoji_name = emoji_name
+
+# the last time each scheduled job ran, so missed runs can be caught up after downtime
+class ScheduledJob(Base):
+    __tablename__ = "scheduled_job"
+    name = Column(String, primary_key = True)
+    last_run = Column(DateTime, nullable=False)
+
+    def __init__(self, name, last_run):
+        self.name = name
+        self.last_run = last_run
+
+# how far each guild got through its latest catch-up pass (reconciling reactions we missed while offline), so a restart
+# partway through a pass picks up from there instead of fetching every message again
+class ReconcileCheckpoint(Base):
+    __tablename__ = "reconcile_checkpoint"
+    guild_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    started_at = Column(DateTime, nullable=False)
+    last_wager_id = Column(Integer) # every wager up to this one has been reconciled (None until the first chunk is done)
+    finished_at = Column(DateTime) # None while the pass is in progress
+
+    def __init__(self, guild_id, started_at):
+        self.guild_id = guild_id
+        self.started_at = started_at
+
+# a user's settled-wager record in a guild, kept up to date when each wager is settled so !stats is a single row read
+class UserStats(Base):
+    __tablename__ = "user_stats"
+    guild_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    user_id = Column(BigInteger, primary_key = True, autoincrement = False)
+    wins = Column(Integer, default=0, nullable=False)
+    losses = Column(Integer, default=0, nullable=False)
+    total_wagered = Column(Integer, default=0, nullable=False)
+    net = Column(Integer, default=0, nullable=False) # money won minus money lost
+    biggest_win = Column(Integer, default=0, nullable=False)
+    streak = Column(Integer, default=0, nullable=False) # current run of wins (positive) or losses (negative)
+
+    def __init__(self, guild_id, user_id):
+        self.guild_id = guild_id
+        self.user_id = user_id
+        self.wins = 0
+        self.losses = 0
+        self.total_wagered = 0
+        self.net = 0
+        self.biggest_win = 0
+        self.streak = 0
+
+    # count a settled wager this user won or lost; winnings is what a win paid on top of the stake, if it isn't the stake
+    # (as in a pool, where it depends on how the pot was split)
+    def record(self, amount, won, winnings=None):
+        self.total_wagered += amount
+        if won:
+            winnings = amount if winnings is None else winnings
+            self.wins += 1
+            self.net += winnings
+            self.biggest_win = max(self.biggest_win, winnings)
+            self.streak = self.streak + 1 if self.streak > 0 else 1
+        else:
+            self.losses += 1
+            self.net -= amount
+            self.streak = self.streak - 1 if self.streak < 0 else -1
+
+# one leg of a ledger transaction: a credit (positive amount) or debit (negative amount) to one account
+# every transaction's legs sum to zero, and rows are only ever appended, so the ledger is a full audit trail of money movements
+# accounts are a user's "available" and "held" (escrowed) money in a guild, plus the guild's "treasury" (user_id is NULL),
+# which pays out starting money and stipends
+class LedgerEntry(Base):
+    __tablename__ = "ledger"
+    __table_args__ = (
+        Index("ix_ledger_account", "guild_id", "user_id", "id"),
+    )
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key = True) # SQLite only autoincrements INTEGER keys
+    txn = Column(String, nullable=False) # shared by every leg of one transaction
+    guild_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger)
+    account = Column(String, nullable=False) # available, held or treasury
+    amount = Column(Integer, nullable=False)
+    kind = Column(String, nullable=False) # starting, stipend, hold, release, win, loss or opening
+    wager_id = Column(Integer) # the wager this money moved for, if any (not a foreign key: canceled wagers are deleted)
+    pool_id = Column(Integer) # likewise for pool wagers
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.now)
+
+# a user's balance in a guild as of a ledger entry, so balances at any time only need the entries after the latest snapshot
+class BalanceSnapshot(Base):
+    __tablename__ = "balance_snapshot"
+    __table_args__ = (
+        Index("ix_balance_snapshot_account", "guild_id", "user_id", "taken_at"),
+    )
+    id = Column(Integer, primary_key = True)
+    guild_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    last_entry_id = Column(BigInteger, nullable=False) # the newest ledger entry included in this snapshot
+    money = Column(Integer, nullable=False)
+    escrow = Column(Integer, nullable=False)
+    taken_at = Column(DateTime, nullable=False)
+
+# create any missing tables and bring the schema up to date on import, unless AUTO_MIGRATE=0
+# (e.g. to apply migrations by hand with `python wager_migrations.py upgrade` before starting the bot)
+if os.getenv("AUTO_MIGRATE", "1") != "0":
+    Base.metadata.create_all(engine)
+    wager_migrations.migrate(engine)
\ No newline at end of file
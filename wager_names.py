@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import discord
+
+logger = logging.getLogger('discord')
+
+# the most members discord will look up by ID in one request
+QUERY_LIMIT = 100
+
+# resolves users' display names in a guild without needing every member cached: names come from the NameCache, then
+# discord.py's member cache (if it has the member), and the rest are asked for with guild.query_members
+# lookups that miss in the same tick are batched into one query per guild (up to QUERY_LIMIT IDs each), however many
+# handlers asked for them
+class NameResolver:
+    def __init__(self, bot, cache):
+        self.bot = bot
+        self.cache = cache
+        self.pending = {} # guild_id -> {user_id: future for their name}
+
+    # get a user's name in a guild without asking discord ("" if they aren't a member), or None if we'd have to ask
+    def cached(self, guild_id, user_id):
+        name = self.cache.get(guild_id, user_id)
+        if name is not None:
+            return name
+        guild = self.bot.get_guild(guild_id)
+        member = guild.get_member(user_id) if guild is not None else None
+        if member is None:
+            return None
+        self.cache.set(guild_id, user_id, member.display_name)
+        return member.display_name
+
+    # get {user_id: display name} for users in a guild ("" for anyone who isn't a member); None IDs are skipped
+    async def resolve(self, guild_id, user_ids):
+        names = {}
+        waiting = {}
+        for user_id in set(user_ids):
+            if user_id is None:
+                continue
+            name = self.cached(guild_id, user_id)
+            if name is not None:
+                names[user_id] = name
+            else:
+                waiting[user_id] = self.request(guild_id, user_id)
+        for user_id, name in waiting.items():
+            names[user_id] = await name
+        return names
+
+    # add a user to the guild's next member query, starting one if there isn't one waiting
+    def request(self, guild_id, user_id):
+        pending = self.pending.get(guild_id)
+        if pending is None:
+            pending = self.pending[guild_id] = {}
+            asyncio.ensure_future(self.query(guild_id))
+        if user_id not in pending:
+            pending[user_id] = asyncio.get_running_loop().create_future()
+        return pending[user_id]
+
+    # look up every user waiting on a guild, QUERY_LIMIT at a time
+    # whatever goes wrong (an unexpected error, or the task being canceled), every waiting lookup is answered with ""
+    # on the way out, so no handler is left awaiting a name forever
+    async def query(self, guild_id):
+        pending = None
+        try:
+            await asyncio.sleep(0) # let every lookup made this tick join the batch
+            pending = self.pending.pop(guild_id)
+            guild = self.bot.get_guild(guild_id)
+            user_ids = list(pending)
+            for start in range(0, len(user_ids), QUERY_LIMIT):
+                chunk = user_ids[start:start + QUERY_LIMIT]
+                found = {}
+                try:
+                    if guild is not None:
+                        members = await guild.query_members(user_ids=chunk, limit=len(chunk), presences=False, cache=False)
+                        found = {member.id: member.display_name for member in members}
+                        for user_id in chunk:
+                            self.cache.set(guild_id, user_id, found.get(user_id, ""))
+                except (asyncio.TimeoutError, discord.ClientException, discord.HTTPException):
+                    logger.exception(f"Couldn't look up {len(chunk)} members of guild {guild_id}")
+                for user_id in chunk:
+                    pending[user_id].set_result(found.get(user_id, ""))
+        except Exception:
+            logger.exception(f"Member lookup for guild {guild_id} failed")
+        finally:
+            if pending is None: # canceled before we took the batch (once we have, any new one is another query's to answer)
+                pending = self.pending.pop(guild_id, {})
+            for name in pending.values():
+                if not name.done():
+                    name.set_result("")
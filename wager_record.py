@@ -0,0 +1,140 @@
+import gzip
+import json
+import logging
+import sqlite3
+import time
+
+logger = logging.getLogger('discord')
+
+# records the gateway traffic the bot acts on to a compact event log, so it can be replayed later (see wager_replay.py)
+# the log is JSON lines (gzipped if the path ends in .gz): a header object, then one array per event, starting with
+# the seconds since recording started and a short event kind:
+#   ["m", message_id, channel_id, guild_id, author_id, author_name, content]   a command message from a user
+#   ["b", channel_id, message_id]                                               a message we sent in a guild channel
+#   ["ra"/"rr", message_id, channel_id, guild_id, user_id, emoji_id, emoji_name] a raw reaction added / removed
+#   ["rc", message_id, channel_id, guild_id]                                    all reactions cleared from a message
+#   ["re", message_id, channel_id, guild_id, emoji_id, emoji_name]              one emoji's reactions cleared
+#   ["mr", guild_id, user_id, name]                                             a member left a guild
+#   ["g", guild_id, [[emoji_id, emoji_name], ...]]                              a guild's emojis, when it's available or they change
+#   ["j", job_name]                                                             a scheduled job ran
+#   ["x", [message_id, ...]]                                                    the expiry sweeper expired these wagers
+#   ["xp", [message_id, ...]]                                                   the pool expiry sweeper expired these pools
+# recording also copies the database as it was when recording started next to the log, as the replay's starting point
+
+LOG_VERSION = 1
+# how often buffered log lines are flushed to disk
+FLUSH_INTERVAL = 1.0
+
+# open an event log for reading or writing, gzipped if the path ends in .gz
+def open_log(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+# read an event log; returns (header, [events])
+def read_log(path):
+    with open_log(path, "r") as log_file:
+        header = json.loads(log_file.readline())
+        return header, [json.loads(line) for line in log_file if line.strip()]
+
+# the path of the copy of the database taken when a log was started
+def start_db_path(log_path):
+    return log_path + ".start.db"
+
+class EventRecorder:
+    def __init__(self, path, command_prefix="!"):
+        self.path = path
+        self.command_prefix = command_prefix
+        self.started = time.monotonic()
+        self.last_flush = self.started
+        self.log_file = open_log(path, "w")
+        self.write(json.dumps({"version": LOG_VERSION, "started_at": time.time(), "command_prefix": command_prefix}))
+
+    # copy the database as it is now, so a replay can start from the same state (SQLite only)
+    def save_start_db(self, engine):
+        if engine.url.get_backend_name() != "sqlite":
+            logger.warning("Event log recording only saves the starting database for SQLite; replays will need one supplied")
+            return
+        with engine.connect() as connection:
+            target = sqlite3.connect(start_db_path(self.path))
+            try:
+                connection.connection.dbapi_connection.backup(target)
+            finally:
+                target.close()
+
+    # start recording a bot's events, the runs of its scheduled jobs, and the wagers and pools its expiry sweepers expire
+    def attach(self, bot, scheduler, sweeper, pool_sweeper):
+        self.bot = bot
+        for name in ["on_message", "on_raw_reaction_add", "on_raw_reaction_remove", "on_raw_reaction_clear",
+                     "on_raw_reaction_clear_emoji", "on_member_remove", "on_guild_available", "on_guild_emojis_update"]:
+            bot.add_listener(getattr(self, name), name)
+        for job in scheduler.jobs:
+            job.on_run = self.recording_job(job.name, job.on_run)
+        sweeper.on_expired = self.recording_expiry("x", sweeper.on_expired, lambda wager: wager.message_id)
+        pool_sweeper.on_expired = self.recording_expiry("xp", pool_sweeper.on_expired, lambda expired: expired[0].message_id)
+
+    def write(self, line):
+        self.log_file.write(line + "\n")
+        now = time.monotonic()
+        if now - self.last_flush >= FLUSH_INTERVAL:
+            self.log_file.flush()
+            self.last_flush = now
+
+    def record(self, *event):
+        self.write(json.dumps([round(time.monotonic() - self.started, 3)] + list(event), separators=(",", ":")))
+
+    def close(self):
+        self.log_file.close()
+
+    # -- listeners --
+
+    async def on_message(self, message):
+        guild_id = message.guild.id if message.guild else None
+        if message.author.id == self.bot.user.id:
+            if guild_id is not None: # replays hand out these IDs to the messages they send, in order
+                self.record("b", message.channel.id, message.id)
+        elif message.content.startswith(self.command_prefix):
+            self.record("m", message.id, message.channel.id, guild_id, message.author.id, message.author.display_name, message.content)
+
+    # our own reactions are left out: the bot ignores them, and a replay adds its own
+    async def on_raw_reaction_add(self, payload):
+        if payload.user_id == self.bot.user.id:
+            return
+        self.record("ra", payload.message_id, payload.channel_id, payload.guild_id, payload.user_id, payload.emoji.id, payload.emoji.name)
+
+    async def on_raw_reaction_remove(self, payload):
+        if payload.user_id == self.bot.user.id:
+            return
+        self.record("rr", payload.message_id, payload.channel_id, payload.guild_id, payload.user_id, payload.emoji.id, payload.emoji.name)
+
+    async def on_raw_reaction_clear(self, payload):
+        self.record("rc", payload.message_id, payload.channel_id, payload.guild_id)
+
+    async def on_raw_reaction_clear_emoji(self, payload):
+        self.record("re", payload.message_id, payload.channel_id, payload.guild_id, payload.emoji.id, payload.emoji.name)
+
+    async def on_member_remove(self, member):
+        self.record("mr", member.guild.id, member.id, member.display_name)
+
+    # the bot looks for its emojis in each guild it's in, so a replay has to give its fake guilds the same ones
+    async def on_guild_available(self, guild):
+        self.record("g", guild.id, [[emoji.id, emoji.name] for emoji in guild.emojis])
+
+    async def on_guild_emojis_update(self, guild, before, after):
+        self.record("g", guild.id, [[emoji.id, emoji.name] for emoji in after])
+
+    # wrap a scheduled job's on_run hook so each run is recorded too
+    def recording_job(self, name, on_run):
+        def recorded_on_run():
+            self.record("j", name)
+            if on_run is not None:
+                on_run()
+        return recorded_on_run
+
+    # wrap a sweeper's on_expired hook so each batch it expires is recorded too, by message ID (expiry depends on the wall
+    # clock, so a replay can't work it out for itself)
+    def recording_expiry(self, kind, on_expired, message_id):
+        async def recorded_on_expired(expired):
+            self.record(kind, [message_id(item) for item in expired])
+            await on_expired(expired)
+        return recorded_on_expired
@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import collections
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from discord.ext import commands
+import wager_fakes
+import wager_record
+from wager_bench import load_bot
+
+# replay an event log recorded with EVENT_LOG (see wager_record.py) against the bot, using wager_fakes in place of discord
+# the replay starts from the database saved when recording started, plays the events back at --speed times the
+# recorded pace, then compares every account's balance, every wager's state and every pool's state and entries with the
+# recorded run's database
+# usage: python wager_replay.py events.jsonl.gz --expected-db db.sql --speed 10
+
+# wager fields compared between the replayed and recorded databases (wagers are matched by message ID)
+WAGER_FIELDS = ["guild_id", "creator_id", "taker_id", "amount", "accepted", "completed", "winner_id", "loser_id"]
+# pool fields compared the same way (pools are matched by message ID too, and their entries by pool message and user ID)
+POOL_FIELDS = ["guild_id", "creator_id", "amount", "completed", "winning_outcome"]
+
+# events that wait for everything before them, and that everything after them waits for
+BARRIER_KINDS = ["j", "mr", "x", "xp"]
+
+# a command context that replies through the fake channel instead of discord's HTTP client
+class ReplayContext(commands.Context):
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content)
+
+class Replay:
+    def __init__(self, bot, fake, events, speed):
+        self.bot = bot
+        self.fake = fake
+        self.events = events
+        self.speed = speed
+        self.latest = {} # ordering key -> the latest task with that key
+        self.message_authors = {} # message_id -> the user whose command we sent that message for
+        self.pending = [] # tasks started since the last barrier event
+        self.barrier = None # the last barrier event's task
+        self.failures = 0
+
+    # -- building the fake world from the log --
+
+    def guild(self, guild_id):
+        return self.fake.guilds.get(guild_id) or self.fake.add_guild(f"guild{guild_id}", guild_id=guild_id)
+
+    def user(self, guild_id, user_id, name=None):
+        if guild_id is not None:
+            guild = self.guild(guild_id)
+            return guild.get_member(user_id) or self.fake.add_member(guild, user_id, name)
+        if user_id not in self.fake.users:
+            self.fake.users[user_id] = wager_fakes.FakeUser(self.fake, user_id, name or f"user{user_id}")
+        return self.fake.users[user_id]
+
+    # a guild channel, or (with no guild) a user's DM channel
+    def channel(self, channel_id, guild_id, user_id=None):
+        channel = self.fake.channels.get(channel_id)
+        if channel is None:
+            if guild_id is not None:
+                channel = self.fake.add_channel(self.guild(guild_id), channel_id)
+            else:
+                channel = wager_fakes.FakeChannel(self.fake, channel_id, None, wager_fakes.discord.ChannelType.private)
+                if user_id is not None:
+                    self.user(None, user_id).dm_channel = channel
+        return channel
+
+    def emoji(self, emoji_id, name):
+        if emoji_id is None:
+            return wager_fakes.FakeEmoji(None, name)
+        if emoji_id not in self.fake.emojis:
+            self.fake.emojis[emoji_id] = wager_fakes.FakeEmoji(emoji_id, name)
+        return self.fake.emojis[emoji_id]
+
+    def set_guild_emojis(self, guild_id, emojis):
+        self.guild(guild_id).emojis = [self.emoji(emoji_id, name) for emoji_id, name in emojis]
+
+    # create the guilds, channels and members the log mentions, give guilds the emojis they first had,
+    # and line up the IDs of the messages we sent in the recorded run so the replay's messages get the same ones
+    async def build_world(self):
+        emoji_guilds = set()
+        for event in self.events:
+            kind = event[1]
+            if kind == "m":
+                message_id, channel_id, guild_id, author_id, author_name, content = event[2:]
+                self.user(guild_id, author_id, author_name)
+                self.channel(channel_id, guild_id, author_id)
+            elif kind == "b":
+                channel_id, message_id = event[2:]
+                self.fake.sent_message_ids.setdefault(channel_id, collections.deque()).append(message_id)
+            elif kind in ["ra", "rr"]:
+                message_id, channel_id, guild_id, user_id = event[2:6]
+                self.user(guild_id, user_id)
+                self.channel(channel_id, guild_id, user_id)
+            elif kind in ["rc", "re"]:
+                self.channel(event[3], event[4])
+            elif kind == "mr":
+                guild_id, user_id, name = event[2:]
+                self.user(guild_id, user_id, name)
+            elif kind == "g" and event[2] not in emoji_guilds:
+                emoji_guilds.add(event[2])
+                self.set_guild_emojis(event[2], event[3])
+
+    # warm the caches and check each guild's emojis the way on_ready does
+    # (on_ready's catch-up on votes cast while offline isn't replayed: the log doesn't hold the reactions it would find)
+    async def warm_caches(self):
+        guild_ids = set(self.fake.guilds)
+        self.bot.emoji_cache.load(await self.bot.wager_db.run(self.bot.wager_db.find_all_emojis))
+        open_pools = await self.bot.wager_db.run(self.bot.wager_db.find_open_pools, guild_ids)
+        self.bot.wager_index.load(await self.bot.wager_db.run(self.bot.wager_db.find_active_wager_states, guild_ids),
+            [pool.message_id for pool in open_pools])
+        self.bot.leaderboards.load(await self.bot.wager_db.run(self.bot.wager_db.find_standings, guild_ids))
+        for guild_id in guild_ids:
+            await self.bot.validate_emojis(self.bot.REQUIRED_EMOJIS, guild_id)
+        self.bot.dispatcher.start()
+
+    # -- replaying --
+
+    # what an event has to wait for: it runs after every earlier event that shares one of its keys
+    # commands in a channel run in order so our messages get the same IDs as in the recorded run, reactions wait for the
+    # command that sent their message, and a user's own events (and events on their wagers) keep their recorded order
+    def ordering_keys(self, event):
+        kind = event[1]
+        if kind == "m":
+            return [("channel", event[3]), ("user", event[4], event[5])]
+        if kind in ["ra", "rr"]:
+            return [("message", event[2]), ("user", event[4], event[5]), ("user", event[4], self.message_authors.get(event[2]))]
+        if kind in ["rc", "re"]:
+            return [("message", event[2]), ("user", event[4], self.message_authors.get(event[2]))]
+        return []
+
+    # play every event at its recorded time (divided by the speed-up), each in its own task as the gateway would,
+    # but after the earlier events it depends on (see ordering_keys); scheduled jobs, expiries and members leaving (which
+    # cancels every wager they're in, as creator or taker) run with nothing else in flight
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.bot.bot.loop = loop # normally set when the bot logs in; needed to dispatch command errors
+        await self.build_world()
+        await self.warm_caches()
+        start = loop.time()
+        tasks = []
+        for event in self.events:
+            delay = event[0] / self.speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = event[1]
+            if kind == "b": # the message the channel's latest command sent
+                channel_id, message_id = event[2:]
+                command = self.latest.get(("channel", channel_id))
+                if command is not None:
+                    self.latest[("message", message_id)] = command
+                    self.message_authors[message_id] = command.author_id
+                continue
+            if kind in BARRIER_KINDS:
+                waits_for = self.pending + [self.barrier]
+                self.pending = []
+            else:
+                keys = self.ordering_keys(event)
+                waits_for = [self.latest[key] for key in keys if key in self.latest] + [self.barrier]
+            task = asyncio.ensure_future(self.play(event, waits_for))
+            task.author_id = event[5] if kind == "m" else None
+            if kind in BARRIER_KINDS:
+                self.barrier = task
+            else:
+                for key in keys:
+                    self.latest[key] = task
+                self.pending.append(task)
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        await self.bot.dispatcher.flush()
+        return loop.time() - start
+
+    async def play(self, event, waits_for):
+        waits_for = [task for task in waits_for if task is not None]
+        if waits_for:
+            await asyncio.wait(waits_for)
+        try:
+            await self.handle(event)
+        except Exception as error:
+            self.failures += 1
+            print(f"Replaying {event} failed: {error!r}")
+
+    async def handle(self, event):
+        bot = self.bot
+        kind = event[1]
+        if kind == "m":
+            message_id, channel_id, guild_id, author_id, author_name, content = event[2:]
+            channel = self.fake.channels[channel_id]
+            message = wager_fakes.FakeMessage(self.fake, message_id, channel, self.user(guild_id, author_id), content)
+            channel.messages[message_id] = message
+            ctx = await bot.bot.get_context(message, cls=ReplayContext)
+            if ctx.valid:
+                await bot.bot.invoke(ctx)
+        elif kind in ["ra", "rr"]:
+            message_id, channel_id, guild_id, user_id, emoji_id, emoji_name = event[2:]
+            message = self.fake.channels[channel_id].get_partial_message(message_id)
+            payload = self.fake.reaction_payload(message, user_id, self.emoji(emoji_id, emoji_name), kind == "ra")
+            if kind == "ra":
+                await bot.on_raw_reaction_add(payload)
+            else:
+                await bot.on_raw_reaction_remove(payload)
+        elif kind == "rc":
+            message_id, channel_id, guild_id = event[2:]
+            self.fake.channels[channel_id].get_partial_message(message_id).reactions_by_emoji.clear()
+            await bot.on_raw_reaction_clear(types.SimpleNamespace(message_id=message_id, channel_id=channel_id, guild_id=guild_id))
+        elif kind == "re":
+            message_id, channel_id, guild_id, emoji_id, emoji_name = event[2:]
+            emoji = self.emoji(emoji_id, emoji_name)
+            self.fake.channels[channel_id].get_partial_message(message_id).reactions_by_emoji.pop(str(emoji), None)
+            await bot.on_raw_reaction_clear_emoji(types.SimpleNamespace(message_id=message_id, channel_id=channel_id, guild_id=guild_id, emoji=emoji))
+        elif kind == "mr":
+            guild_id, user_id, name = event[2:]
+            member = self.guild(guild_id).members.pop(user_id, None) or wager_fakes.FakeMember(self.fake, user_id, name, self.guild(guild_id))
+            await bot.on_member_remove(member)
+        elif kind == "g":
+            self.set_guild_emojis(event[2], event[3])
+        elif kind == "j":
+            for job in bot.scheduler.jobs:
+                if job.name == event[2]:
+                    await bot.wager_db.run(job.func)
+                    if job.on_run is not None:
+                        job.on_run()
+        elif kind == "x": # the replay's own sweeper isn't started, as its deadlines would come from the replay's clock
+            message_ids = event[2]
+            async with bot.wager_event_locks.hold_all(message_ids):
+                expired = await bot.wager_db.run(bot.wager_db.expire_wagers_by_message, message_ids)
+                if expired:
+                    await bot.announce_canceled_wagers(expired, "Expired")
+        elif kind == "xp":
+            expired = await bot.wager_db.run(bot.wager_db.expire_pools_by_message, event[2])
+            await bot.announce_canceled_pools(expired, "Expired") # takes each pool's lock itself
+
+# -- comparing results --
+
+# read {(guild_id, user_id): (money, escrow)}, {message_id: {field: value}} for wagers and for pools, and
+# {(pool message_id, user_id): (outcome, amount)} for pool entries from a bot database (a database from before pools has none)
+def read_state(db_path):
+    connection = sqlite3.connect(db_path)
+    try:
+        balances = {(guild_id, user_id): (money, escrow) for guild_id, user_id, money, escrow in connection.execute('SELECT guild_id, id, money, escrow FROM "user"')}
+        wagers = {row[0]: dict(zip(WAGER_FIELDS, row[1:])) for row in connection.execute(f"SELECT message_id, {', '.join(WAGER_FIELDS)} FROM wager")}
+        pools = {}
+        entries = {}
+        if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'pool'").fetchone():
+            pools = {row[0]: dict(zip(POOL_FIELDS, row[1:])) for row in connection.execute(f"SELECT message_id, {', '.join(POOL_FIELDS)} FROM pool")}
+            entries = {(message_id, user_id): (outcome, amount) for message_id, user_id, outcome, amount in connection.execute(
+                "SELECT pool.message_id, pool_entry.user_id, pool_entry.outcome, pool_entry.amount FROM pool_entry JOIN pool ON pool.id = pool_entry.pool_id")}
+    finally:
+        connection.close()
+    return balances, wagers, pools, entries
+
+# list the differences between the replayed and recorded databases
+def compare_states(replayed_db, expected_db):
+    replayed = read_state(replayed_db)
+    expected = read_state(expected_db)
+    differences = []
+    for name, replayed_rows, expected_rows in zip(["account", "wager message", "pool message", "pool entry"], replayed, expected):
+        for key in sorted(set(replayed_rows) | set(expected_rows)):
+            if replayed_rows.get(key) != expected_rows.get(key):
+                differences.append(f"{name} {key}: replayed {replayed_rows.get(key)}, recorded {expected_rows.get(key)}")
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a recorded event log against the wager bot and check the results")
+    parser.add_argument("log", help="event log recorded with EVENT_LOG")
+    parser.add_argument("--start-db", help="database to start from (default: the copy saved next to the log)")
+    parser.add_argument("--expected-db", help="the recorded run's database at the end of recording, to compare results with")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than recorded to replay (e.g. 1, 10, 100)")
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated seconds per REST call")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="chance a REST call is rate limited")
+    args = parser.parse_args()
+    log_path = os.path.abspath(args.log)
+    start_db = os.path.abspath(args.start_db or wager_record.start_db_path(args.log))
+    expected_db = os.path.abspath(args.expected_db) if args.expected_db else None
+
+    header, events = wager_record.read_log(log_path)
+    if header.get("version") != wager_record.LOG_VERSION:
+        sys.exit(f"Unsupported event log version {header.get('version')}")
+
+    with tempfile.TemporaryDirectory(prefix="wager-replay-") as workdir:
+        shutil.copyfile(start_db, os.path.join(workdir, "db.sql"))
+        bot = load_bot(workdir)
+        bot.bot.command_prefix = header.get("command_prefix", "!")
+        bot.bot.owner_id = 0 # owner-only commands can't be checked without discord, so nobody is the owner
+        first_id = max([value for event in events for value in event if isinstance(value, int)] + [wager_fakes.FIRST_SNOWFLAKE]) + 1
+        fake = wager_fakes.FakeDiscord(latency=args.latency, rate_limit_chance=args.rate_limit, first_id=first_id)
+        fake.install(bot.bot)
+        replay = Replay(bot, fake, events, args.speed)
+        started = time.perf_counter()
+        asyncio.run(replay.run())
+        elapsed = time.perf_counter() - started
+        bot.wager_db.db_executor.shutdown()
+        bot.wager_models.engine.dispose()
+        print(f"Replayed {len(events)} events at {args.speed}x in {elapsed:.2f}s ({len(events) / elapsed:.1f} events/sec), {replay.failures} failed")
+        if expected_db is None:
+            print("No --expected-db given; skipping the comparison with the recorded run")
+            return
+        differences = compare_states(os.path.join(workdir, "db.sql"), expected_db)
+    for difference in differences[:50]:
+        print(difference)
+    if differences:
+        sys.exit(f"{len(differences)} difference(s) from the recorded run")
+    print("Final balances, wager and pool states match the recorded run")
+
+if __name__ == "__main__":
+    main()
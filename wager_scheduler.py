@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import logging
+import wager_db
+
+logger = logging.getLogger('discord')
+
+# never sleep longer than this between checks, so clock changes can't push a job out indefinitely
+MAX_SLEEP = 3600
+# how long to wait before retrying a job that failed
+RETRY_DELAY = 60
+
+# a job that runs at the same time every week
+# func(session) runs on the DB thread, in the same transaction that records the run, so each run happens exactly once
+# a big job can work in batches: if func returns True, the process that claimed the run calls it again (in a new transaction)
+# until it returns something falsy
+# on_run() (if given) runs on the event loop in every process once a run is due, whichever process did the work,
+# so each process can bring its in-memory state in line with it
+class WeeklyJob:
+    def __init__(self, name, weekday, at, func, on_run=None):
+        self.name = name
+        self.weekday = weekday # Monday is 0, Sunday is 6
+        self.at = at
+        self.func = func
+        self.on_run = on_run
+
+    # get the first time this job is due strictly after the given time
+    def next_due(self, after):
+        days_ahead = (self.weekday - after.weekday()) % 7
+        due = datetime.datetime.combine(after.date() + datetime.timedelta(days=days_ahead), self.at)
+        if due <= after:
+            due += datetime.timedelta(days=7)
+        return due
+
+# a job that runs at the same time every day
+class DailyJob:
+    def __init__(self, name, at, func, on_run=None):
+        self.name = name
+        self.at = at
+        self.func = func
+        self.on_run = on_run
+
+    # get the first time this job is due strictly after the given time
+    def next_due(self, after):
+        due = datetime.datetime.combine(after.date(), self.at)
+        if due <= after:
+            due += datetime.timedelta(days=1)
+        return due
+
+# runs jobs on asyncio timers, sleeping until the next one is due; each job's last run is stored in the DB
+class Scheduler:
+    def __init__(self):
+        self.jobs = []
+        self.task = None
+
+    # schedule a job to run every week on a weekday (0 = Monday) at a time of day
+    def every_week(self, name, weekday, at, func, on_run=None):
+        self.jobs.append(WeeklyJob(name, weekday, at, func, on_run))
+
+    # schedule a job to run every day at a time of day
+    def every_day(self, name, at, func, on_run=None):
+        self.jobs.append(DailyJob(name, at, func, on_run))
+
+    # start the scheduler; safe to call again (e.g. when on_ready fires after a reconnect)
+    def start(self):
+        if self.task is not None:
+            return
+        self.task = asyncio.ensure_future(self.run())
+
+    # run every due job (catching up each run missed while we were offline), then sleep until the next one is due
+    async def run(self):
+        last_runs = await wager_db.run(wager_db.load_job_runs, [job.name for job in self.jobs], datetime.datetime.now())
+        while True:
+            failed = False
+            for job in self.jobs:
+                due = job.next_due(last_runs[job.name])
+                while due <= datetime.datetime.now():
+                    try:
+                        more = await wager_db.run(run_job, job, last_runs[job.name], due)
+                        while more:
+                            more = await wager_db.run(job.func)
+                    except Exception:
+                        logger.exception(f"Scheduled job {job.name} failed")
+                        failed = True
+                        break
+                    last_runs[job.name] = due
+                    if job.on_run is not None:
+                        job.on_run()
+                    due = job.next_due(due)
+            next_due = min(job.next_due(last_runs[job.name]) for job in self.jobs)
+            delay = min((next_due - datetime.datetime.now()).total_seconds(), MAX_SLEEP)
+            if failed:
+                delay = RETRY_DELAY
+            await asyncio.sleep(max(delay, 0))
+
+# claim a job run, then do the job's work in the same transaction; returns what the job's func did (True if it has more to do)
+# if another process already claimed this run, the claim matches nothing and the job is skipped
+def run_job(session, job, previous_run, due):
+    if wager_db.claim_job_run(session, job.name, previous_run, due):
+        return job.func(session)
+    return False